@@ -0,0 +1,169 @@
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any
+import threading
+import secrets
+import asyncio
+import sqlite3
+import pickle
+import heapq
+import time
+
+
+TOKEN_BYTES = 6  # 8 url-safe characters, keeps "approve_key:<token>" far below Telegram's 64 bytes
+EVICT_INTERVAL = 60
+REF_SEPARATOR = "\n"  # an action for several objects stores their refs joined
+
+
+@dataclass
+class Action:
+    token: str
+    kind: str
+    payload: Any
+    expires: float
+    ref: str | None = None
+
+    @property
+    def refs(self) -> list[str]:
+        return self.ref.split(REF_SEPARATOR) if self.ref else []
+
+
+class ActionRegistry:
+    """
+    Server-side storage for callback payloads.
+
+    Buttons carry "<kind>:<token>" and the handler gets the payload back with one lookup.
+    Actions live in memory and in SQLite, so any worker process sharing the file can resolve them.
+    An action may have a ref (e.g. key name) to find the live action for an object; ref lookups
+    and pops always go to SQLite, since another worker may have consumed the action.
+    """
+
+    def __init__(self, path: str):
+        self.actions: dict[str, Action] = {}
+        self.expiry_heap: list[tuple[float, str]] = []
+        self.evict_task: asyncio.Task | None = None
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA busy_timeout=5000")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS actions ("
+            "token TEXT PRIMARY KEY, "
+            "kind TEXT NOT NULL, "
+            "ref TEXT, "
+            "payload BLOB NOT NULL, "
+            "expires REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS actions_ref ON actions (kind, ref)")
+
+    # region Disk
+
+    def _execute(self, sql: str, params: tuple = ()):
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def _delete(self, sql: str, params: tuple) -> int:
+        with self.lock:
+            return self.conn.execute(sql, params).rowcount
+
+    def _from_row(self, row) -> Action:
+        token, kind, ref, payload, expires = row
+        return Action(token, kind, pickle.loads(payload), expires, ref)
+
+    # endregion
+
+    def _remember(self, action: Action):
+        self.actions[action.token] = action
+        heapq.heappush(self.expiry_heap, (action.expires, action.token))
+        if self.evict_task is None or self.evict_task.done():
+            self.evict_task = asyncio.create_task(self._evict_loop())
+
+    async def issue(self, kind: str, payload: Any, ttl: float, ref: str | list[str] = None) -> str:
+        token = secrets.token_urlsafe(TOKEN_BYTES)
+        if isinstance(ref, list):
+            ref = REF_SEPARATOR.join(ref)
+        action = Action(token, kind, payload, time.time() + ttl, ref)
+        await asyncio.to_thread(
+            self._execute,
+            "INSERT INTO actions (token, kind, ref, payload, expires) VALUES (?, ?, ?, ?, ?)",
+            (token, kind, ref, pickle.dumps(payload), action.expires)
+        )
+        self._remember(action)
+        return token
+
+    async def get(self, token: str, kind: str = None, expired: bool = False) -> Action | None:
+        action = self.actions.get(token)
+        if action is None:
+            rows = await asyncio.to_thread(
+                self._execute,
+                "SELECT token, kind, ref, payload, expires FROM actions WHERE token = ?",
+                (token,)
+            )
+            if not rows:
+                return None
+            action = self._from_row(rows[0])
+            self._remember(action)
+        if (action.expires < time.time() and not expired) or (kind is not None and action.kind != kind):
+            return None
+        return action
+
+    async def find(self, kind: str, ref: str) -> Action | None:
+        rows = await asyncio.to_thread(
+            self._execute,
+            "SELECT token, kind, ref, payload, expires FROM actions "
+            "WHERE kind = ? AND ref = ? AND expires >= ? ORDER BY expires DESC LIMIT 1",
+            (kind, ref, time.time())
+        )
+        return self._from_row(rows[0]) if rows else None
+
+    async def live(self, kind: str) -> list[Action]:
+        """Unexpired actions of the kind issued by any worker, oldest first"""
+        rows = await asyncio.to_thread(
+            self._execute,
+            "SELECT token, kind, ref, payload, expires FROM actions WHERE kind = ? AND expires >= ? ORDER BY expires",
+            (kind, time.time())
+        )
+        return [self._from_row(row) for row in rows]
+
+    async def count(self, kind: str, ref: str) -> int:
+        rows = await asyncio.to_thread(
+            self._execute,
+            "SELECT COUNT(*) FROM actions WHERE kind = ? AND expires >= ? "
+            "AND instr(? || ref || ?, ? || ? || ?) > 0",  # ref is one of the action's refs
+            (kind, time.time(), REF_SEPARATOR, REF_SEPARATOR, REF_SEPARATOR, ref, REF_SEPARATOR)
+        )
+        return rows[0][0]
+
+    async def pop(self, token: str, kind: str = None, expired: bool = False) -> Action | None:
+        action = await self.get(token, kind, expired)
+        if action is None:
+            return None
+        # the DELETE decides who wins when two taps (or two workers) race for the same token
+        deleted = await asyncio.to_thread(self._delete, "DELETE FROM actions WHERE token = ?", (token,))
+        self.actions.pop(token, None)
+        return action if deleted else None
+
+    async def discard_ref(self, kind: str, ref: str) -> int:
+        """Deletes the actions with the ref, returns how many were still there"""
+        deleted = await asyncio.to_thread(self._delete, "DELETE FROM actions WHERE kind = ? AND ref = ?", (kind, ref))
+        for token in [t for t, a in self.actions.items() if a.kind == kind and a.ref == ref]:
+            del self.actions[token]
+        return deleted
+
+    async def evict(self):
+        # a grace period lets expiry handlers still pop the action they were waiting for
+        now = time.time() - EVICT_INTERVAL
+        while self.expiry_heap and self.expiry_heap[0][0] < now:
+            _, token = heapq.heappop(self.expiry_heap)
+            action = self.actions.get(token)
+            if action is not None and action.expires < now:
+                del self.actions[token]
+        await asyncio.to_thread(self._execute, "DELETE FROM actions WHERE expires < ?", (now,))
+
+    async def _evict_loop(self):
+        while self.actions:
+            await asyncio.sleep(EVICT_INTERVAL)
+            try:
+                await self.evict()
+            except Exception as e:
+                print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] ERR: Action registry eviction failed: {e}")
@@ -0,0 +1,128 @@
+from dataclasses import dataclass
+from datetime import datetime
+import numpy as np
+import sheets
+import time
+
+
+# region Constants
+
+
+OVERDUE_SECONDS = 60*60*24*3  # same threshold as the reminder about unreturned keys
+MIN_LOANS_FOR_RATE = 5  # employees with fewer loans are left out of the overdue ranking
+TOP_SIZE = 10
+STATS_MAX_AGE = 60*10  # open loans become overdue as time goes by, even if the history doesn't change
+EPOCH = datetime(1970, 1, 1)  # entries hold naive local times, so do the columns
+
+
+# endregion
+
+
+@dataclass
+class HistoryColumns:
+    """Accounting history as column arrays, one element per entry"""
+    key_names: list[str]
+    emp_names: list[str]
+    key_codes: np.ndarray  # Entry.key_id, index into key_names
+    emp_codes: np.ndarray  # Entry.emp_id, index into emp_names
+    received: np.ndarray  # seconds since epoch of the naive local time
+    returned: np.ndarray  # same, -1 for keys not returned yet
+
+    @classmethod
+    def from_entries(cls, entries: list) -> "HistoryColumns":
+        key_codes = np.fromiter((e.key_id for e in entries), np.int32, len(entries))
+        emp_codes = np.fromiter((e.emp_id for e in entries), np.int32, len(entries))
+        received = np.fromiter(((e.time_received - EPOCH).total_seconds() for e in entries), np.float64, len(entries))
+        returned = np.fromiter(
+            ((e.time_returned - EPOCH).total_seconds() if e.time_returned else -1 for e in entries),
+            np.float64, len(entries)
+        )
+        refs = sheets.space()  # of the site the entries were read from
+        key_names = list(refs.key_refs.values)
+        emp_names = [f"{first} {last}" for first, last in refs.employee_refs.values]
+        return cls(key_names, emp_names, key_codes, emp_codes, received.astype(np.int64), returned.astype(np.int64))
+
+    def since(self, start: int) -> "HistoryColumns":
+        mask = self.received >= start
+        return HistoryColumns(
+            self.key_names, self.emp_names,
+            self.key_codes[mask], self.emp_codes[mask], self.received[mask], self.returned[mask]
+        )
+
+
+@dataclass
+class StatsReport:
+    created: datetime
+    days: int | None
+    total: int
+    open: int
+    keys_used: int
+    employees: int
+    top_keys: list[tuple[str, int]]
+    avg_hold: float | None  # seconds
+    median_hold: float | None
+    overdue_total: int
+    overdue_rates: list[tuple[str, float, int]]  # (employee, overdue share, loans)
+    peak_hours: list[tuple[int, int]]  # (hour, loans), busiest first
+    weekdays: list[int]  # loans per weekday, Monday first
+
+
+def compute(columns: HistoryColumns, now: datetime, days: int | None = None) -> StatsReport:
+    now_seconds = int((now - EPOCH).total_seconds())
+    if days is not None:
+        columns = columns.since(now_seconds - days * 60*60*24)
+    total = len(columns.received)
+
+    is_open = columns.returned < 0
+    hold = np.where(is_open, now_seconds, columns.returned) - columns.received
+    closed_hold = hold[~is_open]
+    overdue = hold > OVERDUE_SECONDS
+
+    key_counts = np.bincount(columns.key_codes, minlength=len(columns.key_names))
+    top_keys = np.argsort(-key_counts, kind="stable")[:TOP_SIZE]
+
+    emp_counts = np.bincount(columns.emp_codes, minlength=len(columns.emp_names))
+    emp_overdue = np.bincount(columns.emp_codes, weights=overdue, minlength=len(columns.emp_names))
+    rated = np.flatnonzero((emp_counts >= MIN_LOANS_FOR_RATE) & (emp_overdue > 0))
+    rates = emp_overdue[rated] / emp_counts[rated]
+    worst = rated[np.argsort(-rates, kind="stable")][:TOP_SIZE]
+
+    hours = np.bincount((columns.received // 3600) % 24, minlength=24)
+    weekdays = np.bincount((columns.received // 86400 + 3) % 7, minlength=7)  # 01.01.1970 was a Thursday
+
+    return StatsReport(
+        created=now,
+        days=days,
+        total=total,
+        open=int(is_open.sum()),
+        keys_used=int(np.count_nonzero(key_counts)),
+        employees=int(np.count_nonzero(emp_counts)),
+        top_keys=[(columns.key_names[i], int(key_counts[i])) for i in top_keys if key_counts[i]],
+        avg_hold=float(closed_hold.mean()) if len(closed_hold) else None,
+        median_hold=float(np.median(closed_hold)) if len(closed_hold) else None,
+        overdue_total=int(overdue.sum()),
+        overdue_rates=[(columns.emp_names[i], float(emp_overdue[i] / emp_counts[i]), int(emp_counts[i])) for i in worst],
+        peak_hours=[(int(h), int(hours[h])) for h in np.argsort(-hours, kind="stable")[:3] if hours[h]],
+        weekdays=[int(count) for count in weekdays],
+    )
+
+
+class UsageStats:
+    """Column arrays and reports, cached until the entries list is replaced (the history version)"""
+
+    def __init__(self):
+        self.source = None
+        self.columns: HistoryColumns | None = None
+        self.reports: dict[int | None, tuple[float, StatsReport]] = {}
+
+    def get(self, entries: list, days: int | None = None) -> StatsReport:
+        if self.source is not entries:
+            self.columns = HistoryColumns.from_entries(entries)
+            self.source = entries
+            self.reports = {}
+        cached = self.reports.get(days)
+        if cached is not None and time.monotonic() - cached[0] < STATS_MAX_AGE:
+            return cached[1]
+        report = compute(self.columns, datetime.now(), days)
+        self.reports[days] = (time.monotonic(), report)
+        return report
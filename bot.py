@@ -1,19 +1,41 @@
 import json
+import re
 from aiogram.enums import ContentType, ChatAction
 from aiogram import Bot, Dispatcher, types, F
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.types import (
     ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup,
-    InlineKeyboardButton, Message, ErrorEvent, Poll)
+    InlineKeyboardButton, Message, ErrorEvent, Poll,
+    InlineQuery, InlineQueryResultArticle, InputTextMessageContent, FSInputFile)
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.filters import Command
 from aiogram.types import CallbackQuery
 from aiogram.dispatcher.middlewares.base import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.methods import SendMessage, EditMessageText
 from datetime import datetime, timedelta
 from requests.exceptions import ConnectionError
 import asyncio
+import time
 import sheets
+import storage
+import render
+import profiles
+import search
+import intervals
+import analytics
+import export
+import importer
+import migration
+import sites
+import inspector
+import actions
+import journal
+import dashboard
+import throttle
+import webhook
 import logger
 import os
 import sys
@@ -30,21 +52,39 @@ def resource_path(relative_path):
 logger = logger.Logger()
 print("Setting bot token")
 with open(resource_path(os.path.join("credentials", "telegram_bot.json")), "r") as f:
-    API_TOKEN = json.load(f)["telegram_apikey"]
-dp = Dispatcher(storage=MemoryStorage())
-bot: Bot = Bot(API_TOKEN)
+    bot_config = json.load(f)
+API_TOKEN = bot_config["telegram_apikey"]
+FSM_STORAGE_PATH = "fsm_storage.db"
+dp = Dispatcher(storage=storage.SQLiteStorage(FSM_STORAGE_PATH))
+action_registry = actions.ActionRegistry(FSM_STORAGE_PATH)
+if bot_config.get("api_server"):  # e.g. a local Bot API server or a fake one for tests
+    bot: Bot = Bot(API_TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(bot_config["api_server"])))
+else:
+    bot: Bot = Bot(API_TOKEN)
+worker_id = 0  # set by webhook workers, background jobs only run in worker 0
 print("Bot connected")
 
 
+JOURNAL_PATH = "key_journal.jsonl"
+
 print("Connecting to worksheets")
-keys_accounting_table = sheets.KeysAccountingTable()
-keys_table = sheets.KeysTable()
-emp_table = sheets.EmployeesTable()
+default_site = sites.Site(sites.DEFAULT, sheets.tables_data["spreadsheet_url"], JOURNAL_PATH, sheets.default_space)
+default_site.connect(sheets.spreadsheet)
+site_registry = sites.Sites(default_site, sheets.tables_data.get("sites", {}))
 print("Worksheets connected")
 
+# The site of the update being handled, see SiteMiddleware; the default site outside of updates
+key_journal = sites.Current(site_registry, "journal")
+keys_accounting_table = sites.Current(site_registry, "keys_accounting_table")
+keys_table = sites.Current(site_registry, "keys_table")
+emp_table = sites.Current(site_registry, "emp_table")
+
 
 async def main():
-    await dp.start_polling(bot)
+    if bot_config.get("mode") == "webhook":
+        await webhook.run_webhook(bot, dp, bot_config.get("webhook", {}))
+    else:
+        await dp.start_polling(bot)
 
 
 # endregion
@@ -53,47 +93,31 @@ async def main():
 # region Utils
 
 
-def make_serializable(data):
-    if isinstance(data, list):
-        return [make_serializable(item) for item in data]
-    elif isinstance(data, dict):
-        return {key: make_serializable(value) for key, value in data.items()}
-    elif hasattr(data, 'to_dict'):
-        return data.to_dict()
-    else:
-        # Если тип неизвестен и не имеет to_dict(), оставляем его как есть.
-        # Это может вызвать ошибку при попытке сериализации.
-        return str(data)
+def site_kind(kind: str) -> str:
+    """Actions are counted and matched per site, key names and sheet rows repeat across sites"""
+    site = site_registry.current()
+    return kind if site is default_site else f"{kind}:{site.name}"
 
 
-async def remove_key_after_delay(key, dictionary, delay=600):
+def request_kind() -> str:
+    return site_kind("key_request")
+
+
+async def expire_key_request(token, delay=600):
+    name = site_registry.current().name
     await asyncio.sleep(delay)
-    if key in dictionary:
+    with (await site_registry.get(name)).use():  # the site may have been closed and opened again meanwhile
+        action = await action_registry.pop(token, request_kind(), expired=True)
+        if action is None:
+            return
+        await asyncio.gather(*(
+            key_journal.record(journal.EXPIRED, key_name, user_id=action.payload["user_id"]) for key_name in action.refs
+        ))
+        await security_dashboard.resolve_request(token, "\n\nВремя запроса истекло")
         try:
-            await bot.send_message(chat_id=dictionary[key], text=f"Время запроса на ключ {key} истекло.")
+            await bot.send_message(chat_id=action.payload["user_id"], text=f"Время запроса на ключ {', '.join(action.refs)} истекло.")
         except Exception as e:
             print("Не удалось отправить сообщение пользователю:\n", e)
-        del dictionary[key]
-
-
-def escape_markdown(text: str):
-    escape_chars = ['_', '*', '[', '`']
-    for char in escape_chars:
-        text = text.replace(char, f'\\{char}')
-    return text
-
-
-def phone_format(phone: str | int):
-    phone = str(phone)
-    digits = ''.join(filter(str.isdigit, phone))
-    if digits.startswith('8'):
-        digits = '7' + digits[1:]
-    elif digits.startswith('7'):
-        pass
-    else:
-        digits = '7' + digits
-    digits = digits[:11]
-    return f'+{digits}'
 
 
 async def has_role(role: str, user_id: str):
@@ -114,42 +138,94 @@ async def check_registration(user_id: str) -> bool:
     return any(emp.telegram == user_id for emp in employees)
 
 
+async def security_chats() -> list[str]:
+    """Guards of the current site whose chats are routed to it"""
+    name = site_registry.current().name
+    return [emp.telegram for emp in await emp_table.get_security_employees() if site_registry.route(emp.telegram) == name]
+
+
+async def dashboard_text() -> str:
+    requests = [
+        (action.refs, f"{action.payload['emp'].first_name} {action.payload['emp'].last_name}")
+        for action in await action_registry.live(request_kind())
+    ]
+    return render.dashboard(requests, await keys_accounting_table.get_not_returned_keys())
+
+
+def setup_site(site: sites.Site):
+    """Per-site state of the bot: the guards' dashboards and the indexes built from the site's tables"""
+    site.dashboard = dashboard.Dashboard(bot, FSM_STORAGE_PATH, dashboard_text, security_chats, site=site.name)
+    site.key_intervals = intervals.IntervalIndex()
+    site.inline_indexes = search.IndexCache()
+    site.usage_stats = analytics.UsageStats()
+    if site_registry.background and site is not default_site:
+        site.dashboard.touch()
+
+
+site_registry.on_open = setup_site
+setup_site(default_site)
+security_dashboard = sites.Current(site_registry, "dashboard")
+
+
+async def replicate_closed_sites():
+    """Opens closed sites whose journal has events the sheet hasn't got, e.g. written just before the site was closed"""
+    while True:
+        await asyncio.sleep(journal.REPLICATE_RETRY)
+        for name in site_registry.config:
+            if name not in site_registry.open_sites and await site_registry.has_pending(name):
+                try:
+                    await site_registry.get(name)
+                except Exception as e:
+                    print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] ERR: Failed to open site {name}: {e}")
+
+
 # endregion
 
 
 # region Backend
 
-requested_keys = {}
-request_delay = 60*60  # 10 minutes
+request_delay = 60*60  # 1 hour
+return_action_delay = 60*60*24*7  # 7 days
 reminder_delay = 60*60*24  # 24 hours
+KEYS_SEPARATOR = re.compile(r"[,;\n]+")  # several keys in one /get_key or /return_key message
 
 
 async def time_reminder():
     while True:
-        try:
-            print("Checking for time reminders...")
-            not_returned_entries = await keys_accounting_table.get_not_returned_keys()
-
-            for entry in not_returned_entries:
-                print(f"Checking {entry.emp_firstname} {entry.emp_lastname} for key {entry.key_name}")
-                if entry.time_received + timedelta(days=3) < datetime.now():
-                    emp = await emp_table.get_by_name(entry.emp_firstname, entry.emp_lastname)
-                    if emp is None:
-                        print(f"Employee {entry.emp_firstname} {entry.emp_lastname} not returned key {entry.key_name} but not found in database for sending notification message")
-                        continue
-                    print("Sending notification message")
-                    await bot.send_message(chat_id=emp.telegram, text=f"Вы взяли ключ {entry.key_name} 3+ дня назад, но не вернули его. Пожалуйста, верните его в ближайшее время.")
-        except ConnectionError as e:
-            print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] ERR: Connection error (Remote end closed connection without response)")
-        except Exception as e:
-            logger.err(e, "Error in time_reminder")
+        for name in site_registry.names():
+            try:
+                with (await site_registry.get(name)).use():
+                    await remind_site()
+            except ConnectionError as e:
+                print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] ERR: Connection error (Remote end closed connection without response)")
+            except Exception as e:
+                logger.err(e, f"Error in time_reminder ({name})")
         await asyncio.sleep(reminder_delay)
 
 
+async def remind_site():
+    print("Checking for time reminders...")
+    not_returned_entries = await keys_accounting_table.get_not_returned_keys()
+
+    for entry in not_returned_entries:
+        print(f"Checking {entry.emp_firstname} {entry.emp_lastname} for key {entry.key_name}")
+        if entry.time_received + timedelta(days=3) < datetime.now():
+            emp = await emp_table.get_by_name(entry.emp_firstname, entry.emp_lastname)
+            if emp is None:
+                print(f"Employee {entry.emp_firstname} {entry.emp_lastname} not returned key {entry.key_name} but not found in database for sending notification message")
+                continue
+            print("Sending notification message")
+            await bot.send_message(chat_id=emp.telegram, text=f"Вы взяли ключ {entry.key_name} 3+ дня назад, но не вернули его. Пожалуйста, верните его в ближайшее время.")
+
+
 @dp.error()
 async def error_handler(event: ErrorEvent):
     if isinstance(event.exception, ConnectionError):
         print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] ERR: Connection error (Remote end closed connection without response)")
+        if event.update.message:
+            await event.update.message.answer(render.SHEETS_UNAVAILABLE)
+        elif event.update.callback_query:
+            await event.update.callback_query.answer(render.SHEETS_UNAVAILABLE)
         return
     logger.err(event.exception, additional_text="Error while handling command")
     if hasattr(event, "message"):
@@ -159,12 +235,22 @@ async def error_handler(event: ErrorEvent):
 
 @dp.startup()
 async def on_startup(dispatcher: Dispatcher):
-    asyncio.create_task(time_reminder())
+    site_registry.background = worker_id == 0
+    if worker_id == 0:
+        asyncio.create_task(time_reminder())
+        asyncio.create_task(replicate_closed_sites())
+        security_dashboard.touch()  # posts dashboards for guards added while the bot was down
+    await default_site.start(site_registry.background)
     print(f"Bot \'{(await bot.get_me()).username}\' started")
 
 
 @dp.shutdown()
 async def on_shutdown(*args, **kwargs):
+    site_registry.stop()
+    default_site.refresher.stop()
+    default_site.replicator.stop()
+    if sheets.api is not None:
+        await sheets.api.close()
     print(f"Bot \'{(await bot.get_me()).username}\' stopped")
 
 
@@ -174,7 +260,46 @@ class LogCommandsMiddleware(BaseMiddleware):
         return await handler(event, data)
 
 
+class SiteMiddleware(BaseMiddleware):
+    """Handles the update with the tables of the site its chat is routed to (the user's id for inline queries)"""
+
+    async def __call__(self, handler, event, data: dict):
+        reads_token = sheets.tables_read.set(set())  # see StaleDataMiddleware
+        try:
+            chat, user = data.get("event_chat"), data.get("event_from_user")
+            if chat is None and user is None:
+                return await handler(event, data)
+            site = await site_registry.for_chat(chat.id if chat is not None else user.id)
+            with site.use():
+                return await handler(event, data)
+        finally:
+            sheets.tables_read.reset(reads_token)
+
+
+class StaleDataMiddleware(BaseRequestMiddleware):
+    """
+    Marks outgoing texts built from the last good snapshot while Sheets is offline. Only texts of handlers
+    that read accounting or keys data are marked, employee reads are left out as every role check does one.
+    """
+
+    async def __call__(self, make_request, bot: Bot, method):
+        if isinstance(method, (SendMessage, EditMessageText)) and method.text:
+            method.text = render.strip_stale_marker(method.text)
+            stale_since = sheets.space().breaker.stale_since()  # of the site the update is routed to
+            if stale_since is not None and sheets.tables_read.get():
+                method.text += render.stale_marker(stale_since)
+        return await make_request(bot, method)
+
+
+profile_cache = profiles.ProfileCache()
+throttling = throttle.ThrottlingMiddleware(throttle.TokenBuckets())
+
 dp.message.middleware.register(LogCommandsMiddleware())
+dp.message.middleware.register(throttling)
+dp.callback_query.middleware.register(throttling)
+dp.update.outer_middleware.register(profiles.ProfilesMiddleware(profile_cache))
+dp.update.outer_middleware.register(SiteMiddleware())
+bot.session.middleware(StaleDataMiddleware())
 
 
 # endregion
@@ -306,13 +431,14 @@ async def finalize_data(message: types.Message, state: FSMContext):
 async def confirm_data(callback_query: CallbackQuery, state: FSMContext):
     try:
         user_data = await state.get_data()
-        await emp_table.new_employee(
+        await key_journal.employee_added(sheets.Employee(
             user_data["name"],
             user_data["surname"],
-            phone_format(user_data["phone"]),
+            render.phone_format(user_data["phone"]),
             callback_query.from_user.id,
+            [],
             # "user",
-        )
+        ))
     except Exception as e:
         print(e)
         logger.err(e, "Error in confirm registration data")
@@ -343,10 +469,58 @@ async def get_key(message: types.Message, state: FSMContext):
 
     emp = await emp_table.get_by_telegram(message.from_user.id)
     await state.update_data(emp=emp)
-    await message.answer("Введите название ключа или номер базовой станции\n\n(/cancel для отмены)")
+    await message.answer(
+        "Введите название ключа или номер базовой станции\n"
+        "Несколько ключей можно перечислить через запятую\n\n(/cancel для отмены)")
     await state.set_state(GetKeyState.waiting_for_key)
 
 
+async def resolve_key_names(text: str, key_names: set[str]) -> tuple[list[str], list[str]]:
+    """Keys of a comma separated list, plus the parts that match no key or several"""
+    found, unknown = [], []
+    for part in KEYS_SEPARATOR.split(text):
+        part = part.strip()
+        if not part:
+            continue
+        similarities = await sheets.find_similar(part, key_names)
+        if part in key_names:
+            key_name = part
+        elif len(similarities) == 1:
+            key_name = similarities[0]
+        else:
+            unknown.append(part)
+            continue
+        if key_name not in found:
+            found.append(key_name)
+    return found, unknown
+
+
+async def get_key_names(message: types.Message, state: FSMContext, key_names: set[str]):
+    found, unknown = await resolve_key_names(message.text, key_names)
+    if unknown:
+        await message.answer(
+            f"Не удалось однозначно определить ключи: {', '.join(unknown)}\n"
+            "Введите список ещё раз\n\n(/cancel для отмены)")
+        return
+    unavailable = []
+    for key_name in found:
+        copies = (await keys_table.get_by_name(key_name)).copies
+        available = await keys_accounting_table.get_available(key_name, copies)
+        if available <= 0:
+            unavailable.append(f"{key_name} (уже взят)")
+        elif await action_registry.count(request_kind(), key_name) >= available:
+            unavailable.append(f"{key_name} (уже запрошен)")
+    if unavailable:
+        await message.answer(f"Сейчас недоступны: {', '.join(unavailable)}")
+        await state.clear()
+        return
+    await state.update_data(keys=found)
+    await message.answer(
+        f"Ключи: {', '.join(found)}\n"
+        f"Теперь введите комментарий\n\n(/empty - без комментария)\n\n(/cancel для отмены)")
+    await state.set_state(GetKeyState.waiting_for_comment)
+
+
 @dp.message(GetKeyState.waiting_for_key)
 async def get_key_name(message: types.Message, state: FSMContext):
     if message.text == "/cancel":
@@ -355,7 +529,10 @@ async def get_key_name(message: types.Message, state: FSMContext):
         return
     msg = await message.answer("Поиск ключа...", reply_markup=types.ReplyKeyboardRemove())
     key_names = {key.key_name for key in await keys_table.get_all_keys()}
-    not_returned_keys = {key.key_name for key in await keys_accounting_table.get_not_returned_keys()}
+    if len(KEYS_SEPARATOR.split(message.text.strip(" ,;\n"))) > 1:
+        await msg.delete()
+        await get_key_names(message, state, key_names)
+        return
     similarities = await sheets.find_similar(message.text, key_names)
 
     if message.text in key_names or len(similarities) == 1:
@@ -363,18 +540,20 @@ async def get_key_name(message: types.Message, state: FSMContext):
             key_name = similarities[0]
         else:
             key_name = message.text
-        if key_name in not_returned_keys:
+        copies = (await keys_table.get_by_name(key_name)).copies
+        available = await keys_accounting_table.get_available(key_name, copies)
+        if available <= 0:
             await msg.delete()
-            await message.answer("Этот ключ уже взят:")
+            await message.answer("Этот ключ уже взят:" if copies == 1 else "Все экземпляры этого ключа уже взяты:")
             await message.answer(await get_key_state_str(key_name), reply_markup=types.ReplyKeyboardRemove(), parse_mode="Markdown")
             await state.clear()
             return
-        if key_name in requested_keys:
+        if await action_registry.count(request_kind(), key_name) >= available:
             await msg.delete()
-            await message.answer("Этот ключ уже запрошен.")
+            await message.answer("Этот ключ уже запрошен." if copies == 1 else "Все свободные экземпляры этого ключа уже запрошены.")
             await state.clear()
             return
-        await state.update_data(key=key_name)
+        await state.update_data(keys=[key_name])
         await msg.delete()
         await message.answer(
             f"Ключ: {key_name}\n"
@@ -409,161 +588,123 @@ async def get_key_comment(message: types.Message, state: FSMContext):
 
     msg = await message.answer("Обработка...")
 
-    security_emp = await emp_table.get_security_employee()
-    if not security_emp:
+    security_ids = await security_chats()
+    if not security_ids:
         await message.reply("Охранник не зарегистрирован.")
         await state.clear()
         return
 
-    security_id = security_emp.telegram
-    key_name = (await state.get_data())["key"]
-    comment = (await state.get_data())["comment"]
-    emp_from = (await state.get_data())["emp"]
+    data = await state.get_data()
+    key_names = data.get("keys") or [data["key"]]
+    comment = data["comment"]
+    emp_from = data["emp"]
 
-    callback_data_approve = f"approve_key:{message.from_user.id}:{key_name}:{comment}"
-    callback_data_deny = f"deny_key:{message.from_user.id}:{key_name}"
+    token = await action_registry.issue(
+        request_kind(),
+        {"user_id": message.from_user.id, "emp": emp_from, "comment": comment, "keys": key_names},
+        request_delay,
+        ref=key_names,
+    )
 
     keyboard = InlineKeyboardMarkup(
         inline_keyboard=[
-            [InlineKeyboardButton(text="Подтвердить выдачу ключей", callback_data=callback_data_approve)],
-            [InlineKeyboardButton(text="Отклонить", callback_data=callback_data_deny)]
+            [InlineKeyboardButton(text="Подтвердить выдачу ключей", callback_data=f"approve_key:{token}")],
+            [InlineKeyboardButton(text="Отклонить", callback_data=f"deny_key:{token}")]
         ]
     )
 
-    await bot.send_message(
-        chat_id=security_id,
-        text=(
+    sent = await security_dashboard.send_request(  # every guard gets it, the first tap wins
+        security_ids,
+        token,
+        (
             f"{f"Запрос на выдачу ключей от пользователя @{message.from_user.username}\n" if message.from_user.username else "Запрос на выдачу ключей\n"}"
-            f"Ключ: {key_name}\n"
+            f"{'Ключ' if len(key_names) == 1 else 'Ключи'}: {', '.join(key_names)}\n"
             f"Имя: {emp_from.first_name} {emp_from.last_name}\n"
             f"{f"Комментарий: {comment}\n\n" if comment else ""}"
             "Подтвердите действие:"
         ),
-        reply_markup=keyboard,
+        keyboard,
     )
+    if not sent:
+        await action_registry.pop(token, request_kind())
+        await msg.edit_text("Не удалось отправить запрос охраннику, попробуйте позже.")
+        await state.clear()
+        return
 
     await msg.edit_text("Запрос отправлен охраннику. Ожидайте подтверждения.")
     await state.clear()
-    requested_keys[key_name] = message.from_user.id
-    asyncio.create_task(remove_key_after_delay(key_name, requested_keys, request_delay))
+    asyncio.create_task(expire_key_request(token, request_delay))
 
 
 @dp.callback_query(F.data.startswith("approve_key"))
 async def approve_key(callback: CallbackQuery) -> None:
-    _, user_id, key_name, comment = callback.data.split(":")
-    if key_name not in requested_keys:
+    token = callback.data.split(":", 1)[1]
+    action = await action_registry.pop(token, request_kind())
+    if action is None:
         await callback.message.edit_text(callback.message.text+"\n\nВремя запроса истекло")
         return
 
-    emp = await emp_table.get_by_telegram(int(user_id))
+    key_names = action.payload.get("keys") or [action.ref]
+    user_id, emp, comment = action.payload["user_id"], action.payload["emp"], action.payload["comment"]
 
+    # recorded before the employee is told, so whatever they send next already sees the keys on loan
+    await key_journal.issued_many(key_names, emp, comment)  # one journal write, one sheet write for all keys
     await bot.send_message(
         chat_id=user_id,
         text="✔ Охранник подтвердил ваш запрос на выдачу ключей",
     )
 
     await callback.message.edit_text(callback.message.text+"\n\n✔ Выдача ключа подтверждена")
-    await keys_accounting_table.new_entry(
-        key_name,
-        emp.first_name,
-        emp.last_name,
-        emp.phone_number,
-        comment=comment,
-    )
-    if key_name in requested_keys:
-        del requested_keys[key_name]
+    await security_dashboard.resolve_request(
+        token, f"\n\n✔ Выдачу подтвердил {callback.from_user.full_name}", handled_in=callback.message.chat.id)
 
 
 @dp.callback_query(F.data.startswith("deny_key"))
 async def deny_key(callback: CallbackQuery) -> None:
-    _, user_id, key_name = callback.data.split(":")
-    if key_name not in requested_keys:
+    token = callback.data.split(":", 1)[1]
+    action = await action_registry.pop(token, request_kind())
+    if action is None:
         await callback.message.edit_text(callback.message.text+"\n\nВремя запроса истекло")
         return
 
     await bot.send_message(
-        chat_id=user_id,
+        chat_id=action.payload["user_id"],
         text="❌ Охранник отклонил ваш запрос на выдачу ключей.",
     )
+    await asyncio.gather(*(
+        key_journal.record(journal.DENIED, key_name, user_id=action.payload["user_id"]) for key_name in action.refs
+    ))
     await callback.message.edit_text(callback.message.text+"\n\n❌ Вы отклонили запрос на выдачу ключей.")
-    if key_name in requested_keys:
-        del requested_keys[key_name]
+    await security_dashboard.resolve_request(
+        token, f"\n\n❌ Запрос отклонил {callback.from_user.full_name}", handled_in=callback.message.chat.id)
 
 
 async def state_format(entry: sheets.Entry, key_info: bool = True) -> str:
-    if key_info:
-        key = await keys_table.get_by_name(entry.key_name)
-        if key is None:
-            return await state_format(entry, key_info=False)
-        if entry.time_returned is None:
-            return (
-                f"*Ключ*: `{entry.key_name}`\n"
-                f"*  Состояние*: Не на месте\n"
-                f"*  Количество ключей*: `{key.count}`\n"
-                f"*  Тип ключа*: `{key.key_type}`\n"
-                f"*  Тип аппаратный*: `{key.hardware_type}`\n\n"
-                f"*Ключ выдан:*\n"
-                f"  *Имя*: `{entry.emp_firstname} {entry.emp_lastname}`\n"
-                f"  *Выдан в*: `{entry.time_received.strftime('%H:%M (%d.%m.%Y)')}`\n"
-                f"{f"  *Комментарии*: \"{escape_markdown(entry.comment)}\"\n" if entry.comment else ""}"
-                f"  *Контакт*: {phone_format(entry.emp_phone)}\n"
-            )
-        else:
-            return (
-                f"*Ключ*: `{entry.key_name}`\n"
-                f"*  Состояние*: Этот ключ сейчас на месте\n"
-                f"*  Количество ключей*: `{key.count}`\n"
-                f"*  Тип ключа*: `{key.key_type}`\n"
-                f"*  Тип аппаратный*: `{key.hardware_type}`\n\n"
-                f"*Последний пользователь:*\n"
-                f"  *Имя*: `{entry.emp_firstname} {entry.emp_lastname}`\n"
-                f"  *Взял в*: `{entry.time_received.strftime('%H:%M (%d.%m.%Y)')}`\n"
-                f"  *Вернул в*: `{entry.time_returned.strftime('%H:%M (%d.%m.%Y)')}`\n"
-                f"{f"  *Комментарии*: \"{escape_markdown(entry.comment)}\"\n" if entry.comment else ""}"
-                f"  *Контакт*: {phone_format(entry.emp_phone)}\n"
-            )
-    else:
-        if entry.time_returned is None:
-            return (
-                f"*Ключ*: `{entry.key_name}`\n"
-                f"*  Состояние*: Не на месте\n"
-                f"*Ключ выдан:*\n"
-                f"  *Имя*: `{entry.emp_firstname} {entry.emp_lastname}`\n"
-                f"  *Выдан в*: `{entry.time_received.strftime('%H:%M (%d.%m.%Y)')}`\n"
-                f"{f"  *Комментарии*: \"{escape_markdown(entry.comment)}\"\n" if entry.comment else ""}"
-                f"  *Контакт*: {phone_format(entry.emp_phone)}\n"
-            )
-        else:
-            return (
-                f"*Ключ*: `{entry.key_name}`\n"
-                f"*  Состояние*: Этот ключ сейчас на месте\n"
-                f"*Последний пользователь:*\n"
-                f"  *Имя*: `{entry.emp_firstname} {entry.emp_lastname}`\n"
-                f"  *Взял в*: `{entry.time_received.strftime('%H:%M (%d.%m.%Y)')}`\n"
-                f"  *Вернул в*: `{entry.time_returned.strftime('%H:%M (%d.%m.%Y)')}`\n"
-                f"{f"  *Комментарии*: \"{escape_markdown(entry.comment)}\"\n" if entry.comment else ""}"
-                f"  *Контакт*: {phone_format(entry.emp_phone)}\n"
-            )
+    key = await keys_table.get_by_name(entry.key_name) if key_info else None
+    return render.key_card(entry, key)
 
 
 async def get_key_state_str(key_name: str) -> str:
-    entries = await keys_accounting_table.get_all_entries()
-    key_entries = [entry for entry in entries if entry.key_name == key_name]
+    key_entries = (await keys_accounting_table.get_entries_by_key()).get(key_name)
+    key = await keys_table.get_by_name(key_name)
     if not key_entries:
-        key = await keys_table.get_by_name(key_name)
         if key is None:
             return "По этому ключу нет записей в истории и в таблице ключей"
         else:
-            return (
-                f"*Ключ*: `{key_name}`\n"
-                f"*  Состояние*: На месте\n"
-                f"*  Количество ключей*: `{key.count}`\n"
-                f"*  Тип ключа*: `{key.key_type}`\n"
-                f"*  Тип аппаратный*: `{key.hardware_type}`\n\n"
-                f"Нет информации по последнему пользователю\n"
-            )
-    last_entry = key_entries[-1]
-    return await state_format(last_entry)
+            return render.key_card_no_history(key_name, key)
+    available = None
+    if key is not None and key.copies > 1:
+        available = await keys_accounting_table.get_available(key_name, key.copies)
+    return render.key_card(key_entries[-1], key, available)
+
+
+async def known_key_names() -> set[str]:
+    """Keys of the keys worksheet and of the history, from the indexes instead of a scan over the history"""
+    entries_by_key, keys_index = await asyncio.gather(
+        keys_accounting_table.get_entries_by_key(),
+        keys_table.get_keys_index(),
+    )
+    return entries_by_key.keys() | keys_index.keys()
 
 
 class FindKeyState(StatesGroup):
@@ -584,9 +725,7 @@ async def find_key(message: types.Message, state: FSMContext):
 async def waiting_for_key_name(message: types.Message, state: FSMContext):
     msg = await message.answer("Поиск ключа...")
     await state.update_data(key=message.text)
-    entries = await keys_accounting_table.get_all_entries()
-    keys_obj = await keys_table.get_all_keys()
-    key_names = {entry.key_name for entry in entries} | {key.key_name for key in keys_obj}
+    key_names = await known_key_names()
     similarities = await sheets.find_similar(message.text, key_names)
 
     if not similarities:
@@ -631,9 +770,7 @@ async def get_key_history(message: types.Message, state: FSMContext):
 async def waiting_for_key_name(message: types.Message, state: FSMContext):
     msg = await message.answer("Получение истории...")
     await state.update_data(key=message.text)
-    entries = await keys_accounting_table.get_all_entries()
-    keys_obj = await keys_table.get_all_keys()
-    key_names = {entry.key_name for entry in entries} | {key.key_name for key in keys_obj}
+    key_names = await known_key_names()
     similarities = await sheets.find_similar(message.text, key_names)
 
     if not similarities:
@@ -659,41 +796,16 @@ async def waiting_for_key_name(message: types.Message, state: FSMContext):
 
 
 async def get_key_history_str(key_name: str):
-    key, entries = await asyncio.gather(
+    key, entries_by_key = await asyncio.gather(
         keys_table.get_by_name(key_name),
-        keys_accounting_table.get_all_entries()
+        keys_accounting_table.get_entries_by_key()
+    )
+    key_entries = entries_by_key.get(key_name, [])
+    return render.chunks(
+        render.key_history_header(key_name, key, len(key_entries)),
+        [render.key_history_line(entry) for entry in key_entries],
+        "По этому ключу нет записей",
     )
-    key_entries = [entry for entry in entries if entry.key_name == key_name]
-    response_strs = [""]
-    if key:
-        response_strs[-1] = (
-            f"*Ключ*: `{key_name}`\n"
-            f"*Количество ключей*: `{key.count}`\n"
-            f"*Тип ключа*: `{key.key_type}`\n"
-            f"*Тип аппаратный*: `{key.hardware_type}`\n"
-            f"*Этот ключ брали*: {len(key_entries)} раз(а)\n\n"
-        )
-    else:
-        response_strs[-1] = (
-            f"*Ключ*: `{key_name}`\n"
-            f"*Этот ключ брали*: {len(key_entries)} раз(а)\n\n"
-        )
-    if not key_entries:
-        response_strs[-1] += "По этому ключу нет записей"
-        return response_strs
-    for entry in key_entries:
-        if len(response_strs[-1]) > 2000:
-            response_strs.append("")
-        response_strs[-1] += (
-            f"*Имя*: `{entry.emp_firstname} {entry.emp_lastname}`\n"
-            f"| *Взял в*: `{entry.time_received.strftime('%H:%M (%d.%m.%Y)')}`\n"
-            f"{f"| *Вернул в*: `{entry.time_returned.strftime('%H:%M (%d.%m.%Y)')}`\n" if entry.time_returned else ""}"
-            f"| *Контакт*: {phone_format(entry.emp_phone)}\n"
-            f"{f"| *Комментарии*: \"{escape_markdown(entry.comment)}\"\n" if entry.comment else ""}"
-        )
-        response_strs[-1] += "\n"
-
-    return response_strs
 
 
 class GetEmpHistoryState(StatesGroup):
@@ -750,44 +862,117 @@ async def waiting_for_emp_name(message: types.Message, state: FSMContext):
 
 async def get_emp_history_str(emp_name: str):
     first_name, last_name = emp_name.split(" ", 1)
-    emp, entries = await asyncio.gather(
+    emp, entries_by_emp = await asyncio.gather(
         emp_table.get_by_name(first_name, last_name),
-        keys_accounting_table.get_all_entries()
+        keys_accounting_table.get_entries_by_emp()
     )
-    emp_entries = []
-    for entry in entries:
-        if entry.emp_firstname == first_name and entry.emp_lastname == last_name:
-            emp_entries.append(entry)
-    response_strs = [""]
-    if emp:
-        tg = await bot.get_chat(emp.telegram)
-        response_strs[-1] = (
-            f"*Имя*: `{emp.first_name} {emp.last_name}`\n"
-            f"*Телефон*: {phone_format(emp.phone_number)}\n"
-            f"{f"*Телеграм*: @{tg.username}\n" if tg.username else ""}"
-            f"*Роли*: {', '.join(emp.roles) if emp.roles else 'Нет'}\n"
-            f"*Этот сотрудник брал ключи*: {len(emp_entries)} раз(а)\n\n"
-        )
-    else:
-        response_strs[-1] = (
-            f"*Имя*: `{first_name} {last_name}`\n"
-            f"*Этот сотрудник брал ключи*: {len(emp_entries)} раз(а)\n\n"
-        )
-    if not emp_entries:
-        response_strs[-1] += "По этому сотруднику нет записей"
-        return response_strs
-    for entry in emp_entries:
-        if len(response_strs[-1]) > 2000:
-            response_strs.append("")
-        response_strs[-1] += (
-            f"*Ключ*: `{entry.key_name}`\n"
-            f"| *Взял в*: `{entry.time_received.strftime('%H:%M (%d.%m.%Y)')}`\n"
-            f"{f"| *Вернул в*: `{entry.time_returned.strftime('%H:%M (%d.%m.%Y)')}`\n" if entry.time_returned else ""}"
-            f"{f"| *Комментарии*: \"{escape_markdown(entry.comment)}\"\n" if entry.comment else ""}"
-        )
-        response_strs[-1] += "\n"
+    emp_entries = entries_by_emp.get((first_name, last_name), [])
+    username = None
+    if emp and emp.telegram.isdigit():
+        profile = profile_cache.get(emp.telegram)
+        if profile is None:
+            profile_cache.refresh_later(bot, emp.telegram)
+        else:
+            username = profile.username
+    return render.chunks(
+        render.emp_history_header(emp_name, emp, len(emp_entries), username),
+        [render.emp_history_line(entry) for entry in emp_entries],
+        "По этому сотруднику нет записей",
+    )
+
+
+key_intervals = sites.Current(site_registry, "key_intervals")
+
+
+class WhoHadKeyState(StatesGroup):
+    waiting_for_key = State()
+    waiting_for_time = State()
+
+
+@dp.message(Command("who_had"))
+async def who_had_key(message: types.Message, state: FSMContext):
+    if not await has_role("user", message.from_user.id):
+        await message.answer("Вы не имеете доступа к этой команде.")
+        return
+
+    await message.answer("Введите название ключа или номер базовой станции\n\n(/cancel для отмены)")
+    await state.set_state(WhoHadKeyState.waiting_for_key)
+
+
+@dp.message(WhoHadKeyState.waiting_for_key)
+async def who_had_key_name(message: types.Message, state: FSMContext):
+    if message.text == "/cancel":
+        await state.clear()
+        await message.answer("Отменено.", reply_markup=types.ReplyKeyboardRemove())
+        return
+    key_names = await known_key_names()
+    similarities = [message.text] if message.text in key_names else await sheets.find_similar(message.text, key_names)
+
+    if not similarities:
+        await message.answer("Ключ не найден", reply_markup=types.ReplyKeyboardRemove())
+        await state.clear()
+        return
+
+    if len(similarities) > 1:
+        kb = []
+        for sim in similarities:
+            kb.append([KeyboardButton(text=sim)])
+        await message.answer(
+            "Выберите ключ из найденных:",
+            reply_markup=ReplyKeyboardMarkup(keyboard=kb, resize_keyboard=True, one_time_keyboard=True))
+        return
+
+    await state.update_data(key=similarities[0])
+    await message.answer(
+        f"Ключ: {similarities[0]}\n"
+        "Введите время (ДД.ММ.ГГГГ ЧЧ:ММ), дату (ДД.ММ.ГГГГ) или период через дефис "
+        "(ДД.ММ.ГГГГ ЧЧ:ММ - ДД.ММ.ГГГГ ЧЧ:ММ)\n\n(/cancel для отмены)",
+        reply_markup=types.ReplyKeyboardRemove())
+    await state.set_state(WhoHadKeyState.waiting_for_time)
+
+
+@dp.message(WhoHadKeyState.waiting_for_time)
+async def who_had_key_time(message: types.Message, state: FSMContext):
+    if message.text == "/cancel":
+        await state.clear()
+        await message.answer("Отменено.")
+        return
+    try:
+        start, end = parse_period(message.text)
+    except ValueError:
+        await message.answer("Не удалось распознать время, попробуйте еще раз\n\n(/cancel для отмены)")
+        return
+    key_name = (await state.get_data())["key"]
+    for msg in await get_key_holders_str(key_name, start, end):
+        await message.answer(msg, parse_mode="Markdown")
+    await state.clear()
+
+
+def parse_period(text: str) -> tuple[datetime, datetime | None]:
+    """(moment, None) for a point in time, (start, end) for a date or an explicit range"""
+    parts = [part.strip() for part in text.split(" - ")]
+    if len(parts) == 2:
+        start, end = parse_period(parts[0]), parse_period(parts[1])
+        return start[0], end[1] or end[0]
+    if len(parts) != 1:
+        raise ValueError(f"Invalid period: {text}")
+    try:
+        return datetime.strptime(parts[0], "%d.%m.%Y %H:%M"), None
+    except ValueError:
+        day = datetime.strptime(parts[0], "%d.%m.%Y")
+        return day, day + timedelta(days=1)
+
 
-    return response_strs
+async def get_key_holders_str(key_name: str, start: datetime, end: datetime = None):
+    entries_by_key = await keys_accounting_table.get_entries_by_key()
+    entries = await keys_accounting_table.get_all_entries()
+    intervals = key_intervals.get(key_name, entries, entries_by_key)
+    holders = intervals.at(start) if end is None else intervals.between(start, end)
+    return render.chunks(
+        render.key_holders_header(key_name, start, end, len(holders)),
+        [render.key_history_line(entry) for entry in holders],
+        "В это время ключ никто не брал",
+    )
 
 
 @dp.message(Command("my_keys"))
@@ -800,26 +985,12 @@ async def my_history(message: types.Message):
     history_msg_strs = []
 
     not_returned_entries = await keys_accounting_table.get_not_returned_keys()
+    keys_index = await keys_table.get_keys_index()
 
     for entry in not_returned_entries:
-        if entry.emp_firstname != user.first_name or entry.emp_lastname != user.last_name:
+        if entry.emp_id != user.ref_id:
             continue
-        key_data = await keys_table.get_by_name(entry.key_name)
-        if not key_data:
-            history_msg_strs.append(
-                f"*Ключ*: `{entry.key_name}`\n"
-                f"| *Взял в*: `{entry.time_received.strftime('%H:%M (%d.%m.%Y)')}`\n"
-                f"{f"| *Комментарии*: \"{escape_markdown(entry.comment)}\"\n" if entry.comment else ""}"
-            )
-        else:
-            history_msg_strs.append(
-                f"*Ключ*: `{entry.key_name}`\n"
-                f"| *Взял в*: `{entry.time_received.strftime('%H:%M (%d.%m.%Y)')}`\n"
-                f"| *Количество ключей*: `{key_data.count}`\n"
-                f"| *Тип ключа*: `{key_data.key_type}`\n"
-                f"| *Тип аппаратный*: `{key_data.hardware_type}`\n"
-                f"{f"|  *Комментарии*: \"{escape_markdown(entry.comment)}\"\n" if entry.comment else ""}"
-            )
+        history_msg_strs.append(render.my_key(entry, keys_index.get(entry.key_name)))
 
     if not history_msg_strs:
         await message.answer("У вас нет взятых ключей")
@@ -830,6 +1001,72 @@ async def my_history(message: types.Message):
         await message.answer(msg, parse_mode="Markdown", reply_markup=types.ReplyKeyboardRemove())
 
 
+inline_indexes = sites.Current(site_registry, "inline_indexes")
+
+
+def inline_key_names(keys: list[sheets.Key], entries_by_key: dict) -> list[str]:
+    return sorted({key.key_name for key in keys} | set(entries_by_key))
+
+
+def inline_emp_names(employees: list[sheets.Employee]) -> list[str]:
+    return sorted({f"{emp.first_name} {emp.last_name}" for emp in employees})
+
+
+@dp.inline_query()
+async def inline_search(inline_query: InlineQuery):
+    if not await has_role("user", inline_query.from_user.id):
+        await inline_query.answer([], cache_time=60, is_personal=True)
+        return
+
+    keys, keys_index, entries_by_key, open_loans, open_loans_by_emp, employees = await asyncio.gather(
+        keys_table.get_all_keys(),
+        keys_table.get_keys_index(),
+        keys_accounting_table.get_entries_by_key(),
+        keys_accounting_table.get_open_loans(),
+        keys_accounting_table.get_open_loans_by_emp(),
+        emp_table.get_all_employees(),
+    )
+    key_index = inline_indexes.get("keys", (keys, entries_by_key), inline_key_names)
+    emp_index = inline_indexes.get("employees", (employees,), inline_emp_names)
+
+    results = []
+    for i, key_name in enumerate(key_index.search(inline_query.query)):
+        loans = open_loans.get(key_name)
+        key_entries = entries_by_key.get(key_name)
+        key = keys_index.get(key_name)
+        available = key.copies - len(loans or ()) if key is not None and key.copies > 1 else None
+        if loans:
+            description = "Не на месте: " + ", ".join(f"{e.emp_firstname} {e.emp_lastname}" for e in loans)
+            if available:
+                description = f"Свободно {available} из {key.copies}. " + description
+        else:
+            description = "На месте"
+        if key_entries:
+            text = render.key_card(key_entries[-1], key, available)
+        elif key_name in keys_index:
+            text = render.key_card_no_history(key_name, keys_index[key_name])
+        else:
+            text = f"*Ключ*: `{key_name}`\n"
+        results.append(InlineQueryResultArticle(
+            id=f"k{i}",
+            title=f"🔑 {key_name}",
+            description=description,
+            input_message_content=InputTextMessageContent(message_text=text, parse_mode="Markdown"),
+        ))
+    for i, emp_name in enumerate(emp_index.search(inline_query.query, search.MAX_RESULTS - len(results))):
+        taken = [entry.key_name for entry in open_loans_by_emp.get(tuple(emp_name.split(" ", 1)), [])]
+        results.append(InlineQueryResultArticle(
+            id=f"e{i}",
+            title=f"👤 {emp_name}",
+            description=f"На руках: {', '.join(taken)}" if taken else "Нет взятых ключей",
+            input_message_content=InputTextMessageContent(message_text=f"*Имя*: `{emp_name}`\n" + (
+                f"*На руках*: {', '.join(f'`{k}`' for k in taken)}\n" if taken else "*Нет взятых ключей*\n"
+            ), parse_mode="Markdown"),
+        ))
+
+    await inline_query.answer(results, cache_time=5, is_personal=True)
+
+
 # endregion
 
 
@@ -843,6 +1080,10 @@ async def not_returned(message: types.Message):
         await message.answer("Вы не имеете доступа к этой команде.")
         return
 
+    if "security" in user.roles:  # one dashboard message instead of a card per key
+        await security_dashboard.repost(message.chat.id)
+        return
+
     msg = await message.answer("Поиск ключей...")
 
     keys = await keys_accounting_table.get_not_returned_keys()
@@ -854,28 +1095,90 @@ async def not_returned(message: types.Message):
     await msg.delete()
 
     for key in keys:
-        if "security" in user.roles:
-            user_id = (await emp_table.get_by_name(key.emp_firstname, key.emp_lastname)).telegram
-            kb = [[InlineKeyboardButton(text="Вернуть", callback_data=f"return_key:{key.key_name}:{user_id}")]]
-            await message.answer(
-                await state_format(key, False),
-                reply_markup=InlineKeyboardMarkup(inline_keyboard=kb),
-                parse_mode="Markdown")
-        elif "user" in user.roles:
-            await message.answer(await state_format(key, False), parse_mode="Markdown")
+        await message.answer(await state_format(key, False), parse_mode="Markdown")
+
+
+def entry_ref(entry: sheets.Entry) -> str:
+    return str(entry.row or entry.event_id)
+
+
+async def return_key_callback(entry: sheets.Entry, telegram_id: str) -> str:
+    token = await action_registry.issue(
+        site_kind("return_key"),
+        {"entry": entry, "telegram": telegram_id},
+        return_action_delay,
+        ref=entry_ref(entry),
+    )
+    return f"return_key:{token}"
+
+
+async def send_return_cards(message: types.Message, entries: list[sheets.Entry]):
+    """A card with a return button per loan, plus one button returning all of them"""
+    for entry in entries:
+        user_id = (await emp_table.get_by_ref(entry.emp_id)).telegram
+        kb = [[InlineKeyboardButton(text="Вернуть", callback_data=await return_key_callback(entry, user_id))]]
+        await message.answer(
+            await state_format(entry, True),
+            reply_markup=InlineKeyboardMarkup(inline_keyboard=kb),
+            parse_mode="Markdown")
+    if len(entries) > 1:
+        token = await action_registry.issue(
+            site_kind("return_all"), {"entries": entries}, return_action_delay, ref=[entry_ref(entry) for entry in entries]
+        )
+        kb = [[InlineKeyboardButton(text=f"Вернуть все ({len(entries)})", callback_data=f"return_all:{token}")]]
+        await message.answer(
+            f"Ключи к возврату: {', '.join(entry.key_name for entry in entries)}",
+            reply_markup=InlineKeyboardMarkup(inline_keyboard=kb))
 
 
 @dp.callback_query(F.data.startswith("return_key"))
 async def return_key(callback: CallbackQuery):
-    key_name, telegram_id = callback.data.split(":")[1:3]
-    await keys_accounting_table.set_return_time_by_key_name(key_name)
+    action = await action_registry.pop(callback.data.split(":", 1)[1], site_kind("return_key"))
+    if action is None:
+        await callback.answer("Кнопка устарела, используйте /return_key")
+        return
+    entry = action.payload["entry"]
+    await action_registry.discard_ref(site_kind("return_key"), action.ref)
+    await key_journal.returned(entry)
+    security_dashboard.touch()
     await bot.send_message(
-        chat_id=telegram_id,
-        text=f"Охранник подтвердил возврат ключа: {key_name}",
+        chat_id=action.payload["telegram"],
+        text=f"Охранник подтвердил возврат ключа: {entry.key_name}",
     )
     await callback.message.edit_text(f"{callback.message.text}\n\nВремя возврата записано.")
 
 
+@dp.callback_query(F.data.startswith("return_all"))
+async def return_all_keys(callback: CallbackQuery):
+    action = await action_registry.pop(callback.data.split(":", 1)[1], site_kind("return_all"))
+    if action is None:
+        await callback.answer("Кнопка устарела, используйте /return_key")
+        return
+    # keys already returned with their own button are skipped, their return_key actions are gone
+    entries = [
+        entry for entry in action.payload["entries"]
+        if await action_registry.discard_ref(site_kind("return_key"), entry_ref(entry))
+    ]
+    if not entries:
+        await callback.message.edit_text(f"{callback.message.text}\n\nЭти ключи уже возвращены.")
+        return
+    await key_journal.returned_many(entries)  # one journal write, one sheet write for all rows
+    security_dashboard.touch()
+    by_emp = {}
+    for entry in entries:
+        by_emp.setdefault(entry.emp_id, []).append(entry.key_name)
+    for emp_id, key_names in by_emp.items():
+        emp = await emp_table.get_by_ref(emp_id)
+        if emp is None:
+            continue
+        await bot.send_message(
+            chat_id=emp.telegram,
+            text=f"Охранник подтвердил возврат ключей: {', '.join(key_names)}",
+        )
+    await callback.message.edit_text(
+        f"{callback.message.text}\n\nВремя возврата записано: {', '.join(entry.key_name for entry in entries)}")
+
+
 class ReturnKeyState(StatesGroup):
     waiting_for_key = State()
 
@@ -888,7 +1191,9 @@ async def return_key(message: types.Message, state: FSMContext):
 
     emp = await emp_table.get_by_telegram(message.from_user.id)
     await state.update_data(emp=emp)
-    await message.answer("Введите название ключа или номер базовой станции\n\n(/cancel для отмены)")
+    await message.answer(
+        "Введите название ключа или номер базовой станции\n"
+        "Несколько ключей можно перечислить через запятую\n\n(/cancel для отмены)")
     await state.set_state(ReturnKeyState.waiting_for_key)
 
 
@@ -902,6 +1207,23 @@ async def get_key_name(message: types.Message, state: FSMContext):
     key_names = {key.key_name for key in await keys_table.get_all_keys()}
     not_returned_keys = await keys_accounting_table.get_not_returned_keys()
     not_returned_key_names = {key.key_name for key in not_returned_keys}
+    if len(KEYS_SEPARATOR.split(message.text.strip(" ,;\n"))) > 1:
+        await msg.delete()
+        found, unknown = await resolve_key_names(message.text, key_names)
+        if unknown:
+            await message.answer(
+                f"Не удалось однозначно определить ключи: {', '.join(unknown)}\n"
+                "Введите список ещё раз\n\n(/cancel для отмены)")
+            return
+        in_place = [key_name for key_name in found if key_name not in not_returned_key_names]
+        if in_place:
+            await message.answer(f"Сейчас на месте: {', '.join(in_place)}")
+        await send_return_cards(message, sorted(
+            (entry for entry in not_returned_keys if entry.key_name in found),
+            key=lambda entry: found.index(entry.key_name)
+        ))
+        await state.clear()
+        return
     similarities = await sheets.find_similar(message.text, key_names)
 
     if message.text in key_names or len(similarities) == 1:
@@ -917,13 +1239,7 @@ async def get_key_name(message: types.Message, state: FSMContext):
             return
         await state.update_data(key=key_name)
         await msg.delete()
-        key_entry = next(key for key in not_returned_keys if key.key_name == key_name)
-        user_id = (await emp_table.get_by_name(key_entry.emp_firstname, key_entry.emp_lastname)).telegram
-        kb = [[InlineKeyboardButton(text="Вернуть", callback_data=f"return_key:{key_entry.key_name}:{user_id}")]]
-        await message.answer(
-            await state_format(next(key for key in not_returned_keys if key.key_name == key_name), True),
-            reply_markup=InlineKeyboardMarkup(inline_keyboard=kb),
-            parse_mode="Markdown")
+        await send_return_cards(message, [key for key in not_returned_keys if key.key_name == key_name])  # every copy on loan
         await state.clear()
         return
     else:
@@ -956,13 +1272,228 @@ async def drop_cache(message: types.Message):
     await message.answer("Кэш очищен")
 
 
+MIGRATION_PROGRESS_INTERVAL = 3  # seconds between progress edits
+migration_lock = asyncio.Lock()
+
+
+@dp.message(Command("migrate"))
+async def migrate(message: types.Message):
+    if not await has_role("admin", message.from_user.id):
+        await message.answer("Вы не имеете доступа к этой команде.")
+        return
+    args = message.text.split()[1:]
+    if len(args) != 1:
+        await message.answer(
+            "Использование: /migrate <ссылка на новую таблицу>\n"
+            "Ключи, сотрудники и история копируются в новую таблицу, после проверки бот переключается на неё. "
+            "Прерванный перенос продолжается с того же места повторной командой\n"
+            "Ячейки копируются как введены: формулы, числа и даты с их форматом. "
+            "Цвета, границы и ширина столбцов не переносятся")
+        return
+    if bot_config.get("mode") == "webhook" and int(bot_config.get("webhook", {}).get("workers", 1)) > 1:
+        await message.answer("Перенос доступен только при запуске бота в одном процессе (workers: 1)")
+        return
+    if migration_lock.locked():
+        await message.answer("Перенос или импорт уже идёт")
+        return
+    if site_registry.current() is not default_site:  # the other sites' links live in the "sites" config
+        await message.answer("Перенос доступен только для основной таблицы")
+        return
+
+    async with migration_lock:
+        progress = await message.answer("Подготовка листов в новой таблице...")
+        last_edit = 0.0
+
+        async def on_progress(done: int, total: int):
+            nonlocal last_edit
+            if done < total and time.monotonic() - last_edit < MIGRATION_PROGRESS_INTERVAL:
+                return
+            last_edit = time.monotonic()
+            try:
+                await progress.edit_text(f"Перенос данных: проверено частей {done} из {total}...")
+            except Exception:
+                pass  # same text as before, or a Telegram hiccup; progress is best effort
+
+        tables = [default_site.keys_accounting_table, default_site.keys_table, default_site.emp_table]
+        job = migration.Migration(args[0], tables, on_progress=on_progress)
+        try:
+            copied = await job.run(default_site.replicator.lock)
+        except migration.MigrationError as e:
+            await progress.edit_text(f"Перенос не выполнен: {e}")
+            return
+        except Exception as e:
+            logger.err(e, "Error in spreadsheet migration")
+            await progress.edit_text("Перенос прерван, повторите /migrate с той же ссылкой, чтобы продолжить")
+            return
+        default_site.spreadsheet, default_site.url = sheets.spreadsheet, args[0]
+    print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] INFO: Migrated to {args[0]}, {copied} chunks copied")
+    await progress.edit_text("Перенос завершён, бот работает с новой таблицей")
+
+
+EXPORT_FILTER = re.compile(r"(key|emp|period)=(.+?)(?=\s+(?:key|emp|period)=|$)")
+
+
+@dp.message(Command("export"))
+async def export_history(message: types.Message):
+    if not await has_role("admin", message.from_user.id):
+        await message.answer("Вы не имеете доступа к этой команде.")
+        return
+    usage = (
+        "Использование: /export [csv|xlsx] [key=Ключ] [emp=Имя Фамилия] [period=ДД.ММ.ГГГГ - ДД.ММ.ГГГГ]\n"
+        "Например: /export csv emp=Иван Иванов period=01.01.2024 - 31.01.2024"
+    )
+    args = message.text.split(maxsplit=1)[1:]
+    fmt, _, rest = (args[0] if args else "").partition(" ")
+    if fmt not in export.FORMATS:
+        fmt, rest = export.CSV, args[0] if args else ""
+    filters = {}
+    try:
+        for name, value in EXPORT_FILTER.findall(rest):
+            if name == "key":
+                filters["key_name"] = value.strip()
+            elif name == "emp":
+                filters["emp_name"] = value.strip()
+            else:
+                filters["start"], filters["end"] = parse_period(value)
+    except ValueError:
+        await message.answer(usage)
+        return
+    if rest.strip() and not filters:
+        await message.answer(usage)
+        return
+    if fmt == export.XLSX and export.openpyxl is None:
+        await message.answer("Экспорт в XLSX недоступен (не установлен openpyxl), используйте csv")
+        return
+
+    await bot.send_chat_action(message.chat.id, ChatAction.UPLOAD_DOCUMENT)
+    entries = await keys_accounting_table.get_all_entries()
+    headers = list(keys_accounting_table.keys_headers.values())
+    path, count = await asyncio.to_thread(export.export, entries, fmt, headers, **filters)
+    try:
+        if not count:
+            await message.answer("Нет записей для выгрузки")
+            return
+        filename = f"history_{datetime.now().strftime('%Y%m%d_%H%M')}{'.csv.gz' if fmt == export.CSV else '.xlsx'}"
+        await message.answer_document(FSInputFile(path, filename=filename), caption=f"Записей: {count}")
+    finally:
+        os.remove(path)
+
+
+class ImportState(StatesGroup):
+    waiting_for_file = State()
+
+
+@dp.message(Command("import"))
+async def import_table(message: types.Message, state: FSMContext):
+    if not await has_role("admin", message.from_user.id):
+        await message.answer("Вы не имеете доступа к этой команде.")
+        return
+    await message.answer(
+        "Отправьте CSV-файл с ключами или сотрудниками. Первая строка - заголовки столбцов, как в таблице:\n"
+        f"Ключи: {', '.join(keys_table.keys_headers.values())}\n"
+        f"Сотрудники: {', '.join(emp_table.keys_headers.values())}\n"
+        "Уже существующие ключи и сотрудники пропускаются\n\n(/cancel для отмены)")
+    await state.set_state(ImportState.waiting_for_file)
+
+
+@dp.message(ImportState.waiting_for_file)
+async def import_file(message: types.Message, state: FSMContext):
+    if message.text == "/cancel":
+        await state.clear()
+        await message.answer("Отменено.")
+        return
+    if message.document is None:
+        await message.answer("Отправьте CSV-файл документом\n\n(/cancel для отмены)")
+        return
+    if message.document.file_size and message.document.file_size > importer.MAX_FILE_SIZE:
+        await message.answer(f"Файл больше {render.size_str(importer.MAX_FILE_SIZE)}, разделите его на части")
+        return
+    if migration_lock.locked():  # rows written now could miss the copy in the new spreadsheet
+        await message.answer("Идёт перенос таблицы, отправьте файл после его завершения\n\n(/cancel для отмены)")
+        return
+    await state.clear()
+
+    progress = await message.answer("Проверка файла...")
+    data = (await bot.download(message.document)).getvalue()
+    try:
+        rows = await asyncio.to_thread(importer.read_rows, data)
+        if len(rows) < 2:
+            raise ValueError("В файле нет строк кроме заголовка")
+        kind, columns = importer.detect(rows[0], keys_table.keys_headers, emp_table.keys_headers)
+    except ValueError as e:
+        await progress.edit_text(str(e))
+        return
+
+    # deduplicated against the cached indexes, so only new rows cost writes
+    if kind == importer.KEYS:
+        label, add = "ключей", keys_table.add_keys
+        result = importer.parse_keys(rows[1:], columns, await keys_table.get_keys_index())
+    else:
+        label, add = "сотрудников", emp_table.add_employees
+        result = importer.parse_employees(rows[1:], columns, await emp_table.get_all_employees())
+
+    written = 0
+
+    async def on_progress(done: int, total: int):
+        nonlocal written
+        written = done
+        await progress.edit_text(f"Импорт {label}: {done} из {total}...")
+
+    if result.items:
+        await progress.edit_text(f"Импорт {label}: 0 из {len(result.items)}...")
+        if migration_lock.locked():  # started while the file was parsed
+            await progress.edit_text("Идёт перенос таблицы, повторите /import после его завершения")
+            return
+        try:
+            async with migration_lock:  # /migrate refuses to start halfway through the import
+                await add(result.items, on_progress)  # a few chunked writes instead of three requests per row
+        except Exception as e:
+            logger.err(e, "Error in import")
+            await progress.edit_text(
+                f"Импорт {label} прерван, записано {written} из {len(result.items)}. "
+                "Отправьте файл повторно через /import, уже записанные строки будут пропущены")
+            return
+    print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] INFO: Imported {len(result.items)} {kind} from {message.document.file_name}")
+    await progress.edit_text(render.import_report(result, label))
+
+
+usage_stats = sites.Current(site_registry, "usage_stats")
+
+
+@dp.message(Command("stats"))
+async def stats(message: types.Message):
+    if not await has_role("admin", message.from_user.id):
+        await message.answer("Вы не имеете доступа к этой команде.")
+        return
+    args = message.text.split()[1:]
+    if args and (not args[0].isdigit() or int(args[0]) == 0):
+        await message.answer("Использование: /stats [количество дней]")
+        return
+    days = int(args[0]) if args else None
+    entries = await keys_accounting_table.get_all_entries()
+    report = await asyncio.to_thread(usage_stats.get, entries, days)
+    await message.answer(render.stats_report(report), parse_mode="Markdown")
+
+
 @dp.message(Command("send_cache"))
 async def send_cache(message: types.Message):
     if not await has_role("admin", message.from_user.id):
         await message.answer("Вы не имеете доступа к этой команде.")
         return
-    data = make_serializable(sheets.cache)
-    await message.answer(f"Кэш:\n\n{json.dumps(data, indent=4, ensure_ascii=False)}")
+    if message.text.split()[1:] == ["dump"]:
+        await bot.send_chat_action(message.chat.id, ChatAction.UPLOAD_DOCUMENT)
+        path = await asyncio.to_thread(inspector.dump, sheets.space().cache)
+        try:
+            filename = f"cache_{datetime.now().strftime('%Y%m%d_%H%M')}.jsonl.gz"
+            await message.answer_document(FSInputFile(path, filename=filename))
+        finally:
+            os.remove(path)
+        return
+    space = sheets.space()
+    stats = await asyncio.to_thread(
+        inspector.inspect_cache, space.cache, space.cache_added, space.cache_expires, time.monotonic()
+    )
+    await message.answer(render.cache_report(stats), parse_mode="Markdown")
 
 
 # endregion
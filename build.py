@@ -60,10 +60,31 @@ dirs = [
 files = [
     "icon.ico",
     "logger.py",
+    "sheets_api.py",
     "sheets.py",
+    "storage.py",
+    "webhook.py",
+    "actions.py",
+    "render.py",
+    "profiles.py",
+    "search.py",
+    "intervals.py",
+    "analytics.py",
+    "export.py",
+    "importer.py",
+    "migration.py",
+    "inspector.py",
+    "journal.py",
+    "sites.py",
+    "dashboard.py",
+    "throttle.py",
     "bot.py"
 ]
 
+hidden_imports = [
+    "openpyxl",  # optional in export.py, the build ships the XLSX export
+]
+
 command = [
     start_file,
     "--noconfirm",
@@ -81,6 +102,9 @@ if no_console:
 for d in dirs:
     command.append(f"--add-data={d};{d}./")
 
+for module in hidden_imports:
+    command.append(f"--hidden-import={module}")
+
 for filename in files:
     filename = os.path.join(current_directory, filename)
     print("Adding file:", filename)
@@ -0,0 +1,232 @@
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import InlineKeyboardMarkup
+from datetime import datetime
+from typing import Awaitable, Callable
+import threading
+import asyncio
+import sqlite3
+
+
+DEBOUNCE = 2  # seconds, changes within the window are collapsed into one edit per guard
+
+
+class Dashboard:
+    """
+    One pinned message per security employee with the pending key requests and open loans, edited in place.
+
+    Changes only call touch(). The first call of a DEBOUNCE window schedules a refresh that renders the
+    text once and edits only the messages whose last sent text differs. Message ids and texts are kept in
+    SQLite next to the FSM storage, so restarts and other workers keep editing the same messages.
+    Key requests are fanned out to every guard with send_request(), resolve_request() closes the copies
+    the other guards still see. Each site has its own Dashboard, the rows are tagged with the site's name.
+    """
+
+    def __init__(
+            self,
+            bot: Bot,
+            path: str,
+            render_text: Callable[[], Awaitable[str]],
+            get_chats: Callable[[], Awaitable[list[str]]],
+            debounce: float = DEBOUNCE,
+            site: str = "default",
+    ):
+        self.bot = bot
+        self.site = site
+        self.render_text = render_text
+        self.get_chats = get_chats
+        self.debounce = debounce
+        self.dirty = False
+        self.task: asyncio.Task | None = None
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA busy_timeout=5000")
+        self.conn.execute("BEGIN IMMEDIATE")  # workers starting together upgrade the table once
+        columns = {column[1]: column[5] for column in self.conn.execute("PRAGMA table_info(dashboards)")}  # name -> pk
+        rebuild = columns and not columns.get("site")  # keyed by chat only, from before dashboards were per site
+        if rebuild:
+            self.conn.execute("ALTER TABLE dashboards RENAME TO dashboards_old")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS dashboards ("
+            "chat_id TEXT NOT NULL, "
+            "message_id INTEGER NOT NULL, "
+            "text TEXT NOT NULL, "
+            "site TEXT NOT NULL DEFAULT 'default', "
+            "PRIMARY KEY (site, chat_id))"
+        )
+        if rebuild:
+            site_column = "site" if "site" in columns else "'default'"
+            self.conn.execute(
+                "INSERT INTO dashboards (chat_id, message_id, text, site) "
+                f"SELECT chat_id, message_id, text, {site_column} FROM dashboards_old"
+            )
+            self.conn.execute("DROP TABLE dashboards_old")
+        self.conn.execute("COMMIT")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS request_messages ("
+            "token TEXT NOT NULL, "
+            "chat_id TEXT NOT NULL, "
+            "message_id INTEGER NOT NULL, "
+            "text TEXT NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS request_messages_token ON request_messages (token)")
+
+    # region Disk
+
+    def _execute(self, sql: str, params: tuple = ()):
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def _executemany(self, sql: str, params: list[tuple]):
+        with self.lock:
+            self.conn.executemany(sql, params)
+
+    def _pop_requests(self, token: str) -> list[tuple]:
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT chat_id, message_id, text FROM request_messages WHERE token = ?", (token,)
+            ).fetchall()
+            self.conn.execute("DELETE FROM request_messages WHERE token = ?", (token,))
+        return rows
+
+    def _swap(self, chat_id: str, old_message_id: int | None, message_id: int, text: str) -> bool:
+        """
+        Compare-and-swap of the guard's dashboard row: saved only if the row still has old_message_id
+        (or doesn't exist yet), False if another worker's refresh replaced the message first.
+        """
+        with self.lock:
+            if old_message_id is None:
+                cursor = self.conn.execute(
+                    "INSERT OR IGNORE INTO dashboards (chat_id, message_id, text, site) VALUES (?, ?, ?, ?)",
+                    (chat_id, message_id, text, self.site)
+                )
+            else:
+                cursor = self.conn.execute(
+                    "UPDATE dashboards SET message_id = ?, text = ? WHERE site = ? AND chat_id = ? AND message_id = ?",
+                    (message_id, text, self.site, chat_id, old_message_id)
+                )
+            return cursor.rowcount > 0
+
+    # endregion
+
+    # region Dashboards
+
+    def touch(self):
+        """Marks the dashboards outdated, the refresh runs at most once per DEBOUNCE seconds"""
+        self.dirty = True
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._refresh_loop())
+
+    async def _refresh_loop(self):
+        while self.dirty:
+            await asyncio.sleep(self.debounce)
+            self.dirty = False  # changes made during the refresh schedule one more
+            try:
+                await self.refresh()
+            except Exception as e:
+                print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] ERR: Dashboard refresh failed: {e}")
+
+    def stop(self):
+        """Cancels a pending refresh and closes the database, for a site being closed"""
+        if self.task is not None:
+            self.task.cancel()
+        with self.lock:
+            self.conn.close()
+
+    async def refresh(self):
+        chats = set(await self.get_chats())
+        text = await self.render_text()
+        rows = await asyncio.to_thread(
+            self._execute, "SELECT chat_id, message_id, text FROM dashboards WHERE site = ?", (self.site,)
+        )
+        sent = {chat_id: (message_id, sent_text) for chat_id, message_id, sent_text in rows}
+        updates = []
+        for chat_id in chats:
+            message_id, sent_text = sent.get(chat_id, (None, None))
+            if sent_text != text:  # unchanged dashboards cost no request
+                updates.append(self._update(chat_id, text, message_id))
+        await asyncio.gather(*updates)
+        for chat_id in sent.keys() - chats:  # no longer a guard
+            await self._delete(chat_id, sent[chat_id][0])
+            await asyncio.to_thread(
+                self._execute, "DELETE FROM dashboards WHERE site = ? AND chat_id = ?", (self.site, chat_id)
+            )
+
+    async def _update(self, chat_id: str, text: str, message_id: int | None):
+        try:
+            if message_id is not None and await self._edit(chat_id, message_id, text):
+                await asyncio.to_thread(self._swap, chat_id, message_id, message_id, text)
+            else:
+                await self._post(chat_id, text, message_id)
+        except Exception as e:
+            print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] ERR: Dashboard update for {chat_id} failed: {e}")
+
+    async def _edit(self, chat_id: str, message_id: int, text: str) -> bool:
+        """False if the message is gone and a new one has to be posted"""
+        try:
+            await self.bot.edit_message_text(text, chat_id=chat_id, message_id=message_id, parse_mode="Markdown")
+        except TelegramBadRequest as e:
+            return "not modified" in str(e)
+        return True
+
+    async def _post(self, chat_id: str, text: str, old_message_id: int | None = None):
+        message = await self.bot.send_message(chat_id, text, parse_mode="Markdown", disable_notification=True)
+        if not await asyncio.to_thread(self._swap, chat_id, old_message_id, message.message_id, text):
+            # another worker posted the new dashboard meanwhile (and deleted the old one), keep only theirs
+            await self._delete(chat_id, message.message_id)
+            return
+        try:
+            await self.bot.pin_chat_message(chat_id, message.message_id, disable_notification=True)
+        except TelegramBadRequest as e:
+            print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] ERR: Could not pin dashboard in {chat_id}: {e}")
+        if old_message_id is not None:
+            await self._delete(chat_id, old_message_id)
+
+    async def _delete(self, chat_id: str, message_id: int):
+        try:
+            await self.bot.delete_message(chat_id, message_id)
+        except TelegramBadRequest:
+            pass  # already deleted by the user
+
+    async def repost(self, chat_id: str):
+        """Moves the guard's dashboard to the bottom of the chat"""
+        chat_id = str(chat_id)
+        rows = await asyncio.to_thread(
+            self._execute, "SELECT message_id FROM dashboards WHERE site = ? AND chat_id = ?", (self.site, chat_id)
+        )
+        await self._post(chat_id, await self.render_text(), rows[0][0] if rows else None)
+
+    # endregion
+
+    # region Requests
+
+    async def send_request(self, chat_ids: list[str], token: str, text: str, reply_markup: InlineKeyboardMarkup) -> int:
+        """Sends the key request to every guard, returns how many got it"""
+        results = await asyncio.gather(*(
+            self.bot.send_message(chat_id, text, reply_markup=reply_markup) for chat_id in chat_ids
+        ), return_exceptions=True)
+        sent = []
+        for chat_id, result in zip(chat_ids, results):
+            if isinstance(result, Exception):
+                print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] ERR: Key request to {chat_id} failed: {result}")
+            else:
+                sent.append((token, str(chat_id), result.message_id, text))
+        await asyncio.to_thread(
+            self._executemany,
+            "INSERT INTO request_messages (token, chat_id, message_id, text) VALUES (?, ?, ?, ?)",
+            sent
+        )
+        self.touch()
+        return len(sent)
+
+    async def resolve_request(self, token: str, note: str, handled_in: str | int = None):
+        """Appends the note to the copies of the request and removes their buttons, except in the chat that handled it"""
+        rows = await asyncio.to_thread(self._pop_requests, token)
+        await asyncio.gather(*(
+            self.bot.edit_message_text(text + note, chat_id=chat_id, message_id=message_id)
+            for chat_id, message_id, text in rows if chat_id != str(handled_in)
+        ), return_exceptions=True)
+        self.touch()
+
+    # endregion
@@ -0,0 +1,82 @@
+from datetime import datetime
+import tempfile
+import gzip
+import csv
+import os
+import sheets
+
+try:
+    import openpyxl  # optional, only needed for XLSX export
+except ImportError:
+    openpyxl = None
+
+
+CSV = "csv"
+XLSX = "xlsx"
+FORMATS = (CSV, XLSX)
+
+
+def filter_entries(entries, key_name: str = None, emp_name: str = None, start: datetime = None, end: datetime = None):
+    """Entries of the key / employee that overlap [start, end)"""
+    for entry in entries:
+        if key_name is not None and entry.key_name != key_name:
+            continue
+        if emp_name is not None and f"{entry.emp_firstname} {entry.emp_lastname}" != emp_name:
+            continue
+        if end is not None and entry.time_received >= end:
+            continue
+        if start is not None and entry.time_returned is not None and entry.time_returned <= start:
+            continue
+        yield entry
+
+
+def entry_rows(entries):
+    for entry in entries:
+        yield [
+            entry.key_name,
+            entry.emp_firstname,
+            entry.emp_lastname,
+            entry.emp_phone,
+            entry.time_received.strftime(sheets.datetime_format),
+            entry.time_returned.strftime(sheets.datetime_format) if entry.time_returned else "",
+            entry.comment,
+        ]
+
+
+def write_csv(path: str, headers: list[str], rows) -> int:
+    count = 0
+    with gzip.open(path, "wt", encoding="utf-8-sig", newline="") as f:  # BOM so Excel detects UTF-8
+        writer = csv.writer(f)
+        writer.writerow(headers)
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+    return count
+
+
+def write_xlsx(path: str, headers: list[str], rows) -> int:
+    if openpyxl is None:
+        raise RuntimeError("openpyxl is not installed")
+    count = 0
+    workbook = openpyxl.Workbook(write_only=True)  # rows are streamed to disk instead of kept in memory
+    sheet = workbook.create_sheet("История")
+    sheet.append(headers)
+    for row in rows:
+        sheet.append(row)
+        count += 1
+    workbook.save(path)
+    return count
+
+
+def export(entries, fmt: str, headers: list[str], **filters) -> tuple[str, int]:
+    """Writes the filtered history to a temporary file, returns (path, rows written); the caller removes the file"""
+    suffix = ".csv.gz" if fmt == CSV else ".xlsx"
+    fd, path = tempfile.mkstemp(suffix=suffix)
+    os.close(fd)
+    rows = entry_rows(filter_entries(entries, **filters))
+    try:
+        count = write_csv(path, headers, rows) if fmt == CSV else write_xlsx(path, headers, rows)
+    except Exception:
+        os.remove(path)
+        raise
+    return path, count
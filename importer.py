@@ -0,0 +1,120 @@
+from dataclasses import dataclass, field
+import csv
+import io
+import sheets
+import render
+
+
+KEYS = "keys"
+EMPLOYEES = "employees"
+MAX_FILE_SIZE = 5*1024*1024
+ENCODINGS = ("utf-8-sig", "cp1251")  # Excel saves CSV in the ANSI code page unless asked for UTF-8
+
+
+@dataclass
+class ImportResult:
+    kind: str
+    items: list = field(default_factory=list)  # new keys / employees, in file order
+    skipped: int = 0  # already in the table or repeated in the file
+    errors: list[tuple[int, str]] = field(default_factory=list)  # (line, reason)
+
+
+def read_rows(data: bytes) -> list[list[str]]:
+    for encoding in ENCODINGS:
+        try:
+            text = data.decode(encoding)
+            break
+        except UnicodeDecodeError:
+            continue
+    else:
+        raise ValueError("Не удалось определить кодировку файла, сохраните его в UTF-8")
+    try:
+        dialect = csv.Sniffer().sniff(text[:4096], delimiters=",;\t")
+    except csv.Error:
+        dialect = csv.excel
+    return list(csv.reader(io.StringIO(text), dialect))
+
+
+def column_map(header: list[str], table_headers: dict[str, str]) -> dict[str, int]:
+    """Field -> column, columns are recognized by the table's header or by the field name"""
+    names = {}
+    for field_name, title in table_headers.items():
+        names[title.strip().lower()] = field_name
+        names[field_name.lower()] = field_name
+    columns = {}
+    for i, title in enumerate(header):
+        field_name = names.get(title.strip().lower())
+        if field_name is not None:
+            columns.setdefault(field_name, i)
+    return columns
+
+
+def detect(header: list[str], keys_headers: dict[str, str], employees_headers: dict[str, str]) -> tuple[str, dict[str, int]]:
+    keys_columns = column_map(header, keys_headers)
+    if "key_name" in keys_columns:
+        return KEYS, keys_columns
+    employees_columns = column_map(header, employees_headers)
+    if "first_name" in employees_columns and "last_name" in employees_columns:
+        return EMPLOYEES, employees_columns
+    raise ValueError(
+        f"Не удалось определить таблицу по заголовку. Нужен столбец «{keys_headers['key_name']}» для ключей "
+        f"или «{employees_headers['first_name']}» и «{employees_headers['last_name']}» для сотрудников"
+    )
+
+
+def values(row: list[str], columns: dict[str, int]) -> dict[str, str] | None:
+    """None for a blank row"""
+    fields = {name: row[i].strip() if i < len(row) else "" for name, i in columns.items()}
+    return fields if any(fields.values()) else None
+
+
+def parse_keys(rows: list[list[str]], columns: dict[str, int], existing: dict) -> ImportResult:
+    """existing: KeysTable.get_keys_index()"""
+    result = ImportResult(KEYS)
+    seen = set(existing)
+    for line, row in enumerate(rows, start=2):
+        fields = values(row, columns)
+        if fields is None:
+            continue
+        key_name, count = fields["key_name"], fields.get("count") or "1"
+        if not key_name:
+            result.errors.append((line, "нет названия ключа"))
+        elif not count.isdigit() or int(count) == 0:
+            result.errors.append((line, f"количество «{count}» не положительное число"))
+        elif key_name in seen:
+            result.skipped += 1
+        else:
+            seen.add(key_name)
+            result.items.append(sheets.Key(
+                key_name, count, fields.get("key_type") or "None", fields.get("hardware_type") or "None"
+            ))
+    return result
+
+
+def parse_employees(rows: list[list[str]], columns: dict[str, int], existing: list) -> ImportResult:
+    """existing: EmployeesTable.get_all_employees()"""
+    result = ImportResult(EMPLOYEES)
+    names = {(emp.first_name, emp.last_name) for emp in existing}
+    telegrams = {emp.telegram for emp in existing if emp.telegram}
+    for line, row in enumerate(rows, start=2):
+        fields = values(row, columns)
+        if fields is None:
+            continue
+        name = (fields["first_name"], fields["last_name"])
+        telegram = fields.get("telegram", "")
+        phone = fields.get("phone_number", "")
+        if not all(name):
+            result.errors.append((line, "нет имени или фамилии"))
+        elif telegram and not telegram.isdigit():
+            result.errors.append((line, f"Телеграм «{telegram}» должен быть числовым id"))
+        elif phone and not any(char.isdigit() for char in phone):
+            result.errors.append((line, f"телефон «{phone}» без цифр"))
+        elif name in names or (telegram and telegram in telegrams):
+            result.skipped += 1
+        else:
+            names.add(name)
+            if telegram:
+                telegrams.add(telegram)
+            roles = [role.strip() for role in fields.get("roles", "").split(",") if role.strip()]
+            result.items.append(sheets.Employee(*name, render.phone_format(phone) if phone else "", telegram, roles))
+    return result
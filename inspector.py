@@ -0,0 +1,87 @@
+from dataclasses import dataclass
+from datetime import datetime
+import tempfile
+import gzip
+import json
+import sys
+import os
+
+
+SIZE_SAMPLE = 200  # items measured per list, the rest is extrapolated
+DUMP_CHUNK_SIZE = 1000  # items serialized per write
+
+
+@dataclass
+class CacheStats:
+    key: str
+    items: int
+    age: float | None  # seconds since the value was cached
+    expires_in: float | None
+    size: int  # approximate bytes
+
+
+def deep_size(obj, seen: set = None) -> int:
+    """Size of the object with everything it references, objects shared with earlier calls counted once"""
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_size(k, seen) + deep_size(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_size(item, seen) for item in obj)
+    elif hasattr(obj, "__dict__"):
+        size += deep_size(vars(obj), seen)
+    return size
+
+
+def estimate_size(value) -> int:
+    if not isinstance(value, list) or len(value) <= SIZE_SAMPLE:
+        return deep_size(value)
+    step = len(value) / SIZE_SAMPLE
+    seen = set()
+    sample = sum(deep_size(value[int(i * step)], seen) for i in range(SIZE_SAMPLE))
+    return sys.getsizeof(value) + sample * len(value) // SIZE_SAMPLE
+
+
+def inspect_cache(cache: dict, added: dict, expires: dict, now: float) -> list[CacheStats]:
+    """now is time.monotonic(), the clock of added/expires"""
+    result = []
+    for key, value in list(cache.items()):
+        result.append(CacheStats(
+            key=key,
+            items=len(value) if isinstance(value, (list, dict)) else 1,
+            age=now - added[key] if key in added else None,
+            expires_in=expires[key] - now if key in expires else None,
+            size=estimate_size(value),
+        ))
+    return result
+
+
+def to_json(obj):
+    if isinstance(obj, datetime):
+        return obj.isoformat(sep=" ")
+    if hasattr(obj, "__dict__"):
+        return vars(obj)
+    return str(obj)
+
+
+def dump(cache: dict) -> str:
+    """Writes the cache as gzip-compressed JSON lines ({"cache", "value"} per list item) to a temporary file"""
+    fd, path = tempfile.mkstemp(suffix=".jsonl.gz")
+    os.close(fd)
+    try:
+        with gzip.open(path, "wt", encoding="utf-8") as f:
+            for key, value in list(cache.items()):
+                items = value if isinstance(value, list) else [value]
+                for start in range(0, len(items), DUMP_CHUNK_SIZE):
+                    f.write("".join(
+                        json.dumps({"cache": key, "value": item}, ensure_ascii=False, default=to_json) + "\n"
+                        for item in items[start:start + DUMP_CHUNK_SIZE]
+                    ))
+    except Exception:
+        os.remove(path)
+        raise
+    return path
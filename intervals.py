@@ -0,0 +1,65 @@
+from bisect import bisect_left, bisect_right
+from datetime import datetime
+
+
+class KeyIntervals:
+    """
+    Loans of one key sorted by time_received, for point-in-time and range lookups.
+
+    max_ends[i] is the latest return time among returned[0..i], so a backward scan from the
+    bisect position stops as soon as no earlier loan can still overlap the query: the cost is
+    O(log n) plus the loans that actually overlap. Loans not returned yet are kept apart,
+    otherwise one forgotten key would disable that cutoff for the whole history.
+    """
+
+    def __init__(self, entries: list):
+        loans = sorted(entries, key=lambda e: e.time_received)
+        self.returned = [entry for entry in loans if entry.time_returned is not None]
+        self.starts = [entry.time_received for entry in self.returned]
+        self.max_ends = []
+        latest = None
+        for entry in self.returned:
+            latest = entry.time_returned if latest is None or entry.time_returned > latest else latest
+            self.max_ends.append(latest)
+        self.open = [entry for entry in loans if entry.time_returned is None]
+        self.open_starts = [entry.time_received for entry in self.open]
+
+    def _overlapping(self, position: int, start: datetime) -> list:
+        result = []
+        for i in range(position - 1, -1, -1):
+            if self.max_ends[i] <= start:
+                break
+            entry = self.returned[i]
+            if entry.time_returned > start:
+                result.append(entry)
+        result.reverse()
+        return result
+
+    def at(self, moment: datetime) -> list:
+        """Loans held at the moment: received at or before it and not yet returned"""
+        held = self._overlapping(bisect_right(self.starts, moment), moment)
+        held += self.open[:bisect_right(self.open_starts, moment)]
+        return sorted(held, key=lambda e: e.time_received)
+
+    def between(self, start: datetime, end: datetime) -> list:
+        """Loans that overlap [start, end)"""
+        held = self._overlapping(bisect_left(self.starts, end), start)
+        held += self.open[:bisect_left(self.open_starts, end)]
+        return sorted(held, key=lambda e: e.time_received)
+
+
+class IntervalIndex:
+    """KeyIntervals per key name, built lazily and dropped when the entries list is replaced"""
+
+    def __init__(self):
+        self.source = None
+        self.keys: dict[str, KeyIntervals] = {}
+
+    def get(self, key_name: str, entries: list, entries_by_key: dict[str, list]) -> KeyIntervals:
+        if self.source is not entries:
+            self.keys = {}
+            self.source = entries
+        intervals = self.keys.get(key_name)
+        if intervals is None:
+            intervals = self.keys[key_name] = KeyIntervals(entries_by_key.get(key_name, []))
+        return intervals
@@ -0,0 +1,495 @@
+from datetime import datetime
+import asyncio
+import json
+import time
+import os
+import sheets
+
+
+# region Constants
+
+
+ISSUED = "issued"
+RETURNED = "returned"
+DENIED = "denied"
+EXPIRED = "expired"
+EMPLOYEE_ADDED = "employee_added"
+
+REPLICATE_INTERVAL = 2  # seconds between checks for events appended by other processes
+REPLICATE_RETRY = 30
+REPLICATE_BATCH = 500  # events of the same kind written to the sheet in one request
+
+
+# endregion
+
+
+def now():
+    return datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+
+def new_event_id():
+    return f"{time.time_ns():x}-{os.getpid()}"
+
+
+def employee_from_event(event: dict) -> sheets.Employee:
+    return sheets.Employee(event["first_name"], event["last_name"], event["phone_number"], event["telegram"], event["roles"])
+
+
+class Journal:
+    """
+    Append-only journal of key events (JSON lines), the source of truth for check-outs and returns.
+    It doubles as the durable write queue for registrations, so writes survive a Sheets outage.
+
+    Appends are group committed: everything queued while the previous write was in flight goes
+    out in one write + fsync. The accounting worksheet is an eventually consistent projection
+    maintained by Replicator; the high-water mark file stores the journal offset replicated so far
+    and the sheet rows of replicated check-outs. Until an event is replicated it is overlaid on
+    the entries read from the sheet, so handlers see it immediately.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.hwm_path = path + ".hwm"
+        self.queue: list[tuple[dict, asyncio.Future]] = []
+        self.writer: asyncio.Task | None = None
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT | getattr(os, "O_BINARY", 0), 0o644)
+        self.listeners: list[asyncio.Event] = []
+        self.pending_cache = (None, [])
+        self.overlay_cache: dict[str, tuple] = {}  # name -> (source list, state key, result)
+        self.read_marks: dict[str, tuple] = {}  # cache name -> (high-water mark, its file state) its sheet read started from
+        self.own_hwm_key = None  # state of the high-water mark this process wrote last
+        self.read_stamps: dict[str, tuple] = {}  # cache name -> write stamp its sheet read started from
+        self.own_stamps: dict[str, tuple] = {}  # cache name -> write stamp this process left last
+
+    # region Writing
+
+    async def append(self, event: dict) -> dict:
+        return (await self.append_many([event]))[0]
+
+    async def append_many(self, events: list[dict]) -> list[dict]:
+        """Appends the events together, in the same write"""
+        futures = []
+        for event in events:
+            event.setdefault("id", new_event_id())
+            event.setdefault("time", datetime.now().strftime(sheets.datetime_format))
+            futures.append(asyncio.get_running_loop().create_future())
+            self.queue.append((event, futures[-1]))
+        if self.writer is None or self.writer.done():
+            self.writer = asyncio.create_task(self._write_loop())
+        await asyncio.gather(*futures)
+        return events
+
+    def _write(self, data: bytes):
+        os.write(self.fd, data)
+        os.fsync(self.fd)
+
+    async def _write_loop(self):
+        while self.queue:
+            batch, self.queue = self.queue, []
+            data = "".join(json.dumps(event, ensure_ascii=False) + "\n" for event, _ in batch).encode("utf-8")
+            try:
+                await asyncio.to_thread(self._write, data)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for _, future in batch:
+                future.set_result(None)
+            for listener in self.listeners:
+                listener.set()
+
+    async def issued(self, key_name: str, emp: sheets.Employee, comment: str = "") -> dict:
+        return (await self.issued_many([key_name], emp, comment))[0]
+
+    async def issued_many(self, key_names: list[str], emp: sheets.Employee, comment: str = "") -> list[dict]:
+        return await self.append_many([{
+            "type": ISSUED,
+            "key_name": key_name,
+            "emp_firstname": emp.first_name,
+            "emp_lastname": emp.last_name,
+            "emp_phone": emp.phone_number,
+            "comment": comment or "",
+        } for key_name in key_names])
+
+    async def returned(self, entry: sheets.Entry) -> dict:
+        return (await self.returned_many([entry]))[0]
+
+    async def returned_many(self, entries: list[sheets.Entry]) -> list[dict]:
+        hwm, _ = await self.pending()
+        # a replicated check-out is read back without its event id, the high-water mark still has it while it is open
+        issued_ids = {row: issued_id for issued_id, row in hwm["rows"].items()}
+        return await self.append_many([{
+            "type": RETURNED,
+            "key_name": entry.key_name,
+            "row": entry.row,
+            "issued_id": entry.event_id or issued_ids.get(entry.row),
+        } for entry in entries])
+
+    async def employee_added(self, employee: sheets.Employee) -> dict:
+        return await self.append({
+            "type": EMPLOYEE_ADDED,
+            "first_name": employee.first_name,
+            "last_name": employee.last_name,
+            "phone_number": employee.phone_number,
+            "telegram": str(employee.telegram),
+            "roles": employee.roles,
+        })
+
+    async def record(self, event_type: str, key_name: str, **fields) -> dict:
+        return await self.append({"type": event_type, "key_name": key_name, **fields})
+
+    def close(self):
+        os.close(self.fd)
+
+    # endregion
+
+    # region Reading
+
+    def load_hwm(self) -> dict:
+        return self.read_hwm(self.hwm_path)
+
+    def _load_hwm_state(self) -> tuple[dict, tuple | None]:
+        """The high-water mark and the state of the very file read, so they match even if it is replaced meanwhile"""
+        try:
+            with open(self.hwm_path, "r", encoding="utf-8") as f:
+                hwm_stat = os.fstat(f.fileno())
+                return json.load(f), (hwm_stat.st_mtime_ns, hwm_stat.st_size)
+        except FileNotFoundError:
+            return {"offset": 0, "rows": {}}, None
+
+    @staticmethod
+    def read_hwm(hwm_path: str) -> dict:
+        try:
+            with open(hwm_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {"offset": 0, "rows": {}}
+
+    def save_hwm(self, hwm: dict):
+        tmp_path = self.hwm_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(hwm, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.hwm_path)
+        self.own_hwm_key = self._hwm_key()
+
+    def _hwm_key(self):
+        try:
+            hwm_stat = os.stat(self.hwm_path)
+            return hwm_stat.st_mtime_ns, hwm_stat.st_size
+        except FileNotFoundError:
+            return None
+
+    def _state_key(self):
+        return os.fstat(self.fd).st_size, self._hwm_key()
+
+    async def hwm_mark(self, name: str) -> tuple[tuple, bool]:
+        """
+        The high-water mark a sheet read cached under name starts from, taken before its first request,
+        and whether another process moved it since the previous read, so this one has to be a full read
+        """
+        hwm, hwm_key = await asyncio.to_thread(self._load_hwm_state)
+        previous = self.read_marks.get(name)
+        return (hwm, hwm_key), previous is not None and previous[1] != hwm_key and hwm_key != self.own_hwm_key
+
+    def read_from(self, name: str, mark: tuple):
+        """Records the mark of the sheet read now cached under name"""
+        self.read_marks[name] = mark
+
+    async def pending(self) -> tuple[dict, list[tuple[int, dict]]]:
+        """Events after the high-water mark as (end offset, event), plus the high-water mark itself"""
+        return await asyncio.to_thread(self._read_pending)  # stats and reads the files off the event loop
+
+    def _read_pending(self) -> tuple[dict, list[tuple[int, dict]]]:
+        state_key = self._state_key()
+        if self.pending_cache[0] == state_key:
+            return self.pending_cache[1]
+        hwm = self.load_hwm()
+        events = self._read_events(hwm["offset"])
+        self.pending_cache = (state_key, (hwm, events))
+        return hwm, events
+
+    def _read_events(self, start: int, end: int = None) -> list[tuple[int, dict]]:
+        with open(self.path, "rb") as f:
+            f.seek(start)
+            data = f.read() if end is None else f.read(end - start)
+        events = []
+        offset = start
+        for line in data.splitlines(keepends=True):
+            if not line.endswith(b"\n"):  # another process is halfway through a write
+                break
+            offset += len(line)
+            events.append((offset, json.loads(line)))
+        return events
+
+    def _read_overlay(self, mark_hwm: dict | None) -> tuple[dict, list, list]:
+        """
+        Pending events, plus those replicated since the sheet read marked with mark_hwm started:
+        another process may have moved the high-water mark past them before or after the read saw their rows
+        """
+        hwm, events = self._read_pending()
+        if mark_hwm is None or mark_hwm["offset"] >= hwm["offset"]:
+            return hwm, events, []
+        return hwm, events, self._read_events(mark_hwm["offset"], hwm["offset"])
+
+    async def _overlaid(self, name: str, items: list, event_types: tuple, apply, read_name: str | None) -> list:
+        state_key = await asyncio.to_thread(self._state_key)
+        cached = self.overlay_cache.get(name)
+        if cached is not None and cached[0] is items and cached[1] == state_key:
+            return cached[2]
+        mark = self.read_marks.get(read_name)
+        mark_hwm = mark[0] if mark is not None else None
+        hwm, events, replicated = await asyncio.to_thread(self._read_overlay, mark_hwm)
+        events = [(offset, event) for offset, event in events if event["type"] in event_types]
+        replicated = [(offset, event) for offset, event in replicated if event["type"] in event_types]
+        result = apply(list(items), hwm, events, replicated, mark_hwm) if events or replicated else items
+        self.overlay_cache[name] = (items, state_key, result)
+        return result
+
+    async def overlay(self, entries: list[sheets.Entry], read_name: str = None) -> list[sheets.Entry]:
+        """
+        Sheet entries with not yet replicated events applied; the same list if nothing is pending.
+        read_name is the cache the entries were read into (full history, open loans), its mark tells which
+        replicated events the read may lack.
+        """
+        return await self._overlaid(read_name or "entries", entries, (ISSUED, RETURNED), self._apply_key_events, read_name)
+
+    async def overlay_employees(self, employees: list[sheets.Employee], read_name: str = None) -> list[sheets.Employee]:
+        """Sheet employees plus registrations not yet replicated, read_name as in overlay"""
+        return await self._overlaid("employees", employees, (EMPLOYEE_ADDED,), self._apply_employee_events, read_name)
+
+    @staticmethod
+    def _apply_key_events(result: list[sheets.Entry], hwm: dict, events: list, replicated: list, mark_hwm: dict | None) -> list[sheets.Entry]:
+        by_row = {entry.row: i for i, entry in enumerate(result)}
+        by_id = {}
+        rows = hwm["rows"]
+        in_read = {}
+        if replicated:
+            rows = {**mark_hwm["rows"], **hwm["rows"]}  # check-outs returned meanwhile are only in the older mark
+            for i, entry in enumerate(result):
+                match_key = Replicator.match_key(entry.key_name, entry.emp_firstname, entry.emp_lastname, entry.time_received)
+                in_read.setdefault(match_key, []).append(i)
+        for n, (_, event) in enumerate(replicated + events):
+            if event["type"] == ISSUED:
+                i = None
+                if n < len(replicated):  # the read may already have its row
+                    if event["id"] in rows:
+                        i = by_row.get(rows[event["id"]])
+                        if i is not None and result[i].key_name != event["key_name"]:
+                            i = None
+                    else:  # returned since, the row is only known by its contents
+                        reads = in_read.get(Replicator.match_key(
+                            event["key_name"], event["emp_firstname"], event["emp_lastname"],
+                            datetime.strptime(event["time"], sheets.datetime_format)
+                        ))
+                        i = reads.pop(0) if reads else None
+                if i is not None:
+                    by_id[event["id"]] = i
+                    continue
+                entry = sheets.Entry(
+                    event["key_name"],
+                    event["emp_firstname"],
+                    event["emp_lastname"],
+                    event["emp_phone"],
+                    event["time"],
+                    None,
+                    event["comment"],
+                    event_id=event["id"],
+                )
+                by_id[event["id"]] = len(result)
+                if event["id"] in rows:  # replicated after the read
+                    by_row[rows[event["id"]]] = len(result)
+                result.append(entry)
+            elif event["type"] == RETURNED:
+                row = event.get("row") or rows.get(event.get("issued_id") or "")
+                i = by_row.get(row) if row else None
+                if i is None:  # not replicated, or replicated after the read
+                    i = by_id.get(event.get("issued_id"))
+                if i is not None:
+                    result[i] = result[i].with_return_time(event["time"])
+        return result
+
+    @staticmethod
+    def _apply_employee_events(result: list[sheets.Employee], hwm: dict, events: list, replicated: list, mark_hwm: dict | None) -> list[sheets.Employee]:
+        registered = {employee.telegram for employee in result}
+        for _, event in replicated + events:
+            if event["telegram"] not in registered:
+                registered.add(event["telegram"])
+                result.append(employee_from_event(event))
+        return result
+
+    # endregion
+
+    # region Writes by other processes
+
+    def stamp(self, name: str):
+        """
+        Tells the other processes sharing the journal that this one wrote the sheet cached under name,
+        for writes that bypass the journal such as an import
+        """
+        stamp_path = f"{self.path}.{name}"
+        tmp_path = stamp_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(new_event_id())
+            f.flush()
+            stamp_stat = os.fstat(f.fileno())  # a rename keeps the inode and mtime
+        os.replace(tmp_path, stamp_path)
+        self.own_stamps[name] = stamp_stat.st_ino, stamp_stat.st_mtime_ns
+
+    def _stamp_key(self, name: str):
+        try:
+            stamp_stat = os.stat(f"{self.path}.{name}")
+            return stamp_stat.st_ino, stamp_stat.st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    async def stamp_mark(self, name: str):
+        """The write stamp a sheet read cached under name starts from, taken before its first request"""
+        return await asyncio.to_thread(self._stamp_key, name)
+
+    def stamp_read(self, name: str, mark):
+        self.read_stamps[name] = mark
+
+    async def written_elsewhere(self, name: str) -> bool:
+        """Whether another process wrote the sheet after the read cached under name started"""
+        stamp_key = await asyncio.to_thread(self._stamp_key, name)
+        return stamp_key != self.read_stamps.get(name, stamp_key) and stamp_key != self.own_stamps.get(name)
+
+    # endregion
+
+
+class Replicator:
+    """
+    Streams journal events into the worksheets in order, resuming from the high-water mark.
+    While Sheets is offline the events queue up in the journal; the queue is drained as soon
+    as the circuit breaker closes again.
+    """
+
+    def __init__(self, journal: Journal, table: sheets.KeysAccountingTable, emp_table: sheets.EmployeesTable = None):
+        self.journal = journal
+        self.table = table
+        self.emp_table = emp_table
+        self.wakeup = asyncio.Event()
+        self.task: asyncio.Task | None = None
+        self.lock = asyncio.Lock()  # held around every pass, "async with replicator.lock" pauses sheet writes
+        self.started = False
+        self.employees_started = False
+
+    def start(self):
+        self.journal.listeners.append(self.wakeup)
+        self.table.space.breaker.listeners.append(self.wakeup)
+        self.task = asyncio.create_task(self.run())
+
+    def stop(self):
+        for listeners in (self.journal.listeners, self.table.space.breaker.listeners):
+            if self.wakeup in listeners:
+                listeners.remove(self.wakeup)
+        if self.task is not None:
+            self.task.cancel()
+
+    async def run(self):
+        delay = REPLICATE_INTERVAL
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            try:
+                async with self.lock:
+                    await self.replicate()
+                delay = REPLICATE_INTERVAL
+            except Exception as e:
+                print(f"[{now()}] ERR: Journal replication failed, retrying in {REPLICATE_RETRY}s: {e}")
+                delay = REPLICATE_RETRY
+
+    async def replicate(self):
+        hwm, events = await self.journal.pending()
+        if not events:
+            return
+        hwm = {"offset": hwm["offset"], "rows": dict(hwm["rows"])}
+        # replay must not duplicate check-outs that reached the sheet before the high-water mark moved;
+        # such a row is still open (its return comes later in the journal) and not owned by another event
+        owned = set(hwm["rows"].values())
+        replicated = {}
+        for entry in await self.table.get_sheet_entries(force=not self.started):
+            if entry.time_returned is None and entry.row not in owned:
+                match_key = self.match_key(entry.key_name, entry.emp_firstname, entry.emp_lastname, entry.time_received)
+                replicated.setdefault(match_key, []).append(entry.row)
+        self.started = True
+        registered = None
+        for offset, run in self.runs(events):
+            event = run[0]
+            if event["type"] == ISSUED:
+                await self.replicate_issued(run, replicated, hwm)
+            elif event["type"] == RETURNED:
+                await self.replicate_returned(run, hwm)
+            elif event["type"] == EMPLOYEE_ADDED and self.emp_table is not None:
+                if registered is None:
+                    employees = await self.emp_table.get_sheet_employees(force=not self.employees_started)
+                    registered = {employee.telegram for employee in employees}
+                    self.employees_started = True
+                if event["telegram"] not in registered:
+                    await self.emp_table.add_employee(employee_from_event(event))
+                    registered.add(event["telegram"])
+            hwm["offset"] = offset
+            await asyncio.to_thread(self.journal.save_hwm, hwm)  # fsync
+        print(f"[{now()}] INFO: Replicated {len(events)} journal event(s)")
+
+    @staticmethod
+    def runs(events: list[tuple[int, dict]]):
+        """(end offset, events) for runs of consecutive check-outs or returns, other events one by one"""
+        run = []
+        for i, (offset, event) in enumerate(events):
+            run.append(event)
+            next_type = events[i + 1][1]["type"] if i + 1 < len(events) else None
+            if event["type"] not in (ISSUED, RETURNED) or next_type != event["type"] or len(run) >= REPLICATE_BATCH:
+                yield offset, run
+                run = []
+
+    async def replicate_issued(self, run: list[dict], replicated: dict, hwm: dict):
+        """Appends the check-outs missing from the sheet in one write"""
+        new = []
+        for event in run:
+            match_key = self.match_key(
+                event["key_name"], event["emp_firstname"], event["emp_lastname"],
+                datetime.strptime(event["time"], sheets.datetime_format)
+            )
+            rows = replicated.get(match_key)
+            if rows:
+                hwm["rows"][event["id"]] = rows.pop(0)  # each sheet row stands for one check-out
+            else:
+                new.append(event)
+        if not new:
+            return
+        rows = await self.table.append_entries([sheets.Entry(
+            event["key_name"],
+            event["emp_firstname"],
+            event["emp_lastname"],
+            event["emp_phone"],
+            event["time"],
+            None,
+            event["comment"],
+        ) for event in new])
+        for event, row in zip(new, rows):
+            hwm["rows"][event["id"]] = row
+
+    async def replicate_returned(self, run: list[dict], hwm: dict):
+        """Writes the return times of the run in one request"""
+        issued_ids = {row: issued_id for issued_id, row in hwm["rows"].items()}
+        return_times = []
+        for event in run:
+            row = event.get("row") or hwm["rows"].get(event.get("issued_id") or "")
+            # a returned check-out needs no row any more, the high-water mark only keeps open ones
+            hwm["rows"].pop(issued_ids.get(row), None)
+            if row:
+                return_times.append((row, event["time"]))
+            else:
+                print(f"[{now()}] ERR: No sheet row for returned key {event['key_name']} ({event['id']})")
+        if return_times:
+            await self.table.set_return_times(return_times)
+
+    @staticmethod
+    def match_key(key_name: str, first_name: str, last_name: str, time_received: datetime) -> tuple:
+        return key_name, first_name, last_name, time_received
@@ -0,0 +1,777 @@
+"""
+Load test: runs the bot's dispatcher against a local fake Telegram Bot API and in-memory
+worksheets with configurable latency, simulating employees and guards.
+
+    python loadtest.py --users 50 --guards 5 --rounds 3 --sheets-latency 0.2
+
+Each employee takes its own key (/get_key), waits for the approver's confirmation, looks the key
+up (/find_key, /not_returned) and hands it to a guard who returns it (/return_key). With --bundle N
+every request covers N keys, returned with one "return all" tap. Per-user throttling is off
+unless --throttle is given. Latency is measured per handler
+step from feeding the update until the handler finished.
+
+Sheets values requests go through the bot's async client to a local Sheets v4 stand-in over
+the fake worksheets, --gspread sends them through gspread in worker threads instead.
+
+With --webhook-workers N the updates are POSTed to the bot's webhook server (webhook.run_webhook)
+instead, which hands them to N worker processes by chat id (N = 1 handles them in this process).
+A handler step's latency is then the POST, the end to end approval still covers the whole round
+trip. Every employee finally sends a burst of lookups without waiting for the answers, the key
+cards must come back in the order the lookups were sent, otherwise the run fails.
+"""
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+from prettytable import PrettyTable
+from aiohttp import web
+from urllib.parse import unquote
+import argparse
+import tempfile
+import asyncio
+import aiohttp
+import random
+import shutil
+import socket
+import gspread
+import json
+import time
+import rsa
+import sys
+import re
+import os
+
+
+# region Constants
+
+
+TOKEN = "123456:LOADTEST"
+BOT_ID = 123456
+WAIT_TIMEOUT = 60
+APPROVER_ID = 9_000_000
+GUARD_ID_BASE = 9_000_100
+USER_ID_BASE = 1_000_000
+ORDER_CHECKS = 5  # lookups per employee in the final burst
+ORDER_LABEL = "chat order (end to end)"
+KEY_CARD = re.compile(r"\*Ключ\*: `([^`]+)`")
+WEBHOOK_SECRET = "loadtest"
+DRAIN_COMMAND = "/loadtest_drain"  # no handler, answered with "unknown command"
+WORKER_ENV = "KEYS_LOADTEST_WORKER"  # settings of the spawned webhook workers, see setup_worker
+
+
+# endregion
+
+
+# region Fake Sheets
+
+
+def parse_cell(label: str) -> tuple[int, int | None]:
+    """(column, row) of an A1 cell label, row is None for a whole column label like C"""
+    letters = "".join(ch for ch in label if ch.isalpha())
+    col = 0
+    for ch in letters:
+        col = col * 26 + ord(ch) - 64
+    digits = label[len(letters):]
+    return col, int(digits) if digits else None
+
+
+def split_range(range_name: str) -> tuple[str, str]:
+    """(worksheet title, cells) of an A1 range like 'Sheet 1'!A2:C, cells are empty for the whole sheet"""
+    title, _, cells = range_name.rpartition("!") if "!" in range_name else (range_name, "", "")
+    if title.startswith("'"):
+        title = title[1:-1].replace("''", "'")
+    return title, cells
+
+
+def strip_trailing(values: list) -> list:
+    """Drops trailing empty cells / rows, as the Sheets API does"""
+    end = len(values)
+    while end and not values[end - 1]:
+        end -= 1
+    return values[:end]
+
+
+class FakeWorksheet:
+    def __init__(self, title: str, latency: float, spreadsheet_id: str = "", sheet_id: int = 0):
+        self.title = title
+        self.latency = latency
+        self.spreadsheet_id = spreadsheet_id
+        self.id = sheet_id
+        self.rows: list[list[str]] = []
+        self.calls = 0
+
+    def _call(self):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency * random.uniform(0.5, 1.5))  # runs in a worker thread like real gspread I/O
+
+    @property
+    def row_count(self):
+        return max(1000, len(self.rows) + 1)
+
+    def get_all_values(self):
+        self._call()
+        return [list(row) for row in self.rows]
+
+    def row_values(self, row: int):
+        self._call()
+        return list(self.rows[row - 1]) if row <= len(self.rows) else []
+
+    def col_values(self, col: int):
+        self._call()
+        return [row[col - 1] for row in self.rows if len(row) >= col and row[col - 1]]
+
+    def update(self, range_name: str, values: list[list]):
+        self._call()
+        self._write(range_name, values)
+
+    def batch_update(self, data: list[dict]):
+        self._call()
+        for item in data:
+            self._write(item["range"], item["values"])
+
+    def _write(self, range_name: str, values: list[list]):
+        col, row = parse_cell(range_name.split(":")[0])
+        self.write_at(col or 1, row or 1, values)
+
+    def write_at(self, col: int, row: int, values: list[list]):
+        for i, row_values in enumerate(values):
+            while len(self.rows) < row + i:
+                self.rows.append([])
+            target = self.rows[row + i - 1]
+            while len(target) < col - 1 + len(row_values):
+                target.append("")
+            target[col - 1:col - 1 + len(row_values)] = ["" if v is None else str(v) for v in row_values]
+
+    def batch_get(self, ranges: list[str], major_dimension: str = None) -> list[list[list[str]]]:
+        self._call()
+        return [self.read(range_name, major_dimension) for range_name in ranges]
+
+    def read(self, cells: str, major_dimension: str = None) -> list[list[str]]:
+        """Values of cells like A2:C, 1:1 or A5:G5 (empty for the whole sheet), as the Sheets API returns them"""
+        start, _, end = cells.partition(":")
+        (start_col, start_row), (end_col, end_row) = parse_cell(start), parse_cell(end or start)
+        start_col, start_row = start_col or 1, start_row or 1
+        end_col = end_col or max((len(row) for row in self.rows), default=0)
+        end_row = end_row or len(self.rows)
+        rows = [
+            row[start_col - 1:end_col] + [""] * (end_col - start_col + 1 - len(row[start_col - 1:end_col]))
+            for row in self.rows[start_row - 1:end_row]
+        ]
+        if major_dimension == "COLUMNS":
+            rows = [list(column) for column in zip(*rows)]
+        return strip_trailing([strip_trailing(values) for values in rows])
+
+    def append(self, cells: str, values: list[list]) -> int:
+        """Writes the values after the last filled row, returns the first written row"""
+        row = len(strip_trailing([strip_trailing(values) for values in self.rows])) + 1
+        self.write_at(parse_cell(cells.partition(":")[0])[0] or 1, row, values)
+        return row
+
+    def clear_cells(self, cells: str):
+        start, _, end = cells.partition(":")
+        (start_col, start_row), (end_col, end_row) = parse_cell(start), parse_cell(end or start)
+        for row in self.rows[(start_row or 1) - 1:end_row or len(self.rows)]:
+            for col in range((start_col or 1) - 1, min(end_col or len(row), len(row))):
+                row[col] = ""
+
+    def add_rows(self, rows: int):
+        self._call()
+
+    def columns_auto_resize(self, start: int, end: int):
+        self._call()
+
+    def clear(self):
+        self._call()
+        self.rows = []
+
+
+class FakeSpreadsheet:
+    title = "Load test"
+    id = "loadtest"
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.worksheets: dict[str, FakeWorksheet] = {}
+        self.calls = 0  # requests to the Sheets v4 stand-in
+
+    def worksheet(self, title: str) -> FakeWorksheet:
+        if title not in self.worksheets:
+            self.worksheets[title] = FakeWorksheet(title, self.latency, self.id, len(self.worksheets))
+        return self.worksheets[title]
+
+    def add_worksheet(self, title: str, rows: int, cols: int, index: int = None) -> FakeWorksheet:
+        return self.worksheet(title)
+
+    def fetch_sheet_metadata(self):
+        time.sleep(self.latency)
+        return {}
+
+
+class FakeClient:
+    def __init__(self, spreadsheet: FakeSpreadsheet):
+        self.spreadsheet = spreadsheet
+
+    def open_by_url(self, url: str) -> FakeSpreadsheet:
+        return self.spreadsheet
+
+    def set_timeout(self, timeout):
+        pass
+
+
+class FakeSheetsApi:
+    """
+    Sheets v4 over the fake worksheets for the bot's async client (sheets_api.SheetsClient):
+    values get / batchGet / update / batchUpdate / append / clear, spreadsheet batchUpdate
+    and the service account token endpoint. Requests wait the Sheets latency without blocking the loop.
+    """
+
+    def __init__(self, spreadsheet: FakeSpreadsheet):
+        self.spreadsheet = spreadsheet
+        self.runner: web.AppRunner | None = None
+        self.url = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post("/token", self.token)
+        app.router.add_route("*", "/v4/spreadsheets/{path:.*}", self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}"
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    async def token(self, request: web.Request):
+        return web.json_response({"access_token": "loadtest", "expires_in": 3600, "token_type": "Bearer"})
+
+    async def handle(self, request: web.Request):
+        body = await request.json() if request.can_read_body else {}
+        self.spreadsheet.calls += 1
+        if self.spreadsheet.latency:
+            await asyncio.sleep(self.spreadsheet.latency * random.uniform(0.5, 1.5))
+        # ranges are percent-encoded, so a colon left in the raw path separates the custom method
+        path = request.raw_path.split("?")[0][len("/v4/spreadsheets/"):]
+        spreadsheet_id, _, values_path = path.partition("/")
+        if spreadsheet_id != f"{self.spreadsheet.id}:batchUpdate" and spreadsheet_id != self.spreadsheet.id:
+            return web.json_response({"error": {"code": 404, "message": "Requested entity was not found."}}, status=404)
+        if not values_path:
+            return web.json_response({"replies": [self.spreadsheet_request(r) for r in body.get("requests", [])]})
+        if values_path == "values:batchGet":
+            major_dimension = request.query.get("majorDimension", "ROWS")
+            return web.json_response({"valueRanges": [
+                self.read(range_name, major_dimension) for range_name in request.query.getall("ranges", [])
+            ]})
+        if values_path == "values:batchUpdate":
+            for data in body["data"]:
+                self.write(data["range"], data["values"])
+            return web.json_response({"totalUpdatedRows": sum(len(data["values"]) for data in body["data"])})
+        range_name, _, method = values_path[len("values/"):].partition(":")
+        range_name = unquote(range_name)
+        if method == "append":
+            title, cells = split_range(range_name)
+            row = self.spreadsheet.worksheet(title).append(cells, body["values"])
+            return web.json_response({"updates": {"updatedRange": f"{title}!A{row}", "updatedRows": len(body["values"])}})
+        if method == "clear":
+            title, cells = split_range(range_name)
+            self.spreadsheet.worksheet(title).clear_cells(cells)
+            return web.json_response({"clearedRange": range_name})
+        if request.method == "PUT":
+            self.write(range_name, body["values"])
+            return web.json_response({"updatedRange": range_name, "updatedRows": len(body["values"])})
+        return web.json_response(self.read(range_name, request.query.get("majorDimension", "ROWS")))
+
+    def read(self, range_name: str, major_dimension: str) -> dict:
+        title, cells = split_range(range_name)
+        values = self.spreadsheet.worksheet(title).read(cells, major_dimension)
+        value_range = {"range": range_name, "majorDimension": major_dimension}
+        if values:  # like Sheets, empty ranges come without values
+            value_range["values"] = values
+        return value_range
+
+    def write(self, range_name: str, values: list[list]):
+        title, cells = split_range(range_name)
+        col, row = parse_cell(cells.partition(":")[0])
+        self.spreadsheet.worksheet(title).write_at(col or 1, row or 1, values)
+
+    def spreadsheet_request(self, request: dict) -> dict:
+        if "addSheet" in request:
+            properties = request["addSheet"]["properties"]
+            wks = self.spreadsheet.worksheet(properties["title"])
+            return {"addSheet": {"properties": {**properties, "sheetId": wks.id}}}
+        return {}  # formatting, e.g. autoResizeDimensions
+
+
+# endregion
+
+
+# region Fake Telegram
+
+
+class FakeTelegram:
+    """Minimal Bot API: records outgoing messages per chat so virtual users can wait for replies"""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.message_id = 0
+        self.messages: dict[int, list[dict]] = defaultdict(list)
+        self.conditions: dict[int, asyncio.Condition] = defaultdict(asyncio.Condition)
+        self.calls = Counter()
+        self.runner: web.AppRunner | None = None
+        self.url = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}"
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    async def handle(self, request: web.Request):
+        method = request.match_info["method"].lower()
+        data = dict(await request.post())
+        self.calls[method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if method == "getme":
+            result = {"id": BOT_ID, "is_bot": True, "first_name": "Keys", "username": "keys_loadtest_bot"}
+        elif method in ("sendmessage", "editmessagetext", "senddocument"):
+            result = await self.record(method, data)
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def record(self, method: str, data: dict) -> dict:
+        chat_id = int(data["chat_id"])
+        if method == "editmessagetext":
+            message_id = int(data["message_id"])
+        else:
+            self.message_id += 1
+            message_id = self.message_id
+        message = {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": BOT_ID, "is_bot": True, "first_name": "Keys"},
+            "text": data.get("text") or data.get("caption") or "",
+        }
+        markup = json.loads(data["reply_markup"]) if data.get("reply_markup") else None
+        if markup and "inline_keyboard" in markup:
+            message["reply_markup"] = markup
+        condition = self.conditions[chat_id]
+        async with condition:
+            self.messages[chat_id].append(message)
+            condition.notify_all()
+        return message
+
+    def find(self, chat_id: int, predicate, since: int) -> dict | None:
+        return next((m for m in self.messages[chat_id][since:] if predicate(m)), None)
+
+    async def wait_for(self, chat_id: int, predicate, since: int = 0, timeout: float = WAIT_TIMEOUT) -> dict:
+        condition = self.conditions[chat_id]
+        async with condition:
+            await asyncio.wait_for(condition.wait_for(lambda: self.find(chat_id, predicate, since)), timeout)
+        return self.find(chat_id, predicate, since)
+
+
+def button_data(message: dict, prefix: str) -> str | None:
+    for row in message.get("reply_markup", {}).get("inline_keyboard", []):
+        for button in row:
+            if button.get("callback_data", "").startswith(prefix):
+                return button["callback_data"]
+    return None
+
+
+# endregion
+
+
+# region Load test
+
+
+class VirtualUser:
+    def __init__(self, user_id: int, first_name: str, last_name: str):
+        self.id = user_id
+        self.first_name = first_name
+        self.last_name = last_name
+
+    def as_dict(self) -> dict:
+        return {"id": self.id, "is_bot": False, "first_name": self.first_name, "last_name": self.last_name}
+
+
+class LoadTest:
+    def __init__(self, bot_module, api: FakeTelegram, webhook_url: str = None):
+        self.bot_module = bot_module
+        self.api = api
+        self.webhook_url = webhook_url  # None: updates are fed to the dispatcher directly
+        self.session: aiohttp.ClientSession | None = None
+        self.update_id = 0
+        self.latencies: dict[str, list[float]] = defaultdict(list)
+        self.errors = Counter()
+
+    def next_id(self) -> int:
+        self.update_id += 1
+        return self.update_id
+
+    def message(self, user: VirtualUser, text: str) -> dict:
+        update_id = self.next_id()
+        return {"update_id": update_id, "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user.id, "type": "private"},
+            "from": user.as_dict(),
+            "text": text,
+        }}
+
+    def callback(self, user: VirtualUser, message: dict, data: str) -> dict:
+        update_id = self.next_id()
+        return {"update_id": update_id, "callback_query": {
+            "id": str(update_id),
+            "from": user.as_dict(),
+            "chat_instance": str(user.id),
+            "message": message,
+            "data": data,
+        }}
+
+    async def send(self, label: str, update: dict):
+        start = time.perf_counter()
+        try:
+            if self.webhook_url is None:
+                await self.bot_module.dp.feed_raw_update(self.bot_module.bot, update)
+            else:
+                await self.post(update)
+        except Exception as e:
+            self.errors[label] += 1
+            print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] ERR: {label}: {e}")
+        self.latencies[label].append(time.perf_counter() - start)
+
+    async def post(self, update: dict):
+        if self.session is None:
+            self.session = aiohttp.ClientSession()
+        async with self.session.post(
+                self.webhook_url, json=update, headers={"X-Telegram-Bot-Api-Secret-Token": WEBHOOK_SECRET}
+        ) as response:
+            if response.status != 200:
+                raise RuntimeError(f"webhook answered {response.status}")
+
+    async def drain(self, user: VirtualUser):
+        """Waits until the webhook workers have handled everything the user sent: their chat is handled in order,
+        so the answer to an unknown command comes after the answers to the updates before it"""
+        if self.webhook_url is None:  # fed updates are handled by the time send returns
+            return
+        since = len(self.api.messages[user.id])
+        await self.post(self.message(user, DRAIN_COMMAND))
+        await self.api.wait_for(user.id, lambda m: m["text"] == "Неизвестная команда", since)
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+    def key_cards(self, user: VirtualUser, since: int) -> list[str]:
+        """Keys of the key cards the user got since the message index"""
+        cards = (KEY_CARD.match(message["text"]) for message in self.api.messages[user.id][since:])
+        return [card.group(1) for card in cards if card]
+
+    async def check_order(self, user: VirtualUser, key_names: list[str]):
+        """Lookups sent back to back, without waiting for the answers, must be answered in the same order"""
+        await self.drain(user)
+        since = len(self.api.messages[user.id])
+        start = time.perf_counter()
+        for key_name in key_names:
+            await self.send("/find_key", self.message(user, "/find_key"))
+            await self.send("find_key: key name", self.message(user, key_name))
+        condition = self.api.conditions[user.id]
+        try:
+            async with condition:
+                await asyncio.wait_for(
+                    condition.wait_for(lambda: len(self.key_cards(user, since)) >= len(key_names)), WAIT_TIMEOUT
+                )
+        except asyncio.TimeoutError:
+            self.errors[ORDER_LABEL] += 1
+            print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] ERR: {user.id}: got {self.key_cards(user, since)} for {key_names}")
+            return
+        cards = self.key_cards(user, since)
+        if cards != key_names:
+            self.errors[ORDER_LABEL] += 1
+            print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] ERR: {user.id}: answers out of order, {cards} for {key_names}")
+        self.latencies[ORDER_LABEL].append(time.perf_counter() - start)
+
+    async def employee(self, user: VirtualUser, key_names: list[str], rounds: int, returns: asyncio.Queue, order_keys: list[str]):
+        for _ in range(rounds):
+            since = len(self.api.messages[user.id])
+            start = time.perf_counter()
+            await self.send("/get_key", self.message(user, "/get_key"))
+            await self.send("get_key: key name", self.message(user, ", ".join(key_names)))
+            await self.send("get_key: comment", self.message(user, "/empty"))
+            try:
+                await self.api.wait_for(user.id, lambda m: m["text"].startswith("✔"), since)
+            except asyncio.TimeoutError:
+                self.errors["approval (end to end)"] += 1
+                continue
+            self.latencies["approval (end to end)"].append(time.perf_counter() - start)
+
+            await self.send("/find_key", self.message(user, "/find_key"))
+            await self.send("find_key: key name", self.message(user, key_names[0]))
+            await self.send("/not_returned", self.message(user, "/not_returned"))
+
+            returned = asyncio.Event()
+            await returns.put((key_names, returned))
+            await returned.wait()
+        await self.check_order(user, order_keys)
+
+    async def approver(self, user: VirtualUser):
+        since = 0
+        while True:
+            message = await self.api.wait_for(user.id, lambda m: button_data(m, "approve_key:"), since, timeout=None)
+            since = self.api.messages[user.id].index(message) + 1
+            asyncio.create_task(self.send("approve_key", self.callback(user, message, button_data(message, "approve_key:"))))
+
+    async def guard(self, user: VirtualUser, returns: asyncio.Queue):
+        while True:
+            key_names, returned = await returns.get()
+            since = len(self.api.messages[user.id])
+            await self.send("/return_key", self.message(user, "/return_key"))
+            await self.send("return_key: key name", self.message(user, ", ".join(key_names)))
+            prefix = "return_key:" if len(key_names) == 1 else "return_all:"
+            try:
+                message = await self.api.wait_for(user.id, lambda m: button_data(m, prefix), since)
+                await self.send("return_key: button", self.callback(user, message, button_data(message, prefix)))
+                await self.drain(user)
+            except asyncio.TimeoutError:
+                self.errors["return_key: button"] += 1
+            returned.set()
+
+    def report(self, elapsed: float, sheets_calls: int):
+        table = PrettyTable()
+        table.field_names = ["Handler", "Count", "Errors", "p50, ms", "p95, ms", "p99, ms", "Max, ms"]
+        for label in sorted(self.latencies.keys() | self.errors.keys()):
+            values = sorted(self.latencies[label])
+            table.add_row([
+                label, len(values), self.errors[label],
+                *(f"{percentile(values, q) * 1000:.1f}" if values else "-" for q in (0.5, 0.95, 0.99)),
+                f"{values[-1] * 1000:.1f}" if values else "-",
+            ])
+        print(table)
+        updates = sum(len(values) for label, values in self.latencies.items() if not label.endswith("(end to end)"))
+        print(f"Updates: {updates} in {elapsed:.1f}s, {updates / elapsed:.1f} updates/s")
+        print(f"Bot API calls: {sum(self.api.calls.values())}, Sheets calls: {sheets_calls}")
+
+
+def percentile(values: list[float], q: float) -> float:
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def fill_sheets(bot_module, users: list[VirtualUser], guards: list[VirtualUser], approver: VirtualUser, keys: int, history: int):
+    def worksheet(table):
+        wks = table.wks
+        wks.rows = [list(table.keys_headers.values())]
+        return wks
+
+    emps = worksheet(bot_module.emp_table)
+    emps.rows.append([approver.first_name, approver.last_name, "79000000000", str(approver.id), "user, security"])
+    for user in guards:
+        emps.rows.append([user.first_name, user.last_name, "79000000001", str(user.id), "user, security"])
+    for user in users:
+        emps.rows.append([user.first_name, user.last_name, f"79{user.id:09d}", str(user.id), "user"])
+
+    keys_wks = worksheet(bot_module.keys_table)
+    for i in range(keys):
+        keys_wks.rows.append([key_name(i), "1", "Механический", "Нет"])
+
+    accounting = worksheet(bot_module.keys_accounting_table)
+    received = datetime.now() - timedelta(days=365)
+    for i in range(history):
+        user = random.choice(users)
+        received += timedelta(minutes=random.randint(1, 30))
+        returned = received + timedelta(minutes=random.randint(5, 600))
+        accounting.rows.append([
+            key_name(random.randrange(keys)), user.first_name, user.last_name, f"79{user.id:09d}",
+            received.strftime("%d.%m.%Y %H:%M:%S"), returned.strftime("%d.%m.%Y %H:%M:%S"), "",
+        ])
+
+
+def key_name(i: int) -> str:
+    return f"LT-{i:05d}"
+
+
+def write_credentials(path: str, api_url: str, sheets_url: str, async_client: bool = True):
+    os.makedirs(os.path.join(path, "credentials"))
+    _, private_key = rsa.newkeys(1024)  # signs the token request, the stand-in accepts any
+    credentials = {
+        "telegram_bot.json": {"telegram_apikey": TOKEN, "api_server": api_url},
+        "spreadsheet_tables.json": {
+            "spreadsheet_url": "loadtest",
+            "keys_accounting_wks": "accounting",
+            "keys_wks": "keys",
+            "employees_wks": "employees",
+            "async_client": async_client,
+            "sheets_api_url": f"{sheets_url}/v4/spreadsheets",
+        },
+        "gspread_credentials.json": {
+            "type": "service_account",
+            "client_email": "loadtest@loadtest.iam.gserviceaccount.com",
+            "private_key": private_key.save_pkcs1().decode("ascii"),
+            "token_uri": f"{sheets_url}/token",
+        },
+        "logger.json": {"telegram_apikey": "0:loadtest", "user_id": 0, "project_name": "Load test"},
+    }
+    for name, data in credentials.items():
+        with open(os.path.join(path, "credentials", name), "w", encoding="utf-8") as f:
+            json.dump(data, f)
+
+
+def patch_logger():
+    import logger
+    logger.Logger.log = lambda self, text, markdown=True: print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] LOG: {text}")
+
+
+def setup_worker(workdir: str, throttle: bool):
+    """
+    Runs in every webhook worker process, which imports this module before the bot. The worksheets
+    opened through gspread are only handles there, their values are read and written through the
+    Sheets stand-in of the parent process.
+    """
+    sys._MEIPASS = workdir
+    gspread.service_account = lambda filename=None: FakeClient(FakeSpreadsheet(0))
+    patch_logger()
+    import bot as bot_module
+    if not throttle:
+        bot_module.throttling.buckets.burst = float("inf")
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def start_webhook(bot_module, api: FakeTelegram, workdir: str, args) -> tuple[asyncio.Task, str]:
+    """Starts webhook.run_webhook, returns its task and URL once every worker is up and the server listens"""
+    import webhook
+    port = free_port()
+    os.environ[WORKER_ENV] = json.dumps({"workdir": workdir, "throttle": args.throttle})
+    server = asyncio.create_task(webhook.run_webhook(bot_module.bot, bot_module.dp, {
+        "host": "127.0.0.1",
+        "port": port,
+        "path": "/webhook",
+        "secret": WEBHOOK_SECRET,
+        "workers": args.webhook_workers,
+    }))
+    deadline = time.monotonic() + WAIT_TIMEOUT
+    while api.calls["getme"] < max(args.webhook_workers, 1):  # on_startup of every worker ends with getMe
+        if server.done() or time.monotonic() > deadline:
+            server.cancel()
+            raise RuntimeError("webhook workers didn't start")
+        await asyncio.sleep(0.1)
+    while True:
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.1)
+            continue
+        writer.close()
+        return server, f"http://127.0.0.1:{port}/webhook"
+
+
+async def run(args) -> int:
+    api = FakeTelegram(args.api_latency)
+    await api.start()
+
+    spreadsheet = FakeSpreadsheet(args.sheets_latency)
+    gspread.service_account = lambda filename=None: FakeClient(spreadsheet)
+    sheets_api = FakeSheetsApi(spreadsheet)
+    await sheets_api.start()
+
+    workdir = tempfile.mkdtemp(prefix="keys_loadtest_")
+    write_credentials(workdir, api.url, sheets_api.url, not args.gspread)
+    sys._MEIPASS = workdir  # resource_path() resolves credentials/ against it, as in a PyInstaller build
+    os.chdir(workdir)  # FSM storage and the journal are created in the working directory, workers inherit it
+
+    patch_logger()
+    import bot as bot_module
+    if not args.throttle:  # virtual users type far faster than people
+        bot_module.throttling.buckets.burst = float("inf")
+
+    users = [VirtualUser(USER_ID_BASE + i, f"Сотрудник{i}", "Нагрузочный") for i in range(args.users)]
+    guards = [VirtualUser(GUARD_ID_BASE + i, f"Охранник{i}", "Нагрузочный") for i in range(args.guards)]
+    approver = VirtualUser(APPROVER_ID, "Старший", "Охранник")
+    keys = max(args.keys, args.users * args.bundle)
+    fill_sheets(bot_module, users, guards, approver, keys, args.history)
+
+    dp, bot = bot_module.dp, bot_module.bot
+    server = None
+    if args.webhook_workers is None:
+        test = LoadTest(bot_module, api)
+        await dp.emit_startup(bot=bot, dispatcher=dp, bots=[bot], **dp.workflow_data)
+    else:
+        server, url = await start_webhook(bot_module, api, workdir, args)
+        test = LoadTest(bot_module, api, url)
+    returns = asyncio.Queue()
+    background = [asyncio.create_task(test.approver(approver))]
+    background += [asyncio.create_task(test.guard(guard, returns)) for guard in guards]
+
+    start = time.perf_counter()
+    await asyncio.gather(*(
+        test.employee(
+            user, [key_name(i * args.bundle + j) for j in range(args.bundle)], args.rounds, returns,
+            [key_name(k) for k in random.sample(range(keys), min(ORDER_CHECKS, keys))],
+        )
+        for i, user in enumerate(users)
+    ))
+    elapsed = time.perf_counter() - start
+
+    for task in background:
+        task.cancel()
+    await test.close()
+    if server is None:
+        await dp.emit_shutdown(bot=bot, dispatcher=dp, bots=[bot], **dp.workflow_data)
+    else:  # run_webhook shuts the workers (or the dispatcher) down on cancellation
+        server.cancel()
+        try:
+            await server
+        except asyncio.CancelledError:
+            pass
+    await bot.session.close()
+    await api.stop()
+    await sheets_api.stop()
+    test.report(elapsed, spreadsheet.calls + sum(wks.calls for wks in spreadsheet.worksheets.values()))
+    os.chdir(os.path.dirname(workdir))
+    shutil.rmtree(workdir, ignore_errors=True)
+    if test.errors[ORDER_LABEL]:
+        print(f"FAILED: {test.errors[ORDER_LABEL]} chat(s) got their answers out of order")
+        return 1
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test of the bot against fake Telegram and Sheets")
+    parser.add_argument("--users", type=int, default=20, help="virtual employees taking keys")
+    parser.add_argument("--guards", type=int, default=3, help="virtual guards returning keys")
+    parser.add_argument("--rounds", type=int, default=3, help="take/return cycles per employee")
+    parser.add_argument("--bundle", type=int, default=1, help="keys per request and per return")
+    parser.add_argument("--throttle", action="store_true", help="keep the per-user rate limits")
+    parser.add_argument("--gspread", action="store_true", help="call Sheets through gspread instead of the async client")
+    parser.add_argument("--keys", type=int, default=500, help="keys in the keys worksheet")
+    parser.add_argument("--history", type=int, default=10000, help="rows of accounting history")
+    parser.add_argument("--sheets-latency", type=float, default=0.1, help="seconds per Sheets call")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="seconds per Bot API call")
+    parser.add_argument("--webhook-workers", type=int, help="POST the updates to the webhook server with this many worker processes")
+    args = parser.parse_args()
+    if args.webhook_workers is not None and args.webhook_workers > 1 and args.gspread:
+        parser.error("webhook workers reach the fake worksheets only through the async client, drop --gspread")
+    sys.exit(asyncio.run(run(args)))
+
+
+if __name__ == "__mp_main__" and WORKER_ENV in os.environ:  # a webhook worker spawned by run_webhook
+    setup_worker(**json.loads(os.environ[WORKER_ENV]))
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,6 @@
 import bot
 import asyncio
+import multiprocessing
 import traceback
 import logger
 from datetime import datetime
@@ -11,6 +12,7 @@ async def run():
 lgr = None
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()
     try:
         lgr = logger.Logger()
         asyncio.run(run())
@@ -0,0 +1,130 @@
+from datetime import datetime
+import hashlib
+import asyncio
+import json
+import os
+import sheets
+
+
+CHUNK_ROWS = 2000
+PARALLEL_CHUNKS = 4  # chunk copies in flight, each is a read, a write and a read back
+CHECKPOINT_PATH = "migration_checkpoint.json"
+EXTRA_ROWS = 1000  # free rows left in the new worksheets for appends
+
+
+class MigrationError(Exception):
+    pass
+
+
+def checksum(rows: list[list[dict]]) -> str:
+    """Of the cells as Sheets returns them, so trailing empty cells and rows don't count"""
+    normalized = []
+    for row in rows:
+        row = list(row)
+        while row and not row[-1]:
+            row.pop()
+        normalized.append(row)
+    while normalized and not normalized[-1]:
+        normalized.pop()
+    return hashlib.blake2b(json.dumps(normalized, ensure_ascii=False, sort_keys=True).encode("utf-8"), digest_size=16).hexdigest()
+
+
+class Migration:
+    """
+    Copies the worksheets of the tables to another spreadsheet and switches the tables over to it.
+
+    The missing worksheets are added in one batchUpdate, then every table is copied in chunks of
+    CHUNK_ROWS rows, PARALLEL_CHUNKS at a time. Each chunk is read back and compared with the source
+    by checksum, verified checksums are saved to the checkpoint file, so a restarted migration to the
+    same spreadsheet skips the chunks that haven't changed since. The final pass runs with sheet writes
+    paused: chunks changed by writes made during the copy are copied again, then the tables are
+    re-pointed at once. Writes outside the journal (e.g. /import) must not run meanwhile.
+
+    Cells are copied as entered, with their formats: formulas stay formulas, numbers and dates keep
+    their type and number format. Reading grid data costs more than reading values (each cell comes
+    with its format); other formatting like colors, borders and column widths is not copied.
+    """
+
+    def __init__(self, url: str, tables: list, checkpoint_path: str = CHECKPOINT_PATH, on_progress=None):
+        self.url = url
+        self.tables = tables
+        self.checkpoint_path = checkpoint_path
+        self.on_progress = on_progress  # awaited with (chunks done, chunks total)
+        self.semaphore = asyncio.Semaphore(PARALLEL_CHUNKS)
+        self.checkpoint = self.load_checkpoint()
+        self.done = 0
+        self.total = 0
+        self.copied = 0
+
+    # region Checkpoint
+
+    def load_checkpoint(self) -> dict:
+        try:
+            with open(self.checkpoint_path, "r", encoding="utf-8") as f:
+                checkpoint = json.load(f)
+        except (FileNotFoundError, ValueError):
+            checkpoint = None
+        if checkpoint is None or checkpoint.get("source") != sheets.tables_data["spreadsheet_url"] or checkpoint.get("target") != self.url:
+            checkpoint = {"source": sheets.tables_data["spreadsheet_url"], "target": self.url, "chunks": {}}
+        return checkpoint
+
+    def save_checkpoint(self):
+        tmp_path = self.checkpoint_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.checkpoint, f)
+        os.replace(tmp_path, self.checkpoint_path)
+
+    # endregion
+
+    async def run(self, paused_writes) -> int:
+        """paused_writes: async context manager stopping sheet writes, returns the number of chunks copied"""
+        try:
+            target = await sheets.sheets_call(sheets.gs.open_by_url, self.url)
+        except sheets.gspread.exceptions.SpreadsheetNotFound:
+            raise MigrationError("таблица не найдена, откройте к ней доступ сервисному аккаунту бота")
+        except sheets.gspread.exceptions.NoValidUrlKeyFound:
+            raise MigrationError("это не ссылка на Google таблицу")
+        if target.id == sheets.spreadsheet.id:
+            raise MigrationError("бот уже работает с этой таблицей")
+        worksheets = await sheets.add_worksheets(target, [
+            (table.wks.title, max(table.wks.row_count, EXTRA_ROWS), table.wks.col_count) for table in self.tables
+        ])
+        await self.copy_all(worksheets)
+        async with paused_writes:
+            await self.copy_all(worksheets)  # only chunks changed by writes made during the first pass
+            sheets.switch_spreadsheet(target, self.url, {table: worksheets[table.wks.title] for table in self.tables})
+        os.remove(self.checkpoint_path)
+        return self.copied
+
+    async def copy_all(self, worksheets: dict):
+        jobs = []
+        for table in self.tables:
+            source, target = table.wks, worksheets[table.wks.title]
+            rows = len(await sheets.col_values(source, 1))
+            if target.row_count < rows:
+                await sheets.add_rows(target, rows - target.row_count + EXTRA_ROWS)
+            jobs += [(source, target, start, min(start + CHUNK_ROWS - 1, rows)) for start in range(1, rows + 1, CHUNK_ROWS)]
+        self.done, self.total = 0, len(jobs)
+        await asyncio.gather(*(self.copy_chunk(*job) for job in jobs))
+
+    async def copy_chunk(self, source, target, start: int, end: int):
+        cell_range = f"A{start}:{sheets.column_letter(source.col_count)}{end}"
+        key = f"{source.title}!{start}"
+        async with self.semaphore:
+            rows = await sheets.get_cells(source, cell_range)
+            digest = checksum(rows)
+            if self.checkpoint["chunks"].get(key) != digest:  # not copied yet, or changed since
+                # padded to the whole range, so cells emptied in the source are emptied in the copy too
+                padded = [row + [{}] * (source.col_count - len(row)) for row in rows]
+                padded += [[{}] * source.col_count for _ in range(end - start + 1 - len(rows))]
+                await sheets.update_cells(target, start, padded)
+                copied = await sheets.get_cells(target, cell_range)
+                if checksum(copied) != digest:
+                    raise MigrationError(f"копия не совпала с оригиналом: лист {target.title}, строки {start}-{end}")
+                self.checkpoint["chunks"][key] = digest
+                self.save_checkpoint()
+                self.copied += 1
+        self.done += 1
+        print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] INFO: Migration: {source.title} rows {start}-{end} verified")
+        if self.on_progress is not None:
+            await self.on_progress(self.done, self.total)
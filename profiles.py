@@ -0,0 +1,75 @@
+from aiogram import Bot
+from aiogram.dispatcher.middlewares.base import BaseMiddleware
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime
+import asyncio
+import time
+
+
+PROFILE_TTL = 60*60*24
+PROFILES_MAX_SIZE = 5000
+
+
+@dataclass
+class Profile:
+    user_id: int
+    username: str | None
+    first_name: str | None
+    last_name: str | None
+    updated: float
+
+
+class ProfileCache:
+    """TTL + LRU cache of Telegram profiles, fed from incoming updates, get_chat only as a fallback"""
+
+    def __init__(self, ttl: float = PROFILE_TTL, max_size: int = PROFILES_MAX_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.profiles: OrderedDict[int, Profile] = OrderedDict()
+        self.refreshing: set[int] = set()
+
+    def remember(self, user_id: int, username: str | None, first_name: str | None = None, last_name: str | None = None):
+        user_id = int(user_id)
+        self.profiles[user_id] = Profile(user_id, username, first_name, last_name, time.monotonic())
+        self.profiles.move_to_end(user_id)
+        while len(self.profiles) > self.max_size:
+            self.profiles.popitem(last=False)
+
+    def get(self, user_id: int | str) -> Profile | None:
+        user_id = int(user_id)
+        profile = self.profiles.get(user_id)
+        if profile is None:
+            return None
+        if time.monotonic() - profile.updated > self.ttl:
+            del self.profiles[user_id]
+            return None
+        self.profiles.move_to_end(user_id)
+        return profile
+
+    def refresh_later(self, bot: Bot, user_id: int | str):
+        user_id = int(user_id)
+        if user_id in self.refreshing:
+            return
+        self.refreshing.add(user_id)
+        asyncio.create_task(self._refresh(bot, user_id))
+
+    async def _refresh(self, bot: Bot, user_id: int):
+        try:
+            chat = await bot.get_chat(user_id)
+            self.remember(user_id, chat.username, chat.first_name, chat.last_name)
+        except Exception as e:
+            print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] ERR: Failed to get chat {user_id}: {e}")
+        finally:
+            self.refreshing.discard(user_id)
+
+
+class ProfilesMiddleware(BaseMiddleware):
+    def __init__(self, profiles: ProfileCache):
+        self.profiles = profiles
+
+    async def __call__(self, handler, event, data: dict):
+        user = data.get("event_from_user")
+        if user is not None:
+            self.profiles.remember(user.id, user.username, user.first_name, user.last_name)
+        return await handler(event, data)
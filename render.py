@@ -0,0 +1,435 @@
+from datetime import datetime
+from functools import lru_cache
+import weakref
+import re
+
+
+# region Constants
+
+
+time_format = "%H:%M (%d.%m.%Y)"
+MESSAGE_LIMIT = 2000
+
+ESCAPE_TABLE = str.maketrans({char: f"\\{char}" for char in "_*[`"})
+
+KEY_HEADER = "*Ключ*: `{key_name}`\n"
+KEY_INFO = (
+    "*  Количество ключей*: `{count}`\n"
+    "*  Тип ключа*: `{key_type}`\n"
+    "*  Тип аппаратный*: `{hardware_type}`\n"
+)
+STATE_TAKEN = "*  Состояние*: Не на месте\n"
+STATE_IN_PLACE = "*  Состояние*: Этот ключ сейчас на месте\n"
+AVAILABILITY = "*  Свободно*: `{available} из {copies}`\n"
+TAKEN_BODY = (
+    "*Ключ выдан:*\n"
+    "  *Имя*: `{name}`\n"
+    "  *Выдан в*: `{received}`\n"
+    "{comment}"
+    "  *Контакт*: {phone}\n"
+)
+RETURNED_BODY = (
+    "*Последний пользователь:*\n"
+    "  *Имя*: `{name}`\n"
+    "  *Взял в*: `{received}`\n"
+    "  *Вернул в*: `{returned}`\n"
+    "{comment}"
+    "  *Контакт*: {phone}\n"
+)
+
+CARD_TAKEN = KEY_HEADER + STATE_TAKEN + TAKEN_BODY
+CARD_IN_PLACE = KEY_HEADER + STATE_IN_PLACE + RETURNED_BODY
+CARD_TAKEN_WITH_KEY = KEY_HEADER + STATE_TAKEN + "{availability}" + KEY_INFO + "\n" + TAKEN_BODY
+CARD_IN_PLACE_WITH_KEY = KEY_HEADER + STATE_IN_PLACE + "{availability}" + KEY_INFO + "\n" + RETURNED_BODY
+CARD_NO_HISTORY = (
+    KEY_HEADER +
+    "*  Состояние*: На месте\n" +
+    KEY_INFO + "\n"
+    "Нет информации по последнему пользователю\n"
+)
+CARD_COMMENT = "  *Комментарии*: \"{}\"\n"
+
+KEY_HISTORY_HEADER = "*Ключ*: `{key_name}`\n"
+KEY_HISTORY_INFO = (
+    "*Количество ключей*: `{count}`\n"
+    "*Тип ключа*: `{key_type}`\n"
+    "*Тип аппаратный*: `{hardware_type}`\n"
+)
+KEY_HISTORY_COUNT = "*Этот ключ брали*: {count} раз(а)\n\n"
+KEY_HOLDERS_HEADER = (
+    "*Ключ*: `{key_name}`\n"
+    "*{period_label}*: `{period}`\n"
+    "*Ключ был выдан*: {count} раз(а)\n\n"
+)
+KEY_HISTORY_LINE = (
+    "*Имя*: `{name}`\n"
+    "| *Взял в*: `{received}`\n"
+    "{returned}"
+    "| *Контакт*: {phone}\n"
+    "{comment}"
+    "\n"
+)
+
+EMP_HISTORY_HEADER = (
+    "*Имя*: `{name}`\n"
+    "*Телефон*: {phone}\n"
+    "{telegram}"
+    "*Роли*: {roles}\n"
+    "*Этот сотрудник брал ключи*: {count} раз(а)\n\n"
+)
+EMP_HISTORY_HEADER_UNKNOWN = (
+    "*Имя*: `{name}`\n"
+    "*Этот сотрудник брал ключи*: {count} раз(а)\n\n"
+)
+EMP_HISTORY_LINE = (
+    "*Ключ*: `{key_name}`\n"
+    "| *Взял в*: `{received}`\n"
+    "{returned}"
+    "{comment}"
+    "\n"
+)
+
+MY_KEY = (
+    "*Ключ*: `{key_name}`\n"
+    "| *Взял в*: `{received}`\n"
+    "{comment}"
+)
+MY_KEY_WITH_KEY = (
+    "*Ключ*: `{key_name}`\n"
+    "| *Взял в*: `{received}`\n"
+    "| *Количество ключей*: `{count}`\n"
+    "| *Тип ключа*: `{key_type}`\n"
+    "| *Тип аппаратный*: `{hardware_type}`\n"
+    "{comment}"
+)
+
+STALE_MARKER = "\n\n⚠️ Нет связи с Google Таблицей, данные на {}"
+SHEETS_UNAVAILABLE = "Нет связи с Google Таблицей, попробуйте позже"
+
+STATS_HEADER = (
+    "*Статистика {period}*\n"
+    "*Выдач ключей*: {total}\n"
+    "*Сейчас на руках*: {open}\n"
+    "*Разных ключей*: {keys_used}\n"
+    "*Сотрудников*: {employees}\n"
+    "*Среднее время на руках*: {avg_hold}\n"
+    "*Медиана*: {median_hold}\n"
+    "*Просрочено (3+ дня)*: {overdue_total}\n"
+)
+STATS_TOP_KEYS = "\n*Чаще всего берут*:\n"
+STATS_TOP_KEY_LINE = "  `{}`: {} раз(а)\n"
+STATS_OVERDUE = "\n*Чаще всего просрочивают*:\n"
+STATS_OVERDUE_LINE = "  `{}`: {:.0%} из {}\n"
+STATS_PEAK_HOURS = "\n*Пиковые часы*: {}\n"
+STATS_WEEKDAYS = "*По дням недели*: {}\n"
+WEEKDAYS = ("Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс")
+
+CACHE_HEADER = "*Кэш*: записей {count}, ≈{size}\n\n"
+CACHE_LINE = (
+    "`{key}`\n"
+    "| *Элементов*: {items}\n"
+    "| *Возраст*: {age}\n"
+    "| *Истекает через*: {expires_in}\n"
+    "| *Память*: ≈{size}\n\n"
+)
+CACHE_FOOTER = "/send\\_cache dump - выгрузить кэш целиком"
+
+DASHBOARD_LINES = 30  # per section, keeps the message far below Telegram's 4096 characters
+DASHBOARD_REQUESTS = "*Ожидают подтверждения* ({count}):\n"
+DASHBOARD_REQUEST_LINE = "  `{keys}` — {name}\n"
+DASHBOARD_OPEN = "\n*Не на месте* ({count}):\n"
+DASHBOARD_OPEN_LINE = "  `{key_name}` — {name}, с {received}\n"
+DASHBOARD_NONE = "  нет\n"
+DASHBOARD_MORE = "  …и ещё {}\n"
+DASHBOARD_FOOTER = "\n/return\\_key - принять ключи"
+
+IMPORT_ERRORS_SHOWN = 10
+IMPORT_REPORT = (
+    "Импорт {label} завершён\n"
+    "Добавлено: {added}\n"
+    "Пропущено (уже есть): {skipped}\n"
+    "Ошибок: {errors}\n"
+)
+IMPORT_ERROR_LINE = "  строка {}: {}\n"
+
+HISTORY_RETURNED = "| *Вернул в*: `{}`\n"
+HISTORY_COMMENT = "| *Комментарии*: \"{}\"\n"
+MY_KEY_COMMENT = "|  *Комментарии*: \"{}\"\n"
+
+
+# endregion
+
+
+# region Utils
+
+
+def escape_markdown(text: str):
+    return text.translate(ESCAPE_TABLE)
+
+
+@lru_cache(maxsize=4096)
+def phone_format(phone: str | int):
+    phone = str(phone)
+    digits = ''.join(filter(str.isdigit, phone))
+    if digits.startswith('8'):
+        digits = '7' + digits[1:]
+    elif digits.startswith('7'):
+        pass
+    else:
+        digits = '7' + digits
+    digits = digits[:11]
+    return f'+{digits}'
+
+
+@lru_cache(maxsize=65536)
+def time_str(dt: datetime) -> str:
+    return dt.strftime(time_format)
+
+
+def comment_line(template: str, comment: str) -> str:
+    return template.format(escape_markdown(comment)) if comment else ""
+
+
+def key_fields(key) -> dict:
+    return {"count": key.count, "key_type": key.key_type, "hardware_type": key.hardware_type}
+
+
+def key_version(key) -> tuple | None:
+    return None if key is None else (key.count, key.key_type, key.hardware_type)
+
+
+# entry -> {variant: (version, text)}, entries are dropped with the cache lists that own them
+render_cache: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+
+
+def cached(variant: str, entry, extra, build) -> str:
+    version = (entry.time_returned, entry.comment, extra)
+    per_entry = render_cache.get(entry)
+    if per_entry is None:
+        per_entry = render_cache[entry] = {}
+    hit = per_entry.get(variant)
+    if hit is not None and hit[0] == version:
+        return hit[1]
+    text = build()
+    per_entry[variant] = (version, text)
+    return text
+
+
+def stale_marker(since: datetime) -> str:
+    return STALE_MARKER.format(since.strftime(time_format))
+
+
+STALE_MARKER_RE = re.compile(re.escape(STALE_MARKER).replace(re.escape("{}"), r"[^\n]*"))
+
+
+def strip_stale_marker(text: str) -> str:
+    """Edits often resend the old text, which may carry a marker from an earlier outage"""
+    return STALE_MARKER_RE.sub("", text)
+
+
+def chunks(header: str, lines: list[str], empty_text: str, limit: int = MESSAGE_LIMIT) -> list[str]:
+    if not lines:
+        return [header + empty_text]
+    result = []
+    parts, length = [header], len(header)
+    for line in lines:
+        if length > limit:
+            result.append("".join(parts))
+            parts, length = [], 0
+        parts.append(line)
+        length += len(line)
+    result.append("".join(parts))
+    return result
+
+
+# endregion
+
+
+# region Cards
+
+
+def duration_str(seconds: float | None) -> str:
+    if seconds is None:
+        return "нет данных"
+    minutes = int(seconds // 60)
+    days, minutes = divmod(minutes, 60*24)
+    hours, minutes = divmod(minutes, 60)
+    if days:
+        return f"{days} д {hours} ч"
+    return f"{hours} ч {minutes} мин"
+
+
+def size_str(size: int) -> str:
+    for unit in ("Б", "КБ", "МБ"):
+        if size < 1024:
+            return f"{size:.0f} {unit}"
+        size /= 1024
+    return f"{size:.1f} ГБ"
+
+
+def cache_report(stats: list) -> str:
+    lines = [
+        CACHE_LINE.format(
+            key=item.key,
+            items=item.items,
+            age=duration_str(item.age),
+            expires_in=duration_str(item.expires_in),
+            size=size_str(item.size),
+        )
+        for item in sorted(stats, key=lambda item: item.key)
+    ]
+    return CACHE_HEADER.format(count=len(stats), size=size_str(sum(item.size for item in stats))) + "".join(lines) + CACHE_FOOTER
+
+
+def stats_report(report) -> str:
+    period = f"за {report.days} дн." if report.days else "за всё время"
+    text = STATS_HEADER.format(
+        period=period,
+        total=report.total,
+        open=report.open,
+        keys_used=report.keys_used,
+        employees=report.employees,
+        avg_hold=duration_str(report.avg_hold),
+        median_hold=duration_str(report.median_hold),
+        overdue_total=report.overdue_total,
+    )
+    if report.top_keys:
+        text += STATS_TOP_KEYS + "".join(STATS_TOP_KEY_LINE.format(name, count) for name, count in report.top_keys)
+    if report.overdue_rates:
+        text += STATS_OVERDUE + "".join(
+            STATS_OVERDUE_LINE.format(name, rate, count) for name, rate, count in report.overdue_rates
+        )
+    if report.peak_hours:
+        text += STATS_PEAK_HOURS.format(", ".join(f"{hour:02}:00 ({count})" for hour, count in report.peak_hours))
+        text += STATS_WEEKDAYS.format(", ".join(f"{day} {count}" for day, count in zip(WEEKDAYS, report.weekdays)))
+    return text
+
+
+def dashboard_section(header: str, lines: list[str]) -> str:
+    shown = "".join(lines[:DASHBOARD_LINES]) or DASHBOARD_NONE
+    if len(lines) > DASHBOARD_LINES:
+        shown += DASHBOARD_MORE.format(len(lines) - DASHBOARD_LINES)
+    return header.format(count=len(lines)) + shown
+
+
+def dashboard(requests: list[tuple[list[str], str]], open_entries: list) -> str:
+    """requests: (key names, employee name) of pending key requests, oldest first"""
+    request_lines = [
+        DASHBOARD_REQUEST_LINE.format(keys=", ".join(key_names), name=escape_markdown(name))
+        for key_names, name in requests
+    ]
+    open_lines = [
+        DASHBOARD_OPEN_LINE.format(
+            key_name=entry.key_name,
+            name=escape_markdown(f"{entry.emp_firstname} {entry.emp_lastname}"),
+            received=time_str(entry.time_received),
+        )
+        for entry in sorted(open_entries, key=lambda entry: entry.time_received)
+    ]
+    return (
+        dashboard_section(DASHBOARD_REQUESTS, request_lines) +
+        dashboard_section(DASHBOARD_OPEN, open_lines) +
+        DASHBOARD_FOOTER
+    )
+
+
+def import_report(result, label: str) -> str:
+    """Plain text, error lines quote the file as is"""
+    text = IMPORT_REPORT.format(label=label, added=len(result.items), skipped=result.skipped, errors=len(result.errors))
+    text += "".join(IMPORT_ERROR_LINE.format(line, reason) for line, reason in result.errors[:IMPORT_ERRORS_SHOWN])
+    if len(result.errors) > IMPORT_ERRORS_SHOWN:
+        text += DASHBOARD_MORE.format(len(result.errors) - IMPORT_ERRORS_SHOWN)
+    return text
+
+
+def key_card(entry, key=None, available: int = None) -> str:
+    """available: free copies of a multi-copy key, shown next to the state"""
+    def build():
+        fields = {
+            "key_name": entry.key_name,
+            "name": f"{entry.emp_firstname} {entry.emp_lastname}",
+            "received": time_str(entry.time_received),
+            "returned": time_str(entry.time_returned) if entry.time_returned else "",
+            "comment": comment_line(CARD_COMMENT, entry.comment),
+            "phone": phone_format(entry.emp_phone),
+        }
+        if key is None:
+            template = CARD_TAKEN if entry.time_returned is None else CARD_IN_PLACE
+        else:
+            fields.update(key_fields(key))
+            fields["availability"] = "" if available is None else AVAILABILITY.format(available=available, copies=key.copies)
+            template = CARD_TAKEN_WITH_KEY if entry.time_returned is None else CARD_IN_PLACE_WITH_KEY
+        return template.format_map(fields)
+
+    return cached("key_card", entry, (key_version(key), available), build)
+
+
+def key_card_no_history(key_name: str, key) -> str:
+    return CARD_NO_HISTORY.format(key_name=key_name, **key_fields(key))
+
+
+def key_history_header(key_name: str, key, count: int) -> str:
+    header = KEY_HISTORY_HEADER.format(key_name=key_name)
+    if key:
+        header += KEY_HISTORY_INFO.format_map(key_fields(key))
+    return header + KEY_HISTORY_COUNT.format(count=count)
+
+
+def key_history_line(entry) -> str:
+    return cached("key_history", entry, None, lambda: KEY_HISTORY_LINE.format(
+        name=f"{entry.emp_firstname} {entry.emp_lastname}",
+        received=time_str(entry.time_received),
+        returned=HISTORY_RETURNED.format(time_str(entry.time_returned)) if entry.time_returned else "",
+        phone=phone_format(entry.emp_phone),
+        comment=comment_line(HISTORY_COMMENT, entry.comment),
+    ))
+
+
+def key_holders_header(key_name: str, start: datetime, end: datetime | None, count: int) -> str:
+    if end is None:
+        period_label, period = "Время", time_str(start)
+    else:
+        period_label, period = "Период", f"{time_str(start)} - {time_str(end)}"
+    return KEY_HOLDERS_HEADER.format(key_name=key_name, period_label=period_label, period=period, count=count)
+
+
+def emp_history_header(name: str, emp, count: int, username: str | None = None) -> str:
+    if not emp:
+        return EMP_HISTORY_HEADER_UNKNOWN.format(name=name, count=count)
+    return EMP_HISTORY_HEADER.format(
+        name=f"{emp.first_name} {emp.last_name}",
+        phone=phone_format(emp.phone_number),
+        telegram=f"*Телеграм*: @{username}\n" if username else "",
+        roles=', '.join(emp.roles) if emp.roles else 'Нет',
+        count=count,
+    )
+
+
+def emp_history_line(entry) -> str:
+    return cached("emp_history", entry, None, lambda: EMP_HISTORY_LINE.format(
+        key_name=entry.key_name,
+        received=time_str(entry.time_received),
+        returned=HISTORY_RETURNED.format(time_str(entry.time_returned)) if entry.time_returned else "",
+        comment=comment_line(HISTORY_COMMENT, entry.comment),
+    ))
+
+
+def my_key(entry, key=None) -> str:
+    def build():
+        if key is None:
+            return MY_KEY.format(
+                key_name=entry.key_name,
+                received=time_str(entry.time_received),
+                comment=comment_line(HISTORY_COMMENT, entry.comment),
+            )
+        return MY_KEY_WITH_KEY.format(
+            key_name=entry.key_name,
+            received=time_str(entry.time_received),
+            comment=comment_line(MY_KEY_COMMENT, entry.comment),
+            **key_fields(key),
+        )
+
+    return cached("my_key", entry, key_version(key), build)
+
+
+# endregion
@@ -0,0 +1,92 @@
+from bisect import bisect_left
+from collections import Counter
+
+
+MAX_RESULTS = 20
+MAX_PREFIX_SCAN = 500
+TRIGRAM_THRESHOLD = 0.5
+
+
+def normalize(text: str) -> str:
+    return " ".join(text.lower().split())
+
+
+def trigrams(text: str) -> set[str]:
+    text = f" {text} "
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class SearchIndex:
+    """
+    Prefix + trigram index over a list of names.
+
+    Ranking: exact match, whole-name prefix, word prefix, substring, then fuzzy
+    trigram matches (at least TRIGRAM_THRESHOLD of the query trigrams shared).
+    """
+
+    def __init__(self, items: list[str]):
+        self.items = items
+        self.normalized = [normalize(item) for item in items]
+        self.names = sorted((text, i) for i, text in enumerate(self.normalized))
+        words = []
+        self.trigrams: dict[str, list[int]] = {}
+        for i, text in enumerate(self.normalized):
+            for word in set(text.split()):
+                if word != text:
+                    words.append((word, i))
+            for gram in trigrams(text):
+                self.trigrams.setdefault(gram, []).append(i)
+        words.sort()
+        self.words = words
+
+    @staticmethod
+    def with_prefix(prefixes: list[tuple[str, int]], query: str):
+        start = bisect_left(prefixes, (query,))
+        for word, i in prefixes[start:start + MAX_PREFIX_SCAN]:
+            if not word.startswith(query):
+                break
+            yield i
+
+    def search(self, query: str, limit: int = MAX_RESULTS) -> list[str]:
+        query = normalize(query)
+        if not query:
+            return []
+        ranks = {}
+
+        for i in self.with_prefix(self.names, query):
+            ranks[i] = 0 if self.normalized[i] == query else 1
+        for i in self.with_prefix(self.words, query):
+            ranks.setdefault(i, 2)
+
+        query_grams = trigrams(query)
+        if len(query) >= 3:
+            counts = Counter()
+            for gram in query_grams:
+                counts.update(self.trigrams.get(gram, ()))
+            for i, count in counts.items():
+                if i in ranks:
+                    continue
+                if query in self.normalized[i]:
+                    ranks[i] = 3
+                else:
+                    share = count / len(query_grams)
+                    if share >= TRIGRAM_THRESHOLD:
+                        ranks[i] = 5 - share
+
+        best = sorted(ranks, key=lambda i: (ranks[i], len(self.items[i]), self.items[i]))
+        return [self.items[i] for i in best[:limit]]
+
+
+class IndexCache:
+    """Keeps one SearchIndex per name, rebuilt only when one of its source lists is replaced"""
+
+    def __init__(self):
+        self.indexes: dict[str, tuple[tuple, SearchIndex]] = {}
+
+    def get(self, name: str, sources: tuple, build_items) -> SearchIndex:
+        cached = self.indexes.get(name)
+        if cached is not None and len(cached[0]) == len(sources) and all(a is b for a, b in zip(cached[0], sources)):
+            return cached[1]
+        index = SearchIndex(build_items(*sources))
+        self.indexes[name] = (sources, index)
+        return index
@@ -1,13 +1,21 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from bisect import insort
 import gspread
 from datetime import datetime
 import asyncio
+import contextvars
+from contextlib import contextmanager
 from prettytable import PrettyTable
 import logger
 import json
 from difflib import SequenceMatcher
+import random
+import time
 import os
 import sys
+from requests.exceptions import RequestException, ConnectionError as RequestsConnectionError
+import aiohttp
+import sheets_api
 
 
 def resource_path(relative_path):
@@ -36,9 +44,28 @@ EMPS_CACHE_TIME = 60*5
 ACCOUNTING = "keys_accounting_cache"
 A_HEADERS = "keys_accounting_headers_cache"
 ACCOUNTING_CACHE_TIME = 60*5
+OPEN_ACCOUNTING = "keys_accounting_open_cache"  # open loans only, read without the full history
+OPEN_COLUMNS = ("key_name", "emp_firstname", "emp_lastname", "time_received", "time_returned")  # of the projected read
 
 HEADERS_CACHE_TIME = 60*60
 
+REFRESH_LEAD = 30  # refresh this many seconds before a cache entry expires
+REFRESH_JITTER = 15
+REFRESH_DEBOUNCE = 1  # coalesce invalidations from a burst of writes into one reload
+REFRESH_RETRY = 10
+LOAD_ATTEMPTS = 3  # reloads of a read that raced a write before its (possibly stale) value is returned
+
+CELL_FIELDS = "userEnteredValue,userEnteredFormat"  # what a cell-exact copy carries: typed value or formula, and number format
+BATCH_GET_RANGES = 100  # ranges per batchGet request, they all go into the query string
+APPEND_CHUNK_ROWS = 500  # rows per update when appending many rows at once
+ROWS_BLOCK_SIZE = 64  # rows per block hash when diffing a fresh read against the previous one
+REFS_SLACK = 1000  # rows parsed again beyond the live ones before a site's intern tables are rebuilt
+
+BREAKER_THRESHOLD = 3  # consecutive connection failures before Sheets is considered offline
+BREAKER_BASE_DELAY = 5
+BREAKER_MAX_DELAY = 60*5
+SHEETS_TIMEOUT = 30  # seconds per request, so a hanging connection counts as a failure
+
 # mail keysspreadsheetsbot@keysspreadsheetsbot.iam.gserviceaccount.com
 
 # endregion
@@ -63,37 +90,318 @@ async def find_similar(query: str, strings: list[str]) -> list[str]:
     return matches[:5]
 
 
+class RefIds:
+    """Small integer ids of values (employee names, key names), shared by a site's tables so joins compare ints"""
+
+    def __init__(self):
+        self.ids = {}
+        self.values = []
+
+    def get(self, value) -> int:
+        ref_id = self.ids.get(value)
+        if ref_id is None:
+            ref_id = self.ids[value] = len(self.values)
+            self.values.append(value)
+        return ref_id
+
+    def find(self, value) -> int | None:
+        """Id of a value seen before, without registering a new one"""
+        return self.ids.get(value)
+
+    def clear(self):
+        self.ids.clear()
+        self.values.clear()
+
+
+class SheetsUnavailable(RequestsConnectionError):
+    """Raised instead of calling Sheets while the circuit breaker is open"""
+
+
+def is_connection_error(e: Exception) -> bool:
+    if isinstance(e, (RequestException, aiohttp.ClientError, TimeoutError)):
+        return True
+    if isinstance(e, gspread.exceptions.APIError):
+        status = e.response.status_code
+        return status == 429 or status >= 500
+    if isinstance(e, sheets_api.SheetsApiError):
+        return e.status == 429 or e.status >= 500
+    return False
+
+
+class CircuitBreaker:
+    """
+    Stops calling Sheets after BREAKER_THRESHOLD consecutive connection failures. While open,
+    calls fail fast with SheetsUnavailable and a background probe retries with exponential
+    backoff; the first successful call closes the breaker and sets the listeners' events.
+    Every site has its own (CacheSpace.breaker), so one unreachable spreadsheet doesn't take the others offline.
+    """
+
+    def __init__(self, threshold: int = BREAKER_THRESHOLD, base_delay: float = BREAKER_BASE_DELAY, max_delay: float = BREAKER_MAX_DELAY):
+        self.threshold = threshold
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.failures = 0
+        self.delay = base_delay
+        self.retry_at = 0.0
+        self.probing = False
+        self.opened_at: datetime | None = None
+        self.last_success: datetime | None = None
+        self.listeners: list[asyncio.Event] = []
+        self.prober: asyncio.Task | None = None
+        self.probe = None  # call checking the site's spreadsheet, None: the default spreadsheet
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+    def before_call(self):
+        if not self.is_open:
+            return
+        if self.probing or time.monotonic() < self.retry_at:
+            raise SheetsUnavailable(f"Google Sheets is unreachable since {self.opened_at.strftime(datetime_format)}")
+        self.probing = True  # half-open: this call goes through as the probe
+
+    def success(self):
+        self.last_success = datetime.now()
+        self.failures = 0
+        if not self.is_open:
+            return
+        print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] INFO: Google Sheets is reachable again")
+        self.opened_at = None
+        self.probing = False
+        self.delay = self.base_delay
+        for listener in self.listeners:
+            listener.set()
+        for refresher in refreshers:
+            if refresher.space.breaker is self:
+                refresher.wake_all()
+
+    def failure(self, e: Exception):
+        self.failures += 1
+        self.probing = False
+        if self.is_open:
+            self.delay = min(self.delay * 2, self.max_delay)
+        elif self.failures >= self.threshold:
+            self.opened_at = datetime.now()
+            print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] ERR: Google Sheets is unreachable, switching to offline mode: {e}")
+        else:
+            return
+        self.retry_at = time.monotonic() + self.delay * random.uniform(1, 1.5)
+        if self.prober is None or self.prober.done():
+            self.prober = asyncio.create_task(self.probe_loop())
+
+    async def probe_loop(self):
+        while self.is_open:
+            await asyncio.sleep(max(self.retry_at - time.monotonic(), 0))
+            try:
+                await sheets_call(self.probe if self.probe is not None else spreadsheet.fetch_sheet_metadata)
+            except Exception:
+                pass
+
+    def stale_since(self) -> datetime | None:
+        """Time of the last successful call while offline, None while Sheets is reachable"""
+        if not self.is_open:
+            return None
+        return self.last_success or self.opened_at
+
+
+
+class Quota:
+    """Token bucket of Sheets requests, a call waits for its token instead of failing"""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+async def sheets_call(fn, *args, **kwargs):
+    """Calls the async client directly and blocking gspread methods in a thread, within the site's quota and breaker"""
+    quota, breaker = space().quota, space().breaker
+    if quota is not None:
+        await quota.acquire()
+    breaker.before_call()
+    try:
+        if asyncio.iscoroutinefunction(fn):
+            result = await fn(*args, **kwargs)
+        else:
+            result = await asyncio.to_thread(fn, *args, **kwargs)
+    except Exception as e:
+        if is_connection_error(e):
+            breaker.failure(e)
+        else:
+            breaker.success()  # Sheets answered, the request itself was wrong
+        raise
+    breaker.success()
+    return result
+
+
+def a1(wks: gspread.Worksheet, cell_range: str = None) -> str:
+    title = "'" + wks.title.replace("'", "''") + "'"
+    return f"{title}!{cell_range}" if cell_range else title
+
+
+def column_letter(col: int) -> str:
+    return cell(col, 1)[:-1]
+
+
 async def add_worksheet(_spreadsheet: gspread.Spreadsheet, title: str, rows: int, cols: int, index: int = None):
-    await asyncio.to_thread(_spreadsheet.add_worksheet, title=title, rows=rows, cols=cols, index=index)
+    if api is None:
+        await sheets_call(_spreadsheet.add_worksheet, title=title, rows=rows, cols=cols, index=index)
+        return
+    await sheets_call(api.add_sheet, _spreadsheet.id, title, rows, cols, index)
+
+
+async def add_worksheets(_spreadsheet: gspread.Spreadsheet, specs: list[tuple[str, int, int]]) -> dict[str, gspread.Worksheet]:
+    """Adds the missing (title, rows, cols) worksheets in one batchUpdate, returns all worksheets by title"""
+    existing = {wks.title for wks in await sheets_call(_spreadsheet.worksheets)}
+    requests = [
+        {"addSheet": {"properties": {"title": title, "gridProperties": {"rowCount": rows, "columnCount": cols}}}}
+        for title, rows, cols in specs if title not in existing
+    ]
+    if requests:
+        if api is None:
+            await sheets_call(_spreadsheet.batch_update, {"requests": requests})
+        else:
+            await sheets_call(api.batch_update, _spreadsheet.id, requests)
+    return {wks.title: wks for wks in await sheets_call(_spreadsheet.worksheets)}
 
 
 async def update(wks: gspread.Worksheet, cell_str: str, values: list[list]):
-    await asyncio.to_thread(wks.update, cell_str, values)
+    if api is None:
+        await sheets_call(wks.update, cell_str, values)
+        return
+    await sheets_call(api.values_update, wks.spreadsheet_id, a1(wks, cell_str), values)
+
+
+async def batch_update(wks: gspread.Worksheet, data: list[tuple[str, list[list]]]):
+    """Writes several (range, values) pairs in one request"""
+    if api is None:
+        await sheets_call(wks.batch_update, [{"range": cell_range, "values": values} for cell_range, values in data])
+        return
+    await sheets_call(api.values_batch_update, wks.spreadsheet_id, [(a1(wks, cell_range), values) for cell_range, values in data])
 
 
 async def col_values(wks: gspread.Worksheet, col: int):
-    return await asyncio.to_thread(wks.col_values, col)
+    if api is None:
+        return await sheets_call(wks.col_values, col)
+    letter = column_letter(col)
+    values = await sheets_call(api.values_get, wks.spreadsheet_id, a1(wks, f"{letter}:{letter}"), "COLUMNS")
+    return values[0] if values else []
 
 
 async def row_values(wks: gspread.Worksheet, row: int):
-    return await asyncio.to_thread(wks.row_values, row)
+    if api is None:
+        return await sheets_call(wks.row_values, row)
+    values = await sheets_call(api.values_get, wks.spreadsheet_id, a1(wks, f"{row}:{row}"))
+    return values[0] if values else []
 
 
 async def get_all_values(wks: gspread.Worksheet):
-    return await asyncio.to_thread(wks.get_all_values)
+    if api is None:
+        return await sheets_call(wks.get_all_values)
+    return fill_gaps(await sheets_call(api.values_get, wks.spreadsheet_id, a1(wks)))
+
+
+async def batch_get(wks: gspread.Worksheet, ranges: list[str], major_dimension: str = "ROWS") -> list[list[list[str]]]:
+    """Values of several ranges of the worksheet, one list of rows (or columns) per range"""
+    result = []
+    for start in range(0, len(ranges), BATCH_GET_RANGES):
+        chunk = ranges[start:start + BATCH_GET_RANGES]
+        if api is None:
+            value_ranges = await sheets_call(wks.batch_get, chunk, major_dimension=major_dimension)
+            result.extend(list(value_range) for value_range in value_ranges)
+        else:
+            result.extend(await sheets_call(
+                api.values_batch_get, wks.spreadsheet_id, [a1(wks, r) for r in chunk], major_dimension
+            ))
+    return result
+
+
+async def get_cells(wks: gspread.Worksheet, cell_range: str) -> list[list[dict]]:
+    """
+    CellData of the range as entered (a typed value or a formula, and the format), one list per row.
+    Unlike the values reads nothing is rendered, so numbers, dates and formulas keep their kind.
+    """
+    params = {
+        "ranges": a1(wks, cell_range),
+        "includeGridData": "true",
+        "fields": f"sheets.data.rowData.values({CELL_FIELDS})",
+    }
+    if api is None:
+        data = await sheets_call(wks.spreadsheet.fetch_sheet_metadata, params)
+    else:
+        data = await sheets_call(api.get_spreadsheet, wks.spreadsheet_id, params)
+    grid = (data.get("sheets") or [{}])[0].get("data") or [{}]
+    return [row.get("values", []) for row in grid[0].get("rowData", [])]
+
+
+async def update_cells(wks: gspread.Worksheet, start_row: int, rows: list[list[dict]]):
+    """Overwrites the cells from column A of start_row with CellData from get_cells, an empty dict clears the cell"""
+    request = {"updateCells": {
+        "start": {"sheetId": wks.id, "rowIndex": start_row - 1, "columnIndex": 0},
+        "rows": [{"values": row} for row in rows],
+        "fields": CELL_FIELDS,
+    }}
+    if api is None:
+        await sheets_call(wks.spreadsheet.batch_update, {"requests": [request]})
+        return
+    await sheets_call(api.batch_update, wks.spreadsheet_id, [request])
 
 
 async def auto_resize(wks: gspread.Worksheet, start_col: int, end_col: int):
-    await asyncio.to_thread(wks.columns_auto_resize, start_col, end_col)
+    if api is None:
+        await sheets_call(wks.columns_auto_resize, start_col, end_col)
+        return
+    await sheets_call(api.batch_update, wks.spreadsheet_id, [{"autoResizeDimensions": {"dimensions": {
+        "sheetId": wks.id, "dimension": "COLUMNS", "startIndex": start_col, "endIndex": end_col
+    }}}])
 
 
 async def add_rows(wks: gspread.Worksheet, rows_count: int):
-    await asyncio.to_thread(wks.add_rows, rows_count)
+    await sheets_call(wks.add_rows, rows_count)  # through gspread, which keeps wks.row_count up to date
+
+
+async def append_rows(wks: gspread.Worksheet, rows: list[list], on_progress=None) -> int:
+    """
+    Writes the rows after the last filled cell of the first column: one read, at most one add_rows
+    and an update per APPEND_CHUNK_ROWS rows. Returns the first written row,
+    on_progress(written, total) is awaited after each chunk.
+    """
+    insert_row = len(await col_values(wks, 1)) + 1
+    last_row = insert_row + len(rows) - 1
+    if wks.row_count < last_row:
+        await add_rows(wks, last_row - wks.row_count)
+    for start in range(0, len(rows), APPEND_CHUNK_ROWS):
+        await update(wks, cell(1, insert_row + start), rows[start:start + APPEND_CHUNK_ROWS])
+        if on_progress is not None:
+            await on_progress(min(start + APPEND_CHUNK_ROWS, len(rows)), len(rows))
+    return insert_row
 
 
 async def clear(wks: gspread.Worksheet):
     print(f"WARNING: Clearing sheet {wks.title}")
-    await asyncio.to_thread(wks.clear)
+    if api is None:
+        await sheets_call(wks.clear)
+        return
+    await sheets_call(api.values_clear, wks.spreadsheet_id, a1(wks))
+
+
+def fill_gaps(rows: list[list[str]]) -> list[list[str]]:
+    """Pads rows to the same length, like gspread's get_all_values"""
+    width = max((len(row) for row in rows), default=0)
+    return [row + [""] * (width - len(row)) for row in rows]
 
 
 def sort_values_by_headers(russian_headers, values, keys_headers):
@@ -150,6 +458,7 @@ gs = None
 if gs is None:
     print("Setting gspread credentials")
     gs = gspread.service_account(filename=credentials_path)
+    gs.set_timeout(SHEETS_TIMEOUT)
 
 spreadsheet = None
 tables_data = None
@@ -160,6 +469,10 @@ if spreadsheet is None:
     spreadsheet = gs.open_by_url(tables_data["spreadsheet_url"])
     print(f"Spreadsheet \'{spreadsheet.title}\' opened")
 
+api = None  # async Sheets client for values reads and writes, gspread still opens spreadsheets and worksheets
+if tables_data.get("async_client", True):
+    api = sheets_api.SheetsClient(credentials_path, tables_data.get("sheets_api_url", sheets_api.BASE_URL))
+
 
 # endregion
 
@@ -178,9 +491,11 @@ async def change_spreadsheet(url: str):
 
     tables_data["spreadsheet_url"] = url
 
-    await add_worksheet(sp, tables_data["keys_accounting_wks"], 1000, 20)
-    await add_worksheet(sp, tables_data["keys_wks"], 1000, 20)
-    await add_worksheet(sp, tables_data["employees_wks"], 1000, 20)
+    await add_worksheets(sp, [
+        (tables_data["keys_accounting_wks"], 1000, 20),
+        (tables_data["keys_wks"], 1000, 20),
+        (tables_data["employees_wks"], 1000, 20),
+    ])
 
     with open(tables_path, "w", encoding="utf-8") as f:
         json.dump(tables_data, f)
@@ -198,37 +513,496 @@ async def change_spreadsheet(url: str):
     return kat, keys, employees
 
 
-cache = {}
+def switch_spreadsheet(sp: gspread.Spreadsheet, url: str, worksheets: dict) -> None:
+    """
+    Points the tables ({table: worksheet}) at another spreadsheet in one step, without awaiting,
+    so no request sees a mix. Cached values stay valid when the new worksheets are row-for-row copies.
+    """
+    global spreadsheet
+    spreadsheet = sp
+    for table, wks in worksheets.items():
+        table.wks = wks
+    tables_data["spreadsheet_url"] = url
+    with open(tables_path, "w", encoding="utf-8") as f:
+        json.dump(tables_data, f)
+
+
+class CacheSpace:
+    """
+    A site's cache namespace. The cache keys are the same for every site, each table reads and
+    invalidates the space that was current when it was created.
+    """
+
+    def __init__(self, name: str, quota: Quota = None):
+        self.name = name
+        self.quota = quota  # None: no budget of its own, only Google's
+        self.breaker = CircuitBreaker()
+        self.cache = {}
+        self.cache_added = {}
+        self.cache_expires = {}
+        self.inflight = {}
+        self.cache_generation = {}  # bumped on every invalidation, tells loads that raced a write
+        self.stale = set()  # keys invalidated by a write, their old values are served until the refresher reloads them
+        self.timers = {}  # key -> task removing the value when it expires
+        # per site rather than sys.intern or process-wide ids, so a closed site's names are freed with it
+        self.strings = {}  # repeated cell values, one string object per value
+        self.employee_refs = RefIds()  # (first name, last name) -> id
+        self.key_refs = RefIds()  # key name -> id
+        self.parsed = []  # ParsedRows of the site's tables, their objects hold the names and ids above
+        self.reparsed = 0  # rows parsed since the intern tables were rebuilt
+
+    def intern(self, value):
+        return self.strings.setdefault(value, value) if type(value) is str else value
+
+    @contextmanager
+    def use(self):
+        """Objects created inside get their names and ids from this space"""
+        token = current_space.set(self)
+        try:
+            yield self
+        finally:
+            current_space.reset(token)
+
+    def close(self):
+        """Frees a closed site's caches, expiry timers don't keep them alive"""
+        for timer in self.timers.values():
+            timer.cancel()
+        self.timers.clear()
+        if self.breaker.prober is not None:
+            self.breaker.prober.cancel()
+        self.cache.clear()
+        self.cache_added.clear()
+        self.cache_expires.clear()
+        self.stale.clear()
+        self.inflight.clear()
+
+    def rebuild_refs(self):
+        """
+        Starts the intern tables over, so names of edited and deleted rows don't pile up. Objects keep their
+        ids, so every table of the site is parsed in full on its next read and its cached values are dropped.
+        """
+        print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] INFO: {self.name}: rebuilding the intern tables, {len(self.strings)} strings")
+        self.strings.clear()
+        self.employee_refs.clear()
+        self.key_refs.clear()
+        self.reparsed = 0
+        for rows in self.parsed:
+            rows.reparse()
+        self.cache.clear()
+        self.cache_added.clear()
+        self.cache_expires.clear()
+        self.stale.clear()
+        for refresher in refreshers:
+            if refresher.space is self:
+                refresher.wake_all()
+
+    def refs_stale(self) -> bool:
+        """Whether more rows were parsed again since the last rebuild than there are live rows, each may have left a dead name"""
+        live = sum(len(rows.objects) for rows in self.parsed)
+        return self.reparsed > 2 * live + REFS_SLACK  # the first parse of every live row counts too
+
+    async def drop_cache(self):
+        self.cache.clear()
+        self.cache_added.clear()
+        self.cache_expires.clear()
+        self.stale.clear()
+        for refresher in refreshers:
+            if refresher.space is self:
+                refresher.wake_all()
+
+    async def add_to_cache(self, key, value, seconds=60):
+        self.cache[key] = value
+        self.cache_added[key] = time.monotonic()
+        self.cache_expires[key] = time.monotonic() + seconds
+        self.stale.discard(key)
+        print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] INFO: Added to cache: {key}")
+        timer = self.timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        self.timers[key] = asyncio.create_task(self.remove_from_cache(key, seconds))
+
+    async def is_in_cache(self, key):
+        return key in self.cache
+
+    async def remove_from_cache(self, key, seconds=0):
+        if seconds > 0:
+            await asyncio.sleep(seconds)
+            if self.timers.get(key) is asyncio.current_task():
+                del self.timers[key]
+            if self.cache_expires.get(key, 0) > time.monotonic():  # value was replaced by a newer one
+                return
+        else:  # invalidated by a write, reads already in flight may predate it
+            self.cache_generation[key] = self.cache_generation.get(key, 0) + 1
+            self.inflight.pop(key, None)
+            if key in self.cache and self.refreshed(key):  # handlers keep the old value meanwhile
+                print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] INFO: Marked stale: {key}")
+                self.stale.add(key)
+                self.wake_refreshers(key)
+                return
+        if key in self.cache:
+            print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] INFO: Removed from cache: {key}")
+            del self.cache[key]
+            self.cache_added.pop(key, None)
+            self.cache_expires.pop(key, None)
+            self.stale.discard(key)
+        self.wake_refreshers(key)
+
+    def refreshed(self, key) -> bool:
+        """Whether a running refresher reloads the key of this space"""
+        return any(refresher.space is self and key in refresher.loaders for refresher in refreshers)
+
+    def wake_refreshers(self, key):
+        for refresher in refreshers:
+            if refresher.space is self:
+                refresher.wake(key)
+
+    async def single_flight(self, key, load):
+        """Run load() once for all concurrent callers asking for the same cache key"""
+        task = self.inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self.guarded_load(key, load))
+            self.inflight[key] = task
+            task.add_done_callback(lambda done: self.inflight.pop(key) if self.inflight.get(key) is done else None)
+        return await asyncio.shield(task)
+
+    async def guarded_load(self, key, load):
+        for attempt in range(LOAD_ATTEMPTS):
+            generation = self.cache_generation.get(key, 0)
+            value = await load()
+            if self.cache_generation.get(key, 0) == generation:
+                return value
+            # invalidated while loading, so the value may miss the write; callers waiting on it get a fresh one
+            if self.cache.get(key) is value:
+                if self.refreshed(key):  # still served until the retry below replaces it
+                    self.stale.add(key)
+                else:
+                    del self.cache[key]
+                    self.cache_added.pop(key, None)
+                    self.cache_expires.pop(key, None)
+        return value
+
+    async def get_from_cache(self, key):
+        if key in self.cache:
+            print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] INFO: Cache hit: {key}")
+            return self.cache[key]
+        else:
+            return None
+
+
+default_space = CacheSpace("default")
+current_space = contextvars.ContextVar("cache_space", default=default_space)
+
+cache = default_space.cache
+cache_added = default_space.cache_added
+cache_expires = default_space.cache_expires
+inflight = default_space.inflight
+cache_generation = default_space.cache_generation
+employee_refs = default_space.employee_refs
+key_refs = default_space.key_refs
+breaker = default_space.breaker
+refreshers = []
+tables_read = contextvars.ContextVar("tables_read", default=None)  # of the running update, shared with the tasks it gathers
+
+
+def note_read(table: str):
+    reads = tables_read.get()
+    if reads is not None:
+        reads.add(table)
+
+
+def space() -> CacheSpace:
+    return current_space.get()
 
 
 async def drop_cache():
-    cache.clear()
+    await space().drop_cache()
+
+
+class CacheRefresher:
+    """
+    Keeps caches warm: reloads each one shortly before it expires (with jitter)
+    and right after it is invalidated, so handlers don't wait for Sheets.
+    """
+
+    def __init__(self, loaders: dict, _space: CacheSpace = None):
+        self.loaders = loaders  # cache key -> (load(force=True), ttl)
+        self.space = _space if _space is not None else space()
+        self.events = {key: asyncio.Event() for key in loaders}
+        self.tasks = []
+
+    async def warm_up(self):
+        token = current_space.set(self.space)  # the loads fill the caches of this refresher's space
+        try:
+            results = await asyncio.gather(
+                *(load(force=True) for load, _ in self.loaders.values()),
+                return_exceptions=True
+            )
+        finally:
+            current_space.reset(token)
+        for key, result in zip(self.loaders, results):
+            if isinstance(result, Exception):
+                print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] ERR: Failed to preload {key}: {result}")
+
+    def start(self):
+        refreshers.append(self)
+        token = current_space.set(self.space)  # tasks copy the context they are created in
+        try:
+            self.tasks = [asyncio.create_task(self.refresh_loop(key)) for key in self.loaders]
+        finally:
+            current_space.reset(token)
+
+    def stop(self):
+        if self in refreshers:
+            refreshers.remove(self)
+        for task in self.tasks:
+            task.cancel()
+
+    def wake(self, key):
+        if key in self.events:
+            self.events[key].set()
+
+    def wake_all(self):
+        """Reloads every cache, also those still holding a value"""
+        for key, event in self.events.items():
+            if key in self.space.cache:
+                self.space.stale.add(key)
+            event.set()
+
+    async def refresh_loop(self, key):
+        load, ttl = self.loaders[key]
+        event = self.events[key]
+        delay = ttl - REFRESH_LEAD - random.uniform(0, REFRESH_JITTER)
+        while True:
+            try:
+                await asyncio.wait_for(event.wait(), max(delay, REFRESH_DEBOUNCE))
+                await asyncio.sleep(REFRESH_DEBOUNCE)
+            except asyncio.TimeoutError:
+                pass
+            else:
+                if key in self.space.cache and key not in self.space.stale:  # reloaded meanwhile, e.g. by a forced read
+                    event.clear()
+                    continue
+            event.clear()
+            try:
+                await load(force=True)
+                delay = ttl - REFRESH_LEAD - random.uniform(0, REFRESH_JITTER)
+            except Exception as e:
+                print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] ERR: Failed to refresh {key}: {e}")
+                delay = REFRESH_RETRY
 
 
-async def add_to_cache(key, value, seconds=60):
-    cache[key] = value
-    print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] INFO: Added to cache: {key}")
-    asyncio.create_task(remove_from_cache(key, seconds))
+@dataclass
+class ChangeSet:
+    inserted: list[int] = field(default_factory=list)
+    updated: list[int] = field(default_factory=list)
+    deleted: list[int] = field(default_factory=list)
+
+    def __bool__(self):
+        return bool(self.inserted or self.updated or self.deleted)
+
+
+class RowTracker:
+    """Remembers the raw rows of a worksheet with a hash per block, to diff the next read against"""
+
+    def __init__(self, block_size: int = ROWS_BLOCK_SIZE):
+        self.block_size = block_size
+        self.rows: list[tuple] = []
+        self.block_hashes: list[int] = []
+
+    def reset(self):
+        self.rows = []
+        self.block_hashes = []
+
+    def diff(self, rows: list[list[str]], blocks: set[int] = None) -> ChangeSet:
+        """blocks: the only blocks read again (the others are the tracked rows as they were), None for all"""
+        rows = [tuple(row) for row in rows]
+        size = self.block_size
+        block_hashes = [
+            self.block_hashes[block] if blocks is not None and block not in blocks else hash(tuple(rows[i:i + size]))
+            for block, i in enumerate(range(0, len(rows), size))
+        ]
+        changes = ChangeSet()
+        for block, block_hash in enumerate(block_hashes):
+            if block < len(self.block_hashes) and self.block_hashes[block] == block_hash:
+                continue
+            for i in range(block * size, min((block + 1) * size, len(rows))):
+                if i >= len(self.rows):
+                    changes.inserted.append(i)
+                elif self.rows[i] != rows[i]:
+                    changes.updated.append(i)
+        changes.deleted.extend(range(len(rows), len(self.rows)))
+        self.rows, self.block_hashes = rows, block_hashes
+        return changes
+
+
+class ParsedRows:
+    """
+    Parsed objects of a worksheet. Only rows that changed since the previous read are parsed again,
+    unchanged rows keep their objects, and an unchanged sheet keeps returning the very same list.
+
+    After the table's own writes only the blocks holding the written rows are read again, in one batchGet
+    (rows past the end come with the last block, read open-ended). Sheets has no server-side checksums to
+    find other changed blocks by, so edits made by hand or by another process are only picked up by a full
+    read: the refresher's timed reload (partial reads stop when the last full read is as old as that) or
+    expire() after the journal's high-water mark moved.
+    """
+
+    def __init__(self, title: str, parse, ttl: float):
+        self.title = title
+        self.parse = parse  # parse(position, row, headers) -> object or None
+        self.space = space()  # of the table, parsed objects take their ids from it
+        self.space.parsed.append(self)
+        self.tracker = RowTracker()
+        self.objects = []
+        self.items = None
+        self.headers = None
+        self.full_reparse = False
+        self.dirty = set()  # sheet rows written since the last read
+        self.appended = False  # rows were appended after the last one read
+        self.full_read_at = float("-inf")
+        self.partial_max_age = ttl - REFRESH_LEAD - REFRESH_JITTER  # the refresher's timed reload is always a full read
+        self.fetched_blocks = None  # blocks of the last read, None: all of them
+
+    def written(self, rows=(), appended: bool = False):
+        """Sheet rows the table wrote, the next read fetches only their blocks"""
+        self.dirty.update(rows)
+        self.appended = self.appended or appended
+
+    def expire(self):
+        """The next read is a full one, e.g. after another process wrote the worksheet"""
+        self.full_read_at = float("-inf")
+
+    def reparse(self):
+        """The next update parses every row, the raw rows stay the snapshot served while Sheets is unreachable"""
+        self.full_reparse = True
+
+    async def read(self, wks: gspread.Worksheet, get_headers) -> tuple[list, list[str]]:
+        """Fresh rows and headers of the worksheet, or the last good read while Sheets is unreachable"""
+        dirty, self.dirty = self.dirty, set()
+        appended, self.appended = self.appended, False
+        self.fetched_blocks = None
+        partial = (
+            (dirty or appended) and self.headers is not None and not self.full_reparse
+            and time.monotonic() - self.full_read_at < self.partial_max_age
+        )
+        try:
+            if partial:
+                headers = await get_headers()
+                if headers == self.headers:  # new headers reparse every row, read them all
+                    return await self.read_blocks(wks, dirty, appended), headers
+            rows = await get_all_values(wks)
+            headers = await get_headers()
+        except Exception as e:
+            self.written(dirty, appended)  # still to be read
+            if not is_connection_error(e) or self.headers is None:
+                raise
+            print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] ERR: {self.title}: serving the last good snapshot ({e})")
+            return self.tracker.rows, self.headers
+        rows.pop(0)
+        self.full_read_at = time.monotonic()
+        return rows, headers
+
+    async def read_blocks(self, wks: gspread.Worksheet, dirty: set[int], appended: bool) -> list[tuple]:
+        """The tracked rows with the blocks holding the dirty rows read again"""
+        size = self.tracker.block_size
+        tracked = self.tracker.rows
+        width = len(tracked[0]) if tracked else len(self.headers)
+        last = column_letter(width)
+        tail = len(tracked) // size  # first block reaching past the tracked rows, read up to the end of the sheet
+        blocks = sorted({(row - 2) // size for row in dirty if row >= 2})
+        inner = [block for block in blocks if block < tail]
+        ranges = [f"A{2 + block * size}:{last}{1 + (block + 1) * size}" for block in inner]
+        read_tail = appended or len(inner) < len(blocks)
+        if read_tail:
+            ranges.append(f"A{2 + tail * size}:{last}")
+        values = await batch_get(wks, ranges)
+
+        def padded(block_rows: list[list[str]], count: int) -> list[tuple]:
+            block_rows = [tuple(row) + ("",) * (width - len(row)) for row in block_rows]
+            return block_rows + [("",) * width] * (count - len(block_rows))  # trailing empty rows are left out
+
+        rows = list(tracked)
+        for block, block_rows in zip(inner, values):
+            rows[block * size:(block + 1) * size] = padded(block_rows, size)
+        self.fetched_blocks = set(inner)
+        if read_tail:
+            del rows[tail * size:]
+            rows += padded(values[-1], 0)
+            self.fetched_blocks.update(range(tail, (len(rows) + size - 1) // size))
+        print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] INFO: {self.title}: read {len(ranges)} of {(len(rows) + size - 1) // size} blocks")
+        return rows
+
+    def update(self, rows: list[list[str]], headers: list[str]) -> tuple[list, list, list]:
+        """
+        Returns (items, removed objects, added objects).
+        Removed is None when every row was parsed again (new headers or new intern tables).
+        """
+        if (self.headers is not None and headers != self.headers) or self.space.refs_stale():
+            self.space.rebuild_refs()  # every row is parsed again anyway, or the dead names outnumber the live ones
+        reset = headers != self.headers or self.full_reparse
+        if reset:
+            self.full_reparse = False
+            self.tracker.reset()
+            self.objects = []
+            self.headers = headers
+        changes = self.tracker.diff(rows, None if reset else self.fetched_blocks)
+        if not changes and self.items is not None:
+            return self.items, [], []
+        removed = [self.objects[i] for i in changes.updated + changes.deleted if self.objects[i] is not None]
+        del self.objects[len(rows):]
+        self.space.reparsed += len(changes.updated) + len(changes.inserted)
+        with self.space.use():
+            for i in changes.updated:
+                self.objects[i] = self.parse(i, rows[i], headers)
+            for i in changes.inserted:
+                self.objects.append(self.parse(i, rows[i], headers))
+        added = [self.objects[i] for i in changes.updated + changes.inserted if self.objects[i] is not None]
+        self.items = [obj for obj in self.objects if obj is not None]
+        print(
+            f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] INFO: {self.title}: "
+            f"{len(changes.inserted)} inserted, {len(changes.updated)} updated, {len(changes.deleted)} deleted rows"
+        )
+        return self.items, None if reset else removed, added
 
 
-async def is_in_cache(key):
-    return key in cache
+class GroupedView:
+    """Entries grouped by group_key in row order, kept up to date incrementally"""
 
+    def __init__(self, group_key, keep=None):
+        self.group_key = group_key
+        self.keep = keep
+        self.groups = {}
 
-async def remove_from_cache(key, seconds=0):
-    if seconds > 0:
-        await asyncio.sleep(seconds)
-    if key in cache:
-        print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] INFO: Removed from cache: {key}")
-        del cache[key]
+    def build(self, entries):
+        self.groups = {}
+        for entry in entries:
+            if self.keep is None or self.keep(entry):
+                self.groups.setdefault(self.group_key(entry), []).append(entry)
+
+    def add(self, entry):
+        if self.keep is not None and not self.keep(entry):
+            return
+        group = self.groups.setdefault(self.group_key(entry), [])
+        if not group or row_order(group[-1]) < row_order(entry):
+            group.append(entry)
+        else:
+            insort(group, entry, key=row_order)
 
+    def remove(self, entry):
+        group = self.groups.get(self.group_key(entry))
+        if group is None or entry not in group:
+            return
+        group.remove(entry)
+        if not group:
+            del self.groups[self.group_key(entry)]
 
-async def get_from_cache(key):
-    if key in cache:
-        print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] INFO: Cache hit: {key}")
-        return cache[key]
-    else:
-        return None
+
+def row_order(entry) -> float:
+    return entry.row if entry.row is not None else float("inf")  # journal entries are the newest
+
+
+def is_open(entry) -> bool:
+    return entry.time_returned is None
 
 
 # endregion
@@ -247,14 +1021,19 @@ class Entry:
             time_received: datetime,
             time_returned: datetime,
             comment: str,
-            row: int = None
+            row: int = None,
+            event_id: str = None
     ):
-        self.key_name = key_name
-        self.emp_firstname = emp_firstname
-        self.emp_lastname = emp_lastname
-        self.emp_phone = emp_phone
+        refs = space()
+        self.key_name = refs.intern(key_name)  # repeated across thousands of rows, one string object per value
+        self.emp_firstname = refs.intern(emp_firstname)
+        self.emp_lastname = refs.intern(emp_lastname)
+        self.emp_phone = refs.intern(emp_phone)
+        self.key_id = refs.key_refs.get(self.key_name)
+        self.emp_id = refs.employee_refs.get((self.emp_firstname, self.emp_lastname))
         self.comment = comment
         self.row = row
+        self.event_id = event_id  # journal event of a check-out not yet replicated to the sheet
 
         if isinstance(time_received, str):
             self.time_received = datetime.strptime(time_received, datetime_format)
@@ -274,6 +1053,22 @@ class Entry:
             raise TypeError(
                 f"time_returned must be a datetime object or a string in '%d.%m.%Y %H:%M:%S' format. Current value: {time_returned}")
 
+    def __setstate__(self, state: dict):
+        # reference ids are per process, entries unpickled from action payloads get this process' ids
+        self.__dict__.update(state)
+        refs = space()
+        self.key_name = refs.intern(self.key_name)
+        self.emp_firstname = refs.intern(self.emp_firstname)
+        self.emp_lastname = refs.intern(self.emp_lastname)
+        self.key_id = refs.key_refs.get(self.key_name)
+        self.emp_id = refs.employee_refs.get((self.emp_firstname, self.emp_lastname))
+
+    def with_return_time(self, time_returned: datetime | str) -> "Entry":
+        return Entry(
+            self.key_name, self.emp_firstname, self.emp_lastname, self.emp_phone,
+            self.time_received, time_returned, self.comment, self.row, self.event_id
+        )
+
     def __repr__(self):
         return (
             "----------\n"
@@ -287,10 +1082,11 @@ class Entry:
 
 
 class KeysAccountingTable:
-    def __init__(self):
+    def __init__(self, journal=None, _spreadsheet: gspread.Spreadsheet = None):
         with open(tables_path, "r", encoding="utf-8") as f:
             td = json.load(f)
-        self.wks = spreadsheet.worksheet(td["keys_accounting_wks"])
+        self.wks = (_spreadsheet or spreadsheet).worksheet(td["keys_accounting_wks"])
+        self.space = space()
         self.keys_headers = {
             "key_name": "Ключ",
             "emp_firstname": "Имя",
@@ -300,6 +1096,15 @@ class KeysAccountingTable:
             "time_returned": "Время сдачи",
             "comment": "Комментарий",
         }
+        self.rows = ParsedRows("accounting", self.parse_row, ACCOUNTING_CACHE_TIME)
+        self.views = {
+            "by_key": GroupedView(lambda e: e.key_name),
+            "by_emp": GroupedView(lambda e: (e.emp_firstname, e.emp_lastname)),
+            "open_loans": GroupedView(lambda e: e.key_name, is_open),
+            "open_loans_by_emp": GroupedView(lambda e: (e.emp_firstname, e.emp_lastname), is_open),
+        }
+        self.views_source = None
+        self.journal = journal  # journal.Journal whose pending events are overlaid on the sheet
 
     async def new_entry(self, key_name: str, emp_firstname: str, emp_lastname: str, emp_phone: str, comment: str = ""):
         if not comment: comment = ""
@@ -310,74 +1115,224 @@ class KeysAccountingTable:
         await update(self.wks, cell(1, 1), [list(self.keys_headers.values())])
         await auto_resize(self.wks, 1, len(self.keys_headers) + 1)
 
-    async def get_headers(self):
-        cached = await get_from_cache(A_HEADERS)
-        if cached is not None:
-            return cached
+    async def get_headers(self, force: bool = False):
+        if not force:
+            cached = await self.space.get_from_cache(A_HEADERS)
+            if cached is not None:
+                return cached
+        return await self.space.single_flight(A_HEADERS, self.load_headers)
+
+    async def load_headers(self):
         result = (await row_values(self.wks, 1))[0:len(self.keys_headers)]
-        await add_to_cache(A_HEADERS, result, HEADERS_CACHE_TIME)
+        await self.space.add_to_cache(A_HEADERS, result, HEADERS_CACHE_TIME)
         return result
 
     async def append_entry(self, entry: Entry):
-        print("Appending entry:", entry)
-        insert_row = len(await col_values(self.wks, 1)) + 1
+        return (await self.append_entries([entry]))[0]
+
+    async def append_entries(self, entries: list[Entry]) -> list[int]:
+        """Writes the entries to consecutive rows in one request, returns their row numbers"""
+        for entry in entries:
+            print("Appending entry:", entry)
         headers = await self.get_headers()
-        values = []
-        for header in headers:
-            key = swap(self.keys_headers)[header]
-            val = getattr(entry, key)
-            if isinstance(val, datetime):
-                val = val.strftime(datetime_format)
-            values.append(val)
-        await self.check_has_free_rows(insert_row)
-        await update(self.wks, cell(1, insert_row), [values])
-        await remove_from_cache(ACCOUNTING)
+        header_to_key = swap(self.keys_headers)
+        rows = []
+        for entry in entries:
+            values = []
+            for header in headers:
+                val = getattr(entry, header_to_key[header])
+                if isinstance(val, datetime):
+                    val = val.strftime(datetime_format)
+                values.append(val)
+            rows.append(values)
+        insert_row = await append_rows(self.wks, rows)
+        self.rows.written(range(insert_row, insert_row + len(rows)))
+        await self.space.remove_from_cache(ACCOUNTING)
+        await self.space.remove_from_cache(OPEN_ACCOUNTING)
         # await auto_resize(self.wks, 1, len(headers))
+        return list(range(insert_row, insert_row + len(rows)))
 
     async def check_has_free_rows(self, rows_count):
         current_rows = self.wks.row_count
         if current_rows < rows_count:
             await add_rows(self.wks, rows_count - current_rows)
 
-    async def get_all_entries(self) -> list[Entry]:
-        cached = await get_from_cache(ACCOUNTING)
-        if cached is not None:
-            return cached
-        rows = await get_all_values(self.wks)
-        rows.pop(0)
-        headers = await self.get_headers()
-        entries = []
-        for index, row in enumerate(rows, 2):
-            row = [x.strip() for x in row][0:len(self.keys_headers)]
-            row = sort_values_by_headers(headers, row, self.keys_headers)
-            row.append(index)
-            try:
-                entries.append(Entry(*row))
-            except ValueError:
-                print(f"Error in row {index}: {row}")
-                pass
-        await add_to_cache(ACCOUNTING, entries, ACCOUNTING_CACHE_TIME)
+    async def get_all_entries(self, force: bool = False) -> list[Entry]:
+        note_read(ACCOUNTING)
+        entries = await self.get_sheet_entries(force)
+        if self.journal is not None:
+            entries = await self.journal.overlay(entries, ACCOUNTING)
         return entries
 
-    async def get_not_returned_keys(self) -> list[Entry]:
+    async def get_sheet_entries(self, force: bool = False) -> list[Entry]:
+        if not force:
+            cached = await self.space.get_from_cache(ACCOUNTING)
+            if cached is not None:
+                return cached
+        return await self.space.single_flight(ACCOUNTING, self.load_entries)
+
+    async def load_entries(self) -> list[Entry]:
+        if self.journal is not None:
+            mark, moved = await self.journal.hwm_mark(ACCOUNTING)
+            if moved:  # another worker wrote the sheet, only a full read sees its rows
+                self.rows.expire()
+        rows, headers = await self.rows.read(self.wks, self.get_headers)
+        previous = self.rows.items
+        entries, removed, added = self.rows.update(rows, headers)
+        if previous is not None and self.views_source is previous and entries is not previous:
+            for view in self.views.values():
+                if removed is None:  # new headers, every entry is a new object
+                    view.build(entries)
+                    continue
+                for entry in removed:
+                    view.remove(entry)
+                for entry in added:
+                    view.add(entry)
+            self.views_source = entries
+        if self.journal is not None:
+            self.journal.read_from(ACCOUNTING, mark)
+        await self.space.add_to_cache(ACCOUNTING, entries, ACCOUNTING_CACHE_TIME)
+        return entries
+
+    def parse_row(self, position: int, row: list[str], headers: list[str]) -> Entry | None:
+        index = position + 2
+        row = [x.strip() for x in row][0:len(self.keys_headers)]
+        row = sort_values_by_headers(headers, row, self.keys_headers)
+        row.append(index)
+        try:
+            return Entry(*row)
+        except ValueError:
+            print(f"Error in row {index}: {row}")
+            return None
+
+    async def get_view(self, name: str) -> dict:
+        """Entries grouped for fast lookups, rebuilt only if the entries list was replaced wholesale"""
         entries = await self.get_all_entries()
+        if self.views_source is not entries:
+            for view in self.views.values():
+                view.build(entries)
+            self.views_source = entries
+        return self.views[name].groups
+
+    async def get_entries_by_key(self) -> dict[str, list[Entry]]:
+        return await self.get_view("by_key")
+
+    async def get_entries_by_emp(self) -> dict[tuple[str, str], list[Entry]]:
+        return await self.get_view("by_emp")
+
+    async def get_open_loans(self) -> dict[str, list[Entry]]:
+        return await self.get_view("open_loans")
+
+    async def get_open_loans_by_emp(self) -> dict[tuple[str, str], list[Entry]]:
+        return await self.get_view("open_loans_by_emp")
+
+    async def get_available(self, key_name: str, copies: int) -> int:
+        """Copies of the key not on loan, from the incrementally maintained open loans view"""
+        return copies - len((await self.get_open_loans()).get(key_name, ()))
+
+    async def get_not_returned_keys(self) -> list[Entry]:
+        entries = None
+        if not await self.space.is_in_cache(ACCOUNTING):  # no need to pull the whole history for the few open loans
+            try:
+                entries = await self.get_open_entries()
+            except Exception as e:
+                if not is_connection_error(e):
+                    raise
+        if entries is None:  # the full history is cached, or Sheets is unreachable and its last snapshot will do
+            entries = await self.get_all_entries()
         not_returned_keys = []
         for entry in entries:
             if entry.time_returned is None:
                 not_returned_keys.append(entry)
         return not_returned_keys
 
+    async def get_open_entries(self, force: bool = False) -> list[Entry] | None:
+        """Open loans from a projected read with the journal applied, None if the sheet lacks a column it needs"""
+        note_read(ACCOUNTING)
+        headers = await self.get_headers()
+        if any(self.keys_headers[field] not in headers for field in OPEN_COLUMNS):
+            return None
+        entries = None if force else await self.space.get_from_cache(OPEN_ACCOUNTING)
+        if entries is None:
+            entries = await self.space.single_flight(OPEN_ACCOUNTING, self.load_open_entries)
+        if self.journal is not None:
+            entries = await self.journal.overlay(entries, OPEN_ACCOUNTING)
+        return entries
+
+    async def load_open_entries(self) -> list[Entry]:
+        """
+        Projected read: the key, employee and time columns of every row, then full rows only for the open loans
+        whose projected values differ from the last full read; the others keep its parsed entries.
+        """
+        if self.journal is not None:
+            mark, _ = await self.journal.hwm_mark(OPEN_ACCOUNTING)
+        headers = await self.get_headers()
+        columns = [headers.index(self.keys_headers[field]) for field in OPEN_COLUMNS]
+        values = [column[0] if column else [] for column in await batch_get(
+            self.wks, [f"{column_letter(c + 1)}2:{column_letter(c + 1)}" for c in columns], "COLUMNS"
+        )]
+        key_names, returned = values[0], values[-1]
+
+        known_rows = self.rows.tracker.rows if self.rows.headers == headers and not self.rows.full_reparse else []
+        found = {}  # position -> entry
+        missing = []
+        for i, key_name in enumerate(key_names):
+            if not key_name.strip() or (i < len(returned) and returned[i].strip()):
+                continue
+            projected = [(column_values[i] if i < len(column_values) else "").strip() for column_values in values]
+            known = known_rows[i] if i < len(known_rows) else None
+            if known is not None and self.rows.objects[i] is not None and projected == [
+                (known[c] if c < len(known) else "").strip() for c in columns
+            ]:
+                found[i] = self.rows.objects[i]
+            else:
+                missing.append(i)
+        if missing:
+            width = len(headers)
+            last_col = column_letter(width)
+            rows = await batch_get(self.wks, [f"A{i + 2}:{last_col}{i + 2}" for i in missing])
+            with self.space.use():  # the parsed entries take their ids from the table's space
+                for i, value_range in zip(missing, rows):
+                    row = ((value_range[0] if value_range else []) + [""] * width)[:width]  # trailing empty cells are left out
+                    entry = self.parse_row(i, row, headers)
+                    if entry is not None:
+                        found[i] = entry
+        entries = [found[i] for i in sorted(found)]
+        if self.journal is not None:
+            self.journal.read_from(OPEN_ACCOUNTING, mark)
+        await self.space.add_to_cache(OPEN_ACCOUNTING, entries, ACCOUNTING_CACHE_TIME)
+        return entries
+
     async def set_return_time(self, entry: Entry, time_returned: datetime = None) -> None:
+        await self.set_return_time_at_row(entry.row, time_returned)
+
+    async def set_return_time_at_row(self, row: int, time_returned: datetime | str = None) -> None:
         headers = await self.get_headers()
         if time_returned is None:
-            time_returned = datetime.now().strftime(datetime_format)
+            time_returned = datetime.now()
+        if isinstance(time_returned, datetime):
+            time_returned = time_returned.strftime(datetime_format)
         index = headers.index(self.keys_headers["time_returned"]) + 1
         await update(
             self.wks,
-            cell(index, entry.row),
+            cell(index, row),
             [[time_returned]]
         )
-        await remove_from_cache(ACCOUNTING)
+        self.rows.written([row])
+        await self.space.remove_from_cache(ACCOUNTING)
+        await self.space.remove_from_cache(OPEN_ACCOUNTING)
+
+    async def set_return_times(self, return_times: list[tuple[int, datetime | str]]) -> None:
+        """Writes (row, time returned) pairs in one request"""
+        headers = await self.get_headers()
+        index = headers.index(self.keys_headers["time_returned"]) + 1
+        await batch_update(self.wks, [
+            (cell(index, row), [[time_returned.strftime(datetime_format) if isinstance(time_returned, datetime) else time_returned]])
+            for row, time_returned in return_times
+        ])
+        self.rows.written(row for row, _ in return_times)
+        await self.space.remove_from_cache(ACCOUNTING)
+        await self.space.remove_from_cache(OPEN_ACCOUNTING)
 
     async def set_return_time_by_key_name(self, key_name: str, time_returned: datetime = None) -> None:
         entries = await self.get_not_returned_keys()
@@ -393,38 +1348,64 @@ class Key:
     count: int
     key_type: str
     hardware_type: str
+    ref_id: int = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        refs = space()
+        self.key_name = refs.intern(self.key_name)
+        self.ref_id = refs.key_refs.get(self.key_name)
+
+    @property
+    def copies(self) -> int:
+        """Number of copies of the key, a missing or malformed count means a single one"""
+        count = str(self.count).strip()
+        return int(count) if count.isdigit() and int(count) > 0 else 1
 
 
 class KeysTable:
-    def __init__(self):
+    def __init__(self, journal=None, _spreadsheet: gspread.Spreadsheet = None):
         with open(tables_path, "r", encoding="utf-8") as f:
             td = json.load(f)
-        self.wks = spreadsheet.worksheet(td["keys_wks"])
+        self.wks = (_spreadsheet or spreadsheet).worksheet(td["keys_wks"])
+        self.space = space()
+        self.journal = journal  # shared with the other worker processes, tells when they wrote the sheet
         self.keys_headers = {
             "key_name": "Ключ",
             "count": "Количество",
             "key_type": "Тип ключа",
             "hardware_type": "Тип (Аппаратный)",
         }
+        self.rows = ParsedRows("keys", self.parse_row, KEYS_CACHE_TIME)
+        self.index_source = None
+        self.index = {}
 
     async def get_by_name(self, name: str) -> Key | None:
+        return (await self.get_keys_index()).get(name)
+
+    async def get_keys_index(self) -> dict[str, Key]:
         keys = await self.get_all_keys()
-        for key in keys:
-            if key.key_name == name:
-                return key
-        return None
+        if self.index_source is not keys:
+            index = {}
+            for key in keys:
+                index.setdefault(key.key_name, key)
+            self.index, self.index_source = index, keys
+        return self.index
 
     async def setup_table(self):
         await self.check_has_free_rows(1)
         await update(self.wks, cell(1, 1), [list(self.keys_headers.values())])
         await auto_resize(self.wks, 1, len(self.keys_headers) + 1)
 
-    async def get_headers(self):
-        cached = await get_from_cache(K_HEADERS)
-        if cached is not None:
-            return cached
+    async def get_headers(self, force: bool = False):
+        if not force:
+            cached = await self.space.get_from_cache(K_HEADERS)
+            if cached is not None:
+                return cached
+        return await self.space.single_flight(K_HEADERS, self.load_headers)
+
+    async def load_headers(self):
         headers = (await row_values(self.wks, 1))[0:len(self.keys_headers)]
-        await add_to_cache(K_HEADERS, headers, HEADERS_CACHE_TIME)
+        await self.space.add_to_cache(K_HEADERS, headers, HEADERS_CACHE_TIME)
         return headers
 
     async def check_has_free_rows(self, rows_count):
@@ -436,38 +1417,52 @@ class KeysTable:
         await self.add_key(Key(key_name, count, "None", "None"))
 
     async def add_key(self, key_obj: Key):
-        insert_row = len(await col_values(self.wks, 1)) + 1
-        headers = await self.get_headers()
-        values = []
-        for header in headers:
-            key = swap(self.keys_headers)[header]
-            val = getattr(key_obj, key)
-            values.append(val)
-        await self.check_has_free_rows(insert_row)
-        await update(self.wks, cell(1, insert_row), [values])
-        await remove_from_cache(KEYS)
-
-    async def get_all_keys(self) -> list[Key]:
-        cached = await get_from_cache(KEYS)
-        if cached is not None:
-            return cached
-        rows = await get_all_values(self.wks)
-        rows.pop(0)
+        await self.add_keys([key_obj])
+
+    async def add_keys(self, keys: list[Key], on_progress=None):
+        """Appends the keys in chunked writes, see append_rows"""
         headers = await self.get_headers()
-        keys = []
-        for row in rows:
-            row = [x.strip() for x in row][0:len(self.keys_headers)]
-            while len(row) < len(self.keys_headers):
-                row.append("")
-            row = sort_values_by_headers(headers, row, self.keys_headers)
-            try:
-                keys.append(Key(*row))
-            except ValueError:
-                print(f"Error in table keys in row {row}")
-                pass
-        await add_to_cache(KEYS, keys, KEYS_CACHE_TIME)
+        header_to_key = swap(self.keys_headers)
+        rows = [[getattr(key_obj, header_to_key[header]) for header in headers] for key_obj in keys]
+        try:
+            await append_rows(self.wks, rows, on_progress)
+        finally:  # the chunks written before a failure are in the sheet too
+            self.rows.written(appended=True)
+            await self.space.remove_from_cache(KEYS)
+            if self.journal is not None:
+                await asyncio.to_thread(self.journal.stamp, KEYS)
+
+    async def get_all_keys(self, force: bool = False) -> list[Key]:
+        note_read(KEYS)
+        if self.journal is not None and await self.journal.written_elsewhere(KEYS):  # e.g. an import in another worker
+            self.rows.expire()
+            force = True
+        if not force:
+            cached = await self.space.get_from_cache(KEYS)
+            if cached is not None:
+                return cached
+        return await self.space.single_flight(KEYS, self.load_keys)
+
+    async def load_keys(self) -> list[Key]:
+        stamp = await self.journal.stamp_mark(KEYS) if self.journal is not None else None
+        rows, headers = await self.rows.read(self.wks, self.get_headers)
+        keys, _, _ = self.rows.update(rows, headers)
+        if self.journal is not None:
+            self.journal.stamp_read(KEYS, stamp)
+        await self.space.add_to_cache(KEYS, keys, KEYS_CACHE_TIME)
         return keys
 
+    def parse_row(self, position: int, row: list[str], headers: list[str]) -> Key | None:
+        row = [x.strip() for x in row][0:len(self.keys_headers)]
+        while len(row) < len(self.keys_headers):
+            row.append("")
+        row = sort_values_by_headers(headers, row, self.keys_headers)
+        try:
+            return Key(*row)
+        except ValueError:
+            print(f"Error in table keys in row {row}")
+            return None
+
 
 class Employee:
     def __init__(
@@ -477,10 +1472,12 @@ class Employee:
             phone_number: str,
             telegram: str,
             roles: list[str]) -> None:
-        self.first_name = first_name
-        self.last_name = last_name
-        self.phone_number = phone_number
+        refs = space()
+        self.first_name = refs.intern(first_name)
+        self.last_name = refs.intern(last_name)
+        self.phone_number = refs.intern(phone_number)
         self.telegram = telegram
+        self.ref_id = refs.employee_refs.get((self.first_name, self.last_name))
 
         if isinstance(roles, list):
             self.roles = roles
@@ -492,6 +1489,13 @@ class Employee:
         else:
             self.roles = []
 
+    def __setstate__(self, state: dict):
+        self.__dict__.update(state)
+        refs = space()
+        self.first_name = refs.intern(self.first_name)
+        self.last_name = refs.intern(self.last_name)
+        self.ref_id = refs.employee_refs.get((self.first_name, self.last_name))
+
     def __repr__(self):
         return (
             "----------\n"
@@ -504,10 +1508,11 @@ class Employee:
 
 
 class EmployeesTable:
-    def __init__(self):
+    def __init__(self, journal=None, _spreadsheet: gspread.Spreadsheet = None):
         with open(tables_path, "r", encoding="utf-8") as f:
             td = json.load(f)
-        self.wks = spreadsheet.worksheet(td["employees_wks"])
+        self.wks = (_spreadsheet or spreadsheet).worksheet(td["employees_wks"])
+        self.space = space()
         self.keys_headers = {
             "first_name": "Имя",
             "last_name": "Фамилия",
@@ -515,18 +1520,26 @@ class EmployeesTable:
             "telegram": "Телеграм",
             "roles": "Роли",
         }
+        self.rows = ParsedRows("employees", self.parse_row, EMPS_CACHE_TIME)
+        self.index_source = None
+        self.index = {}
+        self.journal = journal  # journal.Journal whose pending registrations are overlaid on the sheet
 
     async def setup_table(self):
         await self.check_has_free_rows(1)
         await update(self.wks, cell(1, 1), [list(self.keys_headers.values())])
         await auto_resize(self.wks, 1, len(self.keys_headers) + 1)
 
-    async def get_headers(self):
-        cached = await get_from_cache(E_HEADERS)
-        if cached is not None:
-            return cached
+    async def get_headers(self, force: bool = False):
+        if not force:
+            cached = await self.space.get_from_cache(E_HEADERS)
+            if cached is not None:
+                return cached
+        return await self.space.single_flight(E_HEADERS, self.load_headers)
+
+    async def load_headers(self):
         headers = (await row_values(self.wks, 1))[0:len(self.keys_headers)]
-        await add_to_cache(E_HEADERS, headers, HEADERS_CACHE_TIME)
+        await self.space.add_to_cache(E_HEADERS, headers, HEADERS_CACHE_TIME)
         return headers
 
     async def check_has_free_rows(self, rows_count):
@@ -545,38 +1558,68 @@ class EmployeesTable:
         await self.add_employee(Employee(first_name, last_name, phone, telegram, roles))
 
     async def add_employee(self, employee_obj: Employee):
-        insert_row = len(await col_values(self.wks, 1)) + 1
-        headers = await self.get_headers()
-        values = []
-        for header in headers:
-            key = swap(self.keys_headers)[header]
-            val = getattr(employee_obj, key)
-            if isinstance(val, list):
-                val = ", ".join(val)
-            values.append(str(val))
-        await self.check_has_free_rows(insert_row)
-        await update(self.wks, cell(1, insert_row), [values])
-        await remove_from_cache(EMPS)
-
-    async def get_all_employees(self) -> list[Employee]:
-        cached = await get_from_cache(EMPS)
-        if cached is not None:
-            return cached
-        rows = await get_all_values(self.wks)
-        rows.pop(0)
+        await self.add_employees([employee_obj])
+
+    async def add_employees(self, employees: list[Employee], on_progress=None):
+        """Appends the employees in chunked writes, see append_rows"""
         headers = await self.get_headers()
-        employees = []
-        for row in rows:
-            row = [x.strip() for x in row][0:len(self.keys_headers)]
-            row = sort_values_by_headers(headers, row, self.keys_headers)
-            try:
-                employees.append(Employee(*row))
-            except ValueError:
-                print(f"Error in table employees in row {row}")
-                pass
-        await add_to_cache(EMPS, employees, EMPS_CACHE_TIME)
+        header_to_key = swap(self.keys_headers)
+        rows = []
+        for employee_obj in employees:
+            values = []
+            for header in headers:
+                val = getattr(employee_obj, header_to_key[header])
+                if isinstance(val, list):
+                    val = ", ".join(val)
+                values.append(str(val))
+            rows.append(values)
+        try:
+            await append_rows(self.wks, rows, on_progress)
+        finally:  # the chunks written before a failure are in the sheet too
+            self.rows.written(appended=True)
+            await self.space.remove_from_cache(EMPS)
+            if self.journal is not None:
+                await asyncio.to_thread(self.journal.stamp, EMPS)
+
+    async def get_all_employees(self, force: bool = False) -> list[Employee]:
+        employees = await self.get_sheet_employees(force)
+        if self.journal is not None:
+            employees = await self.journal.overlay_employees(employees, EMPS)
         return employees
 
+    async def get_sheet_employees(self, force: bool = False) -> list[Employee]:
+        if self.journal is not None and await self.journal.written_elsewhere(EMPS):  # e.g. an import in another worker
+            self.rows.expire()
+            force = True
+        if not force:
+            cached = await self.space.get_from_cache(EMPS)
+            if cached is not None:
+                return cached
+        return await self.space.single_flight(EMPS, self.load_employees)
+
+    async def load_employees(self) -> list[Employee]:
+        if self.journal is not None:
+            mark, moved = await self.journal.hwm_mark(EMPS)
+            if moved:  # another worker wrote the sheet, only a full read sees its rows
+                self.rows.expire()
+            stamp = await self.journal.stamp_mark(EMPS)
+        rows, headers = await self.rows.read(self.wks, self.get_headers)
+        employees, _, _ = self.rows.update(rows, headers)
+        if self.journal is not None:
+            self.journal.read_from(EMPS, mark)
+            self.journal.stamp_read(EMPS, stamp)
+        await self.space.add_to_cache(EMPS, employees, EMPS_CACHE_TIME)
+        return employees
+
+    def parse_row(self, position: int, row: list[str], headers: list[str]) -> Employee | None:
+        row = [x.strip() for x in row][0:len(self.keys_headers)]
+        row = sort_values_by_headers(headers, row, self.keys_headers)
+        try:
+            return Employee(*row)
+        except ValueError:
+            print(f"Error in table employees in row {row}")
+            return None
+
     async def get_by_telegram(self, telegram: str):
         telegram = str(telegram)
         employees = await self.get_all_employees()
@@ -584,17 +1627,24 @@ class EmployeesTable:
             if employee.telegram == telegram:
                 return employee
 
-    async def get_security_employee(self):
+    async def get_security_employees(self) -> list[Employee]:
         employees = await self.get_all_employees()
-        for employee in employees:
-            if "security" in employee.roles:
-                return employee
+        return [employee for employee in employees if "security" in employee.roles and employee.telegram]
 
     async def get_by_name(self, first_name: str, last_name: str):
+        await self.get_all_employees()  # a cold process has no ids until the employees are parsed
+        ref_id = self.space.employee_refs.find((first_name, last_name))
+        return None if ref_id is None else await self.get_by_ref(ref_id)
+
+    async def get_by_ref(self, ref_id: int) -> Employee | None:
+        """Employee with the reference id, e.g. Entry.emp_id"""
         employees = await self.get_all_employees()
-        for employee in employees:
-            if employee.first_name == first_name and employee.last_name == last_name:
-                return employee
+        if self.index_source is not employees:
+            index = {}
+            for employee in employees:
+                index.setdefault(employee.ref_id, employee)
+            self.index, self.index_source = index, employees
+        return self.index.get(ref_id)
 
 
 # endregion
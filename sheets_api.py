@@ -0,0 +1,179 @@
+from urllib.parse import quote
+from google.auth import crypt, jwt
+from yarl import URL
+import aiohttp
+import asyncio
+import json
+import time
+
+
+# region Constants
+
+
+BASE_URL = "https://sheets.googleapis.com/v4/spreadsheets"
+SCOPES = [
+    "https://www.googleapis.com/auth/spreadsheets",
+    "https://www.googleapis.com/auth/drive",
+]
+TOKEN_LIFETIME = 60*60
+TOKEN_EARLY_REFRESH = 60*5  # refresh this many seconds before the access token expires
+REQUEST_TIMEOUT = 30
+POOL_SIZE = 20
+KEEPALIVE_TIMEOUT = 60
+USER_AGENT = "KeysAccountingBot (gzip)"  # Google only compresses responses for user agents containing "gzip"
+
+
+# endregion
+
+
+class SheetsApiError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(f"Sheets API error {status}: {message}")
+        self.status = status
+
+
+class ServiceAccountToken:
+    """OAuth access token of a service account, cached and refreshed shortly before it expires"""
+
+    def __init__(self, info: dict, scopes: list[str] = SCOPES):
+        self.info = info
+        self.scopes = scopes
+        self.signer = crypt.RSASigner.from_service_account_info(info)
+        self.token: str | None = None
+        self.expires = 0.0
+        self.lock = asyncio.Lock()
+
+    def valid(self) -> bool:
+        return self.token is not None and time.time() < self.expires - TOKEN_EARLY_REFRESH
+
+    def invalidate(self):
+        self.token = None
+
+    async def get(self, session: aiohttp.ClientSession) -> str:
+        if self.valid():
+            return self.token
+        async with self.lock:  # one refresh for all concurrent requests
+            if not self.valid():
+                await self.refresh(session)
+        return self.token
+
+    async def refresh(self, session: aiohttp.ClientSession):
+        now = int(time.time())
+        assertion = jwt.encode(self.signer, {
+            "iss": self.info["client_email"],
+            "scope": " ".join(self.scopes),
+            "aud": self.info["token_uri"],
+            "iat": now,
+            "exp": now + TOKEN_LIFETIME,
+        })
+        async with session.post(self.info["token_uri"], data={
+            "grant_type": "urn:ietf:params:oauth:grant-type:jwt-bearer",
+            "assertion": assertion.decode("utf-8"),
+        }) as response:
+            data = await response.json(content_type=None)
+            if response.status != 200:
+                raise SheetsApiError(response.status, data.get("error_description") or data.get("error", ""))
+        self.token = data["access_token"]
+        self.expires = now + data.get("expires_in", TOKEN_LIFETIME)
+
+
+class SheetsClient:
+    """
+    Async Google Sheets v4 client over one pooled keep-alive aiohttp session.
+    Covers the operations the tables need: values get / batchGet / append / update / clear,
+    batchUpdate, reading cells with their grid data and adding a sheet.
+    """
+
+    def __init__(self, credentials_path: str, base_url: str = BASE_URL, timeout: float = REQUEST_TIMEOUT):
+        with open(credentials_path, "r", encoding="utf-8") as f:
+            self.token = ServiceAccountToken(json.load(f))
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.session: aiohttp.ClientSession | None = None
+
+    def get_session(self) -> aiohttp.ClientSession:
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=POOL_SIZE, keepalive_timeout=KEEPALIVE_TIMEOUT),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                headers={"Accept-Encoding": "gzip", "User-Agent": USER_AGENT},
+            )
+        return self.session
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def request(self, method: str, path: str, params: dict | list = None, body: dict = None) -> dict:
+        session = self.get_session()
+        url = URL(self.base_url + path, encoded=True)
+        for attempt in range(2):
+            token = await self.token.get(session)
+            async with session.request(
+                    method, url, params=params, json=body,
+                    headers={"Authorization": f"Bearer {token}"}
+            ) as response:
+                if response.status == 401 and attempt == 0:  # token revoked or clock skew, get a new one
+                    self.token.invalidate()
+                    continue
+                try:
+                    data = await response.json(content_type=None) or {}
+                except ValueError:  # e.g. an HTML error page from a proxy
+                    data = {}
+                if response.status >= 400:
+                    error = data.get("error", {})
+                    raise SheetsApiError(response.status, error.get("message", "") if isinstance(error, dict) else str(error))
+                return data
+
+    @staticmethod
+    def values_path(spreadsheet_id: str, range_name: str, action: str = "") -> str:
+        return f"/{spreadsheet_id}/values/{quote(range_name, safe='')}{action}"
+
+    async def values_get(self, spreadsheet_id: str, range_name: str, major_dimension: str = "ROWS") -> list[list[str]]:
+        data = await self.request(
+            "GET", self.values_path(spreadsheet_id, range_name), params={"majorDimension": major_dimension}
+        )
+        return data.get("values", [])
+
+    async def values_batch_get(self, spreadsheet_id: str, ranges: list[str], major_dimension: str = "ROWS") -> list[list[list[str]]]:
+        params = [("ranges", range_name) for range_name in ranges] + [("majorDimension", major_dimension)]
+        data = await self.request("GET", f"/{spreadsheet_id}/values:batchGet", params=params)
+        return [value_range.get("values", []) for value_range in data.get("valueRanges", [])]
+
+    async def values_update(self, spreadsheet_id: str, range_name: str, values: list[list], value_input_option: str = "RAW") -> dict:
+        return await self.request(
+            "PUT", self.values_path(spreadsheet_id, range_name),
+            params={"valueInputOption": value_input_option},
+            body={"range": range_name, "majorDimension": "ROWS", "values": values},
+        )
+
+    async def values_batch_update(self, spreadsheet_id: str, data: list[tuple[str, list[list]]], value_input_option: str = "RAW") -> dict:
+        """data: (range, values) pairs written in one request"""
+        return await self.request("POST", f"/{spreadsheet_id}/values:batchUpdate", body={
+            "valueInputOption": value_input_option,
+            "data": [{"range": range_name, "majorDimension": "ROWS", "values": values} for range_name, values in data],
+        })
+
+    async def values_append(self, spreadsheet_id: str, range_name: str, values: list[list], value_input_option: str = "RAW") -> dict:
+        return await self.request(
+            "POST", self.values_path(spreadsheet_id, range_name, ":append"),
+            params={"valueInputOption": value_input_option, "insertDataOption": "INSERT_ROWS"},
+            body={"range": range_name, "majorDimension": "ROWS", "values": values},
+        )
+
+    async def values_clear(self, spreadsheet_id: str, range_name: str) -> dict:
+        return await self.request("POST", self.values_path(spreadsheet_id, range_name, ":clear"), body={})
+
+    async def batch_update(self, spreadsheet_id: str, requests: list[dict]) -> dict:
+        return await self.request("POST", f"/{spreadsheet_id}:batchUpdate", body={"requests": requests})
+
+    async def get_spreadsheet(self, spreadsheet_id: str, params: dict) -> dict:
+        return await self.request("GET", f"/{spreadsheet_id}", params=params)
+
+    async def add_sheet(self, spreadsheet_id: str, title: str, rows: int, cols: int, index: int = None) -> dict:
+        properties = {"title": title, "gridProperties": {"rowCount": rows, "columnCount": cols}}
+        if index is not None:
+            properties["index"] = index
+        data = await self.batch_update(spreadsheet_id, [{"addSheet": {"properties": properties}}])
+        return data["replies"][0]["addSheet"]["properties"]
@@ -0,0 +1,191 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime
+import contextvars
+import asyncio
+import os
+import sheets
+import journal
+
+
+DEFAULT = "default"  # the spreadsheet of spreadsheet_url, serves every chat not routed elsewhere
+MAX_OPEN_SITES = 20  # open sites beyond this are closed least recently used first
+SITE_QUOTA_RATE = 1.0  # Sheets requests per second per routed site, the service account's quota is shared
+SITE_QUOTA_BURST = 30
+
+current = contextvars.ContextVar("site")
+
+
+class Site:
+    """One spreadsheet served by the process, with its own tables, cache space, journal and Sheets quota"""
+
+    def __init__(self, name: str, url: str, journal_path: str, space: sheets.CacheSpace):
+        self.name = name
+        self.url = url
+        self.journal_path = journal_path
+        self.space = space
+        self.spreadsheet = None
+        self.journal = None
+        self.keys_accounting_table = None
+        self.keys_table = None
+        self.emp_table = None
+        self.replicator = None
+        self.refresher = None
+        self.dashboard = None  # set up by Sites.on_open
+        self.active = 0  # updates and tasks using the site right now, an active site is never closed
+
+    def connect(self, spreadsheet):
+        """Blocking, gspread fetches the worksheets"""
+        self.spreadsheet = spreadsheet
+        self.space.breaker.probe = lambda: self.spreadsheet.fetch_sheet_metadata()  # the current one, /migrate switches it
+        self.journal = journal.Journal(self.journal_path)
+        with self.use():  # the tables keep the site's cache space
+            self.keys_accounting_table = sheets.KeysAccountingTable(journal=self.journal, _spreadsheet=spreadsheet)
+            self.keys_table = sheets.KeysTable(journal=self.journal, _spreadsheet=spreadsheet)
+            self.emp_table = sheets.EmployeesTable(journal=self.journal, _spreadsheet=spreadsheet)
+        self.replicator = journal.Replicator(self.journal, self.keys_accounting_table, self.emp_table)
+        self.refresher = sheets.CacheRefresher({
+            sheets.A_HEADERS: (self.keys_accounting_table.get_headers, sheets.HEADERS_CACHE_TIME),
+            sheets.K_HEADERS: (self.keys_table.get_headers, sheets.HEADERS_CACHE_TIME),
+            sheets.E_HEADERS: (self.emp_table.get_headers, sheets.HEADERS_CACHE_TIME),
+            sheets.ACCOUNTING: (self.keys_accounting_table.get_all_entries, sheets.ACCOUNTING_CACHE_TIME),
+            sheets.KEYS: (self.keys_table.get_all_keys, sheets.KEYS_CACHE_TIME),
+            sheets.EMPS: (self.emp_table.get_all_employees, sheets.EMPS_CACHE_TIME),
+        }, self.space)
+
+    async def start(self, replicate: bool = True):
+        with self.use():
+            if replicate:
+                self.replicator.start()
+            await self.refresher.warm_up()
+            self.refresher.start()
+
+    def stop(self):
+        self.refresher.stop()
+        self.replicator.stop()
+        if self.dashboard is not None:
+            self.dashboard.stop()
+        self.journal.close()  # unreplicated events stay in the file, the next start replays them
+        self.space.close()
+
+    @contextmanager
+    def use(self):
+        """Routes the tables, caches and quota of the code inside (and of the tasks it creates) to this site"""
+        self.active += 1
+        site_token = current.set(self)
+        space_token = sheets.current_space.set(self.space)
+        try:
+            yield self
+        finally:
+            sheets.current_space.reset(space_token)
+            current.reset(site_token)
+            self.active -= 1
+
+
+class Sites:
+    """
+    Routes chats to sites and keeps the recently used ones open in an OrderedDict kept in last-use order.
+    Sites are configured under "sites" in spreadsheet_tables.json as name -> {"spreadsheet_url", "chats"},
+    a site opens on the first update routed to it. Closing a cold site frees its caches and parsed rows,
+    its journal stays on disk.
+    """
+
+    def __init__(self, default: Site, config: dict, max_open: int = MAX_OPEN_SITES):
+        self.default = default
+        self.config = config
+        self.routes = {str(chat_id): name for name, site in config.items() for chat_id in site.get("chats", [])}
+        self.max_open = max_open
+        self.open_sites: OrderedDict[str, Site] = OrderedDict()
+        self.opening: dict[str, asyncio.Task] = {}
+        self.on_open = None  # called with every site it opens, before the site serves updates
+        self.background = True  # replication and dashboards, run only in webhook worker 0
+        if config and default.space.quota is None:  # the default site shares the service account's quota too
+            default.space.quota = sheets.Quota(SITE_QUOTA_RATE, SITE_QUOTA_BURST)
+
+    def journal_path(self, name: str) -> str:
+        return self.config[name].get("journal", f"key_journal_{name}.jsonl")
+
+    def names(self) -> list[str]:
+        return [DEFAULT] + list(self.config)
+
+    def route(self, chat_id: int | str) -> str:
+        return self.routes.get(str(chat_id), DEFAULT)
+
+    def current(self) -> Site:
+        return current.get(self.default)
+
+    async def for_chat(self, chat_id: int | str) -> Site:
+        return await self.get(self.route(chat_id))
+
+    async def get(self, name: str) -> Site:
+        if name == DEFAULT:
+            return self.default
+        site = self.open_sites.get(name)
+        if site is not None:
+            self.open_sites.move_to_end(name)
+            return site
+        task = self.opening.get(name)
+        if task is None:  # updates arriving while the site opens wait for the same open
+            task = self.opening[name] = asyncio.ensure_future(self._open(name))
+            task.add_done_callback(lambda done: self.opening.pop(name, None))
+        return await asyncio.shield(task)
+
+    async def _open(self, name: str) -> Site:
+        config = self.config[name]
+        site = Site(
+            name,
+            config["spreadsheet_url"],
+            self.journal_path(name),
+            sheets.CacheSpace(name, sheets.Quota(SITE_QUOTA_RATE, SITE_QUOTA_BURST)),
+        )
+        with site.use():
+            spreadsheet = await sheets.sheets_call(sheets.gs.open_by_url, site.url)
+            await asyncio.to_thread(site.connect, spreadsheet)
+            if self.on_open is not None:
+                self.on_open(site)
+        await site.start(self.background)
+        self.open_sites[name] = site
+        print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] INFO: Site {name} opened ({len(self.open_sites)} open)")
+        self.evict()
+        return site
+
+    def evict(self):
+        for name, site in list(self.open_sites.items()):
+            if len(self.open_sites) <= self.max_open:
+                break
+            if site.active:
+                continue
+            del self.open_sites[name]
+            site.stop()
+            print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] INFO: Site {name} closed")
+
+    async def has_pending(self, name: str) -> bool:
+        """Whether the site's journal has events the sheet hasn't got yet, without opening the site"""
+        return await asyncio.to_thread(self._has_pending, self.journal_path(name))
+
+    @staticmethod
+    def _has_pending(path: str) -> bool:
+        try:
+            size = os.path.getsize(path)
+        except FileNotFoundError:
+            return False
+        return size > journal.Journal.read_hwm(path + ".hwm")["offset"]
+
+    def stop(self):
+        for site in self.open_sites.values():
+            site.stop()
+        self.open_sites.clear()
+
+
+class Current:
+    """Stands for the table (journal, dashboard...) of the site the running update is routed to"""
+
+    def __init__(self, sites: Sites, attr: str):
+        object.__setattr__(self, "sites", sites)
+        object.__setattr__(self, "attr", attr)
+
+    def __getattr__(self, name):
+        return getattr(getattr(self.sites.current(), self.attr), name)
+
+    def __setattr__(self, name, value):
+        setattr(getattr(self.sites.current(), self.attr), name, value)
@@ -0,0 +1,146 @@
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey, DefaultKeyBuilder
+from datetime import datetime
+from typing import Any
+import threading
+import asyncio
+import sqlite3
+import pickle
+
+
+FLUSH_INTERVAL = 0.5  # seconds between write-behind flushes
+MAX_CLEAN_RECORDS = 10000  # clean records kept in memory before the oldest are dropped
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    Persistent FSM storage backed by SQLite in WAL mode.
+
+    Writes land in an in-memory front layer and are flushed in batches every
+    FLUSH_INTERVAL seconds, so a chain of state.update_data calls costs one disk write.
+    The same file can be opened by several processes as long as every chat is handled
+    by only one of them (see webhook sharding), since the front layer is per process.
+    """
+
+    def __init__(self, path: str, flush_interval: float = FLUSH_INTERVAL):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        self.records: dict[str, list] = {}  # key -> [state, data]
+        self.dirty: set[str] = set()
+        self.flush_task: asyncio.Task | None = None
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("PRAGMA busy_timeout=5000")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS fsm ("
+            "key TEXT PRIMARY KEY, "
+            "state TEXT, "
+            "data BLOB NOT NULL)"
+        )
+
+    # region Disk
+
+    def _load(self, key: str) -> list:
+        with self.lock:
+            row = self.conn.execute("SELECT state, data FROM fsm WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return [None, {}]
+        return [row[0], pickle.loads(row[1])]
+
+    def _write(self, records: list[tuple[str, str | None, dict]]):
+        upserts = [(key, state, pickle.dumps(data)) for key, state, data in records if state is not None or data]
+        deletes = [(key,) for key, state, data in records if state is None and not data]
+        with self.lock:
+            self.conn.execute("BEGIN")
+            try:
+                if upserts:
+                    self.conn.executemany(
+                        "INSERT INTO fsm (key, state, data) VALUES (?, ?, ?) "
+                        "ON CONFLICT(key) DO UPDATE SET state = excluded.state, data = excluded.data",
+                        upserts
+                    )
+                if deletes:
+                    self.conn.executemany("DELETE FROM fsm WHERE key = ?", deletes)
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    async def flush(self):
+        if not self.dirty:
+            return
+        keys, self.dirty = self.dirty, set()
+        records = [(key, self.records[key][0], dict(self.records[key][1])) for key in keys]
+        try:
+            await asyncio.to_thread(self._write, records)
+        except Exception:
+            self.dirty |= keys
+            raise
+        self._evict()
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] ERR: FSM storage flush failed: {e}")
+
+    def _evict(self):
+        overflow = len(self.records) - MAX_CLEAN_RECORDS
+        if overflow <= 0:
+            return
+        for key in [k for k in self.records if k not in self.dirty][:overflow]:
+            del self.records[key]
+
+    # endregion
+
+    # region Front layer
+
+    async def _record(self, key: StorageKey) -> tuple[str, list]:
+        str_key = self.key_builder.build(key)
+        record = self.records.get(str_key)
+        if record is None:
+            record = await asyncio.to_thread(self._load, str_key)
+            record = self.records.setdefault(str_key, record)
+        return str_key, record
+
+    def _mark_dirty(self, str_key: str):
+        self.dirty.add(str_key)
+        if self.flush_task is None or self.flush_task.done():
+            self.flush_task = asyncio.create_task(self._flush_loop())
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        str_key, record = await self._record(key)
+        record[0] = state.state if isinstance(state, State) else state
+        self._mark_dirty(str_key)
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        _, record = await self._record(key)
+        return record[0]
+
+    async def set_data(self, key: StorageKey, data: dict[str, Any]) -> None:
+        str_key, record = await self._record(key)
+        record[1] = data.copy()
+        self._mark_dirty(str_key)
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        _, record = await self._record(key)
+        return record[1].copy()
+
+    async def close(self) -> None:
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            try:
+                await self.flush_task
+            except asyncio.CancelledError:
+                pass
+            self.flush_task = None
+        await self.flush()
+        with self.lock:
+            self.conn.close()
+
+    # endregion
@@ -0,0 +1,131 @@
+from aiogram.dispatcher.middlewares.base import BaseMiddleware
+from aiogram.types import Message, CallbackQuery
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime
+import time
+
+
+RATE = 1.0  # tokens refilled per second
+BURST = 15  # bucket size, a normal flow (command, answer, button) never waits
+IDLE_TTL = 60*10  # a full bucket that long untouched is the same as no bucket
+MAX_USERS = 10000
+DEFAULT_COST = 1
+
+# Commands and the states that follow them; the follow-up message is what actually reads the tables
+COSTS = {
+    "/find_key": 1, "FindKeyState": 2,
+    "/key_history": 1, "GetKeyHistoryState": 4,
+    "/emp_history": 1, "GetEmpHistoryState": 4,
+    "/who_had": 1, "WhoHadKeyState": 3,
+    "/my_keys": 2,
+    "/not_returned": 3,
+    "/return_key": 1, "ReturnKeyState": 2,
+    "/stats": 4,
+    "/export": 8,
+    "/import": 1, "ImportState": 8,
+    "/send_cache": 8,
+    "/drop_cache": 8,
+    "/migrate": 8,
+}
+
+THROTTLED = "Слишком много запросов, подождите {} сек."
+
+
+@dataclass
+class Bucket:
+    tokens: float
+    updated: float
+    warned: bool = False  # the user was told to wait, stay silent until the bucket refills
+
+
+class TokenBuckets:
+    """Per-user token buckets in an OrderedDict kept in last-use order, so idle users are evicted from the front in O(1)"""
+
+    def __init__(self, rate: float = RATE, burst: float = BURST, idle_ttl: float = IDLE_TTL, max_users: int = MAX_USERS):
+        self.rate = rate
+        self.burst = burst
+        self.idle_ttl = idle_ttl
+        self.max_users = max_users
+        self.buckets: OrderedDict[int, Bucket] = OrderedDict()
+
+    def take(self, user_id: int, cost: float) -> tuple[bool, Bucket]:
+        now = time.monotonic()
+        bucket = self.buckets.get(user_id)
+        if bucket is None:
+            bucket = self.buckets[user_id] = Bucket(self.burst, now)
+        else:
+            bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.updated) * self.rate)
+            bucket.updated = now
+            self.buckets.move_to_end(user_id)
+        self.evict(now)
+        if bucket.tokens < cost:
+            return False, bucket
+        bucket.tokens -= cost
+        bucket.warned = False
+        return True, bucket
+
+    def wait_time(self, bucket: Bucket, cost: float) -> float:
+        return (cost - bucket.tokens) / self.rate
+
+    def evict(self, now: float):
+        while self.buckets:
+            user_id, bucket = next(iter(self.buckets.items()))
+            if now - bucket.updated < self.idle_ttl and len(self.buckets) <= self.max_users:
+                break
+            self.buckets.popitem(last=False)
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """
+    Rate limits each user's messages and button taps with token buckets weighted by COSTS,
+    so one user cannot drain the shared Sheets quota. An update identical to one of the same
+    user that is still being handled (a repeated command, a double tap) is merged into it.
+    """
+
+    def __init__(self, buckets: TokenBuckets, costs: dict[str, float] = COSTS):
+        self.buckets = buckets
+        self.costs = costs
+        self.inflight: set[tuple] = set()
+
+    def cost(self, event, raw_state: str | None) -> float:
+        if isinstance(event, Message) and event.text and event.text.startswith("/"):
+            return self.costs.get(event.text.split()[0].split("@")[0], DEFAULT_COST)
+        if isinstance(event, Message) and raw_state:
+            return self.costs.get(raw_state.split(":")[0], DEFAULT_COST)
+        return DEFAULT_COST
+
+    @staticmethod
+    def query(event, raw_state: str | None) -> tuple:
+        if isinstance(event, CallbackQuery):
+            return event.from_user.id, "callback", event.data
+        return event.from_user.id, "message", raw_state, event.text or event.content_type
+
+    async def __call__(self, handler, event, data: dict):
+        user = data.get("event_from_user")
+        if user is None:
+            return await handler(event, data)
+
+        query = self.query(event, data.get("raw_state"))
+        if query in self.inflight:  # the first one answers for both
+            if isinstance(event, CallbackQuery):
+                await event.answer()
+            return None
+
+        cost = self.cost(event, data.get("raw_state"))
+        allowed, bucket = self.buckets.take(user.id, cost)
+        if not allowed:
+            print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] INFO: Throttled {user.username} ({user.id})")
+            text = THROTTLED.format(max(1, round(self.buckets.wait_time(bucket, cost))))
+            if isinstance(event, CallbackQuery):
+                await event.answer(text)
+            elif not bucket.warned:
+                bucket.warned = True
+                await event.answer(text)
+            return None
+
+        self.inflight.add(query)
+        try:
+            return await handler(event, data)
+        finally:
+            self.inflight.discard(query)
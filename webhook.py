@@ -0,0 +1,177 @@
+from aiogram import Bot, Dispatcher
+from aiohttp import web
+from datetime import datetime
+import multiprocessing
+import asyncio
+
+
+# region Constants
+
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+CHAT_ID_PATHS = (
+    ("chat", "id"),
+    ("message", "chat", "id"),
+    ("from", "id"),
+    ("user", "id"),
+)
+
+
+# endregion
+
+
+# region Utils
+
+
+def now():
+    return datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+
+def update_chat_id(update: dict) -> int:
+    for obj in update.values():
+        if not isinstance(obj, dict):
+            continue
+        for path in CHAT_ID_PATHS:
+            value = obj
+            for part in path:
+                value = value.get(part) if isinstance(value, dict) else None
+            if isinstance(value, int):
+                return value
+    return 0
+
+
+class ChatSequencer:
+    """Runs updates concurrently across chats but strictly one after another within a chat"""
+
+    def __init__(self, handle):
+        self.handle = handle
+        self.tails: dict[int, asyncio.Task] = {}
+
+    def submit(self, update: dict):
+        chat_id = update_chat_id(update)
+        previous = self.tails.get(chat_id)
+        self.tails[chat_id] = asyncio.create_task(self._run(chat_id, previous, update))
+
+    async def _run(self, chat_id: int, previous: asyncio.Task | None, update: dict):
+        if previous is not None:
+            await asyncio.wait([previous])
+        try:
+            await self.handle(update)
+        except Exception as e:
+            print(f"[{now()}] ERR: Failed to process update {update.get('update_id')}: {e}")
+        finally:
+            if self.tails.get(chat_id) is asyncio.current_task():
+                del self.tails[chat_id]
+
+    async def join(self):
+        while self.tails:
+            await asyncio.wait(list(self.tails.values()))
+
+
+# endregion
+
+
+# region Workers
+
+
+def worker_main(index: int, queue: multiprocessing.Queue):
+    asyncio.run(run_worker(index, queue))
+
+
+async def run_worker(index: int, queue: multiprocessing.Queue):
+    import bot as bot_module
+    bot_module.worker_id = index
+    bot, dp = bot_module.bot, bot_module.dp
+
+    sequencer = ChatSequencer(lambda update: dp.feed_raw_update(bot, update))
+    await dp.emit_startup(bot=bot, dispatcher=dp, bots=[bot], **dp.workflow_data)
+    print(f"[{now()}] INFO: Worker {index} started")
+    try:
+        while True:
+            update = await asyncio.to_thread(queue.get)
+            if update is None:
+                break
+            sequencer.submit(update)
+        await sequencer.join()
+    finally:
+        await dp.emit_shutdown(bot=bot, dispatcher=dp, bots=[bot], **dp.workflow_data)
+        await bot.session.close()
+        print(f"[{now()}] INFO: Worker {index} stopped")
+
+
+# endregion
+
+
+# region Server
+
+
+async def run_webhook(bot: Bot, dp: Dispatcher, config: dict):
+    """
+    Serve Telegram updates from a local aiohttp server.
+
+    With workers > 1 every update is routed to worker process chat_id % workers,
+    so all updates of one conversation are handled by the same process in order.
+    With workers <= 1 updates are handled in this process.
+    """
+    host = config.get("host", "0.0.0.0")
+    port = int(config.get("port", 8080))
+    path = config.get("path", "/webhook")
+    secret = config.get("secret")
+    workers = int(config.get("workers", 1))
+
+    processes = []
+    queues = []
+    sequencer = None
+    if workers > 1:
+        ctx = multiprocessing.get_context("spawn")
+        for index in range(workers):
+            queue = ctx.Queue()
+            process = ctx.Process(target=worker_main, args=(index, queue), name=f"bot-worker-{index}", daemon=True)
+            process.start()
+            queues.append(queue)
+            processes.append(process)
+    else:
+        sequencer = ChatSequencer(lambda update: dp.feed_raw_update(bot, update))
+        await dp.emit_startup(bot=bot, dispatcher=dp, bots=[bot], **dp.workflow_data)
+
+    async def handle_update(request: web.Request):
+        if secret and request.headers.get(SECRET_HEADER) != secret:
+            return web.Response(status=401)
+        update = await request.json()
+        if sequencer is not None:
+            sequencer.submit(update)
+        else:
+            queues[update_chat_id(update) % workers].put(update)
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post(path, handle_update)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    print(f"[{now()}] INFO: Webhook server listening on {host}:{port}{path} with {max(workers, 1)} worker(s)")
+
+    if config.get("url"):
+        await bot.set_webhook(
+            config["url"],
+            secret_token=secret,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+        if sequencer is not None:
+            await sequencer.join()
+            await dp.emit_shutdown(bot=bot, dispatcher=dp, bots=[bot], **dp.workflow_data)
+        for queue in queues:
+            queue.put(None)
+        for process in processes:
+            await asyncio.to_thread(process.join, 10)
+        if config.get("url"):
+            await bot.delete_webhook()
+        await bot.session.close()
+
+
+# endregion